@@ -0,0 +1,375 @@
+"""
+In process caches used by the OrientDB clients to avoid round trips for lookups that are repeated many times during
+ETL and ingestion. The caches are shared by every client of the same database within a worker. They are only ever a
+shortcut: the UNIQUE_HASH_INDEX on each class hashkey remains the source of truth, so a missing entry costs at most
+the round trip the cache was meant to save. A cached RID can be stale when another worker deleted or merged its node,
+so it is only trusted for HASHKEY_CACHE_TTL seconds after it was read from or written to OrientDB.
+"""
+import copy
+import time
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from apiserver.utils import HASHKEY_CACHE_SIZE, HASHKEY_BLOOM_CAPACITY, HASHKEY_CACHE_TTL, CASE_CACHE_SIZE, \
+    CASE_CACHE_TTL, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+
+
+class LRUCache:
+    """
+    Bounded least recently used mapping. Not thread safe on its own; callers hold their own lock.
+    """
+
+    def __init__(self, max_size=HASHKEY_CACHE_SIZE):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            return self.data[key]
+        return None
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        return self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class BloomFilter:
+    """
+    Fixed size bloom filter sized for the expected number of keys and false positive rate. A False from
+    might_contain means the key was never added.
+    """
+
+    def __init__(self, capacity=HASHKEY_BLOOM_CAPACITY, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing with the two halves of a single md5 digest gives k independent enough positions
+        digest = hashlib.md5(str(key).encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def might_contain(self, key):
+        for p in self._positions(key):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class HashkeyCache:
+    """
+    Per class hashkey to RID cache consulted by ODB.check_index_nodes before querying index:<Class>_hashkey.
+    Each class has a bounded LRU of resolved hashkeys and, once the class has been warmed from the full index, a bloom
+    filter of every known hashkey. A hashkey the bloom filter has never seen is known not to exist (within this worker)
+    so the lookup is skipped entirely. Nodes inserted by other workers are still caught by the unique index on insert.
+    A RID older than the ttl is not returned, the caller checks the index again and add renews the entry, so a node
+    deleted by another worker is only reused for up to the ttl.
+        hits: lookups answered from the LRU
+        expired: cached RIDs older than the ttl, checked against OrientDB
+        negatives: lookups answered as not existing by the bloom filter
+        misses: lookups that went to OrientDB
+    """
+
+    def __init__(self, max_size=HASHKEY_CACHE_SIZE, bloom_capacity=HASHKEY_BLOOM_CAPACITY, use_bloom=True,
+                 ttl=HASHKEY_CACHE_TTL):
+        self.max_size = max_size
+        self.bloom_capacity = bloom_capacity
+        self.use_bloom = use_bloom
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.classes = {}
+        self.blooms = {}
+        self.warmed = set()
+        self.stats = {"hits": 0, "expired": 0, "negatives": 0, "misses": 0, "inserts": 0}
+
+    def _lru(self, class_name):
+        if class_name not in self.classes:
+            self.classes[class_name] = LRUCache(self.max_size)
+            if self.use_bloom:
+                self.blooms[class_name] = BloomFilter(self.bloom_capacity)
+        return self.classes[class_name]
+
+    def get(self, class_name, hashkey):
+        """
+        Return the RID for the hashkey if it was cached within the ttl, counting the hit
+        :param class_name:
+        :param hashkey:
+        :return: str(rid) or None
+        """
+        with self.lock:
+            entry = self._lru(class_name).get(hashkey)
+            if not entry:
+                return None
+            if time.time() - entry[1] >= self.ttl:
+                self.stats["expired"] += 1
+                return None
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def known_absent(self, class_name, hashkey):
+        """
+        True only when the class has been warmed and its bloom filter has never seen the hashkey. Otherwise the caller
+        must check OrientDB, which is counted as a miss.
+        :param class_name:
+        :param hashkey:
+        :return:
+        """
+        with self.lock:
+            if class_name in self.warmed and class_name in self.blooms \
+                    and not self.blooms[class_name].might_contain(hashkey):
+                self.stats["negatives"] += 1
+                return True
+            self.stats["misses"] += 1
+            return False
+
+    def add(self, class_name, hashkey, rid):
+        """
+        Record a hashkey to RID pair. Merged nodes carry several hashkeys separated by commas and each is added.
+        :param class_name:
+        :param hashkey:
+        :param rid:
+        :return:
+        """
+        if not hashkey or not rid:
+            return
+        rid = str(rid)
+        if rid[0] != "#":
+            rid = "#%s" % rid
+        now = time.time()
+        with self.lock:
+            lru = self._lru(class_name)
+            for h in str(hashkey).split(","):
+                if h:
+                    lru.put(h, (rid, now))
+                    if class_name in self.blooms:
+                        self.blooms[class_name].add(h)
+            self.stats["inserts"] += 1
+
+    def discard(self, class_name, hashkey):
+        """
+        Forget a hashkey, for example when its node was deleted. The bloom filter cannot remove keys so a discarded
+        hashkey will be checked against OrientDB from then on.
+        :param class_name:
+        :param hashkey:
+        :return:
+        """
+        with self.lock:
+            lru = self._lru(class_name)
+            for h in str(hashkey).split(","):
+                lru.pop(h)
+
+    def clear(self):
+        # For a database that was created again, so every class has to be warmed again
+        with self.lock:
+            self.classes = {}
+            self.blooms = {}
+            self.warmed = set()
+
+    def warm(self, class_name, pairs):
+        """
+        Fill a class from an iterable of (hashkey, rid) pairs read from the full hashkey index. Only after a class is
+        warmed can the bloom filter be trusted for negative lookups.
+        :param class_name:
+        :param pairs:
+        :return: number of pairs loaded
+        """
+        i = 0
+        for hashkey, rid in pairs:
+            self.add(class_name, hashkey, rid)
+            i += 1
+        with self.lock:
+            self.stats["inserts"] -= i
+            self.warmed.add(class_name)
+        return i
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = sum(len(self.classes[c]) for c in self.classes)
+            stats["warmed"] = sorted(self.warmed)
+        lookups = stats["hits"] + stats["negatives"] + stats["misses"]
+        stats["saved_ratio"] = (stats["hits"] + stats["negatives"]) / lookups if lookups else 0.0
+        return stats
+
+
+class CaseCache:
+    """
+    Case graphs assembled by ODB.load_graph. An entry is only used while the version read from the case record, which
+    changes when the case is saved by any worker, is the one it was stored with and it is younger than the ttl. save
+    also invalidates the entry of the case in its own worker. Graphs are copied in and out so callers can change them.
+    """
+
+    def __init__(self, max_size=CASE_CACHE_SIZE, ttl=CASE_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cases = LRUCache(max_size)
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    @staticmethod
+    def key(case_key):
+        # The same case is sent as #12:1 or 12:1
+        return str(case_key).lstrip("#")
+
+    def get(self, case_key, version):
+        with self.lock:
+            entry = self.cases.get(self.key(case_key))
+            if entry and version is not None and entry[0] == version and time.time() - entry[1] < self.ttl:
+                self.stats["hits"] += 1
+                return copy.deepcopy(entry[2])
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, case_key, version, graph):
+        if version is None:
+            return
+        with self.lock:
+            self.cases.put(self.key(case_key), (version, time.time(), copy.deepcopy(graph)))
+
+    def invalidate(self, case_key):
+        with self.lock:
+            if self.cases.pop(self.key(case_key)):
+                self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.cases)
+        return stats
+
+
+class ResultCache:
+    """
+    Responses of read endpoints keyed by the endpoint and the normalized query. Each entry records the write generation
+    of the classes it was built from. Writes through any client of the database in this worker move the generation of
+    the classes they touch on, so an entry is only used while none of its classes has been written to since and it is
+    younger than the ttl. Stale entries are not searched for, they fail the check and are replaced or aged out of the
+    LRU.
+        cache.put("get_neighbors", "12:1", response, ["E", "Person"])
+        cache.invalidate("Person")
+        cache.get("get_neighbors", "12:1")  # None
+    """
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = LRUCache(max_size)
+        self.generations = {}
+        self.stats = {"invalidations": 0, "endpoints": {}}
+
+    def _count(self, endpoint, outcome):
+        if endpoint not in self.stats["endpoints"]:
+            self.stats["endpoints"][endpoint] = {"hits": 0, "misses": 0}
+        self.stats["endpoints"][endpoint][outcome] += 1
+
+    def get(self, endpoint, key):
+        """
+        Return a copy of the cached response if it is still valid, counting the hit or miss for the endpoint
+        :param endpoint:
+        :param key: hashable normalized query
+        :return: response or None
+        """
+        with self.lock:
+            entry = self.results.get((endpoint, key))
+            if entry and time.time() - entry[1] < self.ttl and all(
+                    self.generations.get(c, 0) == g for c, g in entry[0].items()):
+                self._count(endpoint, "hits")
+                return copy.deepcopy(entry[2])
+            self._count(endpoint, "misses")
+            return None
+
+    def put(self, endpoint, key, response, class_names):
+        """
+        Keep a response along with the current generation of the classes it was built from
+        :param endpoint:
+        :param key:
+        :param response:
+        :param class_names: iterable of the vertex and edge classes the response depends on
+        :return:
+        """
+        with self.lock:
+            generations = {c: self.generations.get(c, 0) for c in set(class_names)}
+            self.results.put((endpoint, key), (generations, time.time(), copy.deepcopy(response)))
+
+    def invalidate(self, *class_names):
+        """
+        Mark the responses built from any of the classes as stale
+        :param class_names:
+        :return:
+        """
+        with self.lock:
+            for c in set(class_names):
+                if c:
+                    self.generations[c] = self.generations.get(c, 0) + 1
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        # For writes where the classes touched are not known
+        with self.lock:
+            self.results.clear()
+            self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = {"invalidations": self.stats["invalidations"], "size": len(self.results), "endpoints": {}}
+            for endpoint, counts in self.stats["endpoints"].items():
+                lookups = counts["hits"] + counts["misses"]
+                stats["endpoints"][endpoint] = dict(counts, hit_ratio=counts["hits"] / lookups if lookups else 0.0)
+        return stats
+
+
+# One cache per database so the ODB, OSINT and Shodan clients of a worker agree on what exists
+hashkey_caches = {}
+hashkey_caches_lock = threading.Lock()
+
+
+def get_hashkey_cache(db_name):
+    with hashkey_caches_lock:
+        if db_name not in hashkey_caches:
+            hashkey_caches[db_name] = HashkeyCache()
+        return hashkey_caches[db_name]
+
+
+case_caches = {}
+case_caches_lock = threading.Lock()
+
+
+def get_case_cache(db_name):
+    with case_caches_lock:
+        if db_name not in case_caches:
+            case_caches[db_name] = CaseCache()
+        return case_caches[db_name]
+
+
+result_caches = {}
+result_caches_lock = threading.Lock()
+
+
+def get_result_cache(db_name):
+    with result_caches_lock:
+        if db_name not in result_caches:
+            result_caches[db_name] = ResultCache()
+        return result_caches[db_name]
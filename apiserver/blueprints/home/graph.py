@@ -0,0 +1,99 @@
+"""
+Graph results built up by the ETL and graph functions. The result is the usual {"nodes": [], "lines": []} dictionary so
+it can be returned by the views as is, but the node keys and line keys are also indexed in hashed structures so that
+checking whether a node or relationship is already in the graph does not scan the lists.
+"""
+
+
+class GraphAccumulator(dict):
+    """
+    Dictionary with "nodes" and "lines" lists and, kept as attributes so they are not serialized:
+        node_index: node key to the position of the node in "nodes"
+        line_index: set of (from, to, description) for the lines in the graph
+    When a limit is given only the first limit nodes and lines are kept in the lists while the indexes keep counting
+    every distinct node and line, which is used to return a sample of very large imports.
+        graph = GraphAccumulator()
+        graph.add_node({"key": "#12:1", ...})
+        graph.add_line("#12:1", "#12:2", "Related")
+    """
+
+    def __init__(self, graph=None, limit=None):
+        super().__init__(nodes=[], lines=[])
+        self.node_index = {}
+        self.line_index = set()
+        self.limit = limit
+        self.truncated = False
+        if graph:
+            for k in graph:
+                if k not in ["nodes", "lines"]:
+                    self[k] = graph[k]
+            for n in graph.get("nodes", []):
+                self.add_node(n)
+            for l in graph.get("lines", []):
+                self.add_line(line=l)
+
+    @staticmethod
+    def line_key(fromNode, toNode, description=None):
+        return str(fromNode), str(toNode), description
+
+    def has_node(self, key):
+        return key in self.node_index
+
+    def get_node(self, key):
+        """
+        Return the node with the key if it is held in the graph
+        :param key:
+        :return:
+        """
+        i = self.node_index.get(key)
+        if i is None:
+            return None
+        return self["nodes"][i]
+
+    def add_node(self, node):
+        """
+        Add the node if its key is not in the graph yet
+        :param node: dict with at least a key
+        :return: True if the node was new
+        """
+        if node["key"] in self.node_index:
+            return False
+        if self.limit is None or len(self["nodes"]) < self.limit:
+            self.node_index[node["key"]] = len(self["nodes"])
+            self["nodes"].append(node)
+        else:
+            self.node_index[node["key"]] = None
+            self.truncated = True
+        return True
+
+    def has_line(self, fromNode, toNode, description=None):
+        return self.line_key(fromNode, toNode, description) in self.line_index
+
+    def add_line(self, fromNode=None, toNode=None, description=None, line=None):
+        """
+        Add a line if the same (from, to, description) is not in the graph yet. Either the parts of the line or a line
+        dictionary, which can carry other attributes, are accepted. Lines using title instead of description are keyed
+        on the title.
+        :param fromNode:
+        :param toNode:
+        :param description:
+        :param line:
+        :return: True if the line was new
+        """
+        if line is None:
+            line = {"to": toNode, "from": fromNode, "description": description}
+        key = self.line_key(line["from"], line["to"], line.get("description", line.get("title")))
+        if key in self.line_index:
+            return False
+        self.line_index.add(key)
+        if self.limit is None or len(self["lines"]) < self.limit:
+            self["lines"].append(line)
+        else:
+            self.truncated = True
+        return True
+
+    def node_count(self):
+        return len(self.node_index)
+
+    def line_count(self):
+        return len(self.line_index)
@@ -0,0 +1,351 @@
+"""
+Background jobs for long running ingestion and monitoring tasks. Jobs run on a bounded pool of threads within each
+worker and their state is written to a small JSON file per job so that any gunicorn worker can report the status of,
+or cancel, a job started by another. Jobs of the same type are single flight across workers: a lock file per job type
+is held while a job of that type is queued or running and a second submission returns the job already in progress.
+A job whose state file says it is active but whose worker has exited, having released the lock, is marked abandoned
+when it is loaded.
+"""
+import os
+import json
+import time
+import uuid
+import click
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from apiserver.utils import get_datetime, JOB_WORKERS
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ACTIVE = ["queued", "running"]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Handle passed to the target of a job as its job keyword. The target reports progress with update() and checks
+    cancelled() (or uses wait() instead of time.sleep) so that it stops at a safe point when the job is cancelled.
+        def graph_cve(self, df, job=None):
+            ...
+            job.update(progress=i / total, message="%d Vuls" % new_nodes)
+            if job.cancelled():
+                break
+    """
+
+    def __init__(self, queue, job_type, description=""):
+        self.queue = queue
+        self.id = "%s_%s" % (job_type, uuid.uuid4().hex[:12])
+        self.job_type = job_type
+        self.description = description
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = ""
+        self.submitted = get_datetime()
+        self.started = self.ended = None
+        self.result = self.error = None
+        self.pid = os.getpid()
+        self.single_flight = False
+        self.lock_file = None
+        self.cancel_event = threading.Event()
+        self.last_write = 0
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "type": self.job_type,
+            "description": self.description,
+            "status": self.status,
+            "progress": round(self.progress, 4),
+            "message": self.message,
+            "submitted": self.submitted,
+            "started": self.started,
+            "ended": self.ended,
+            "error": self.error,
+            "result": self.result if type(self.result) in [str, int, float, dict, list] else str(self.result),
+            "pid": self.pid,
+            "single_flight": self.single_flight
+        }
+
+    def update(self, progress=None, message=None):
+        """
+        Record progress between 0 and 1 and a message. The state file is rewritten at most once a second.
+        :param progress:
+        :param message:
+        :return:
+        """
+        if progress is not None:
+            self.progress = max(0.0, min(1.0, progress))
+        if message is not None:
+            self.message = message
+        if time.time() - self.last_write >= 1:
+            self.queue.save(self)
+
+    def cancelled(self):
+        if not self.cancel_event.is_set() and os.path.exists(self.queue.cancel_path(self.id)):
+            self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+    def wait(self, seconds):
+        """
+        Sleep for seconds unless the job is cancelled in the meantime
+        :param seconds:
+        :return: True if the job was cancelled
+        """
+        end = time.time() + seconds
+        while not self.cancelled():
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            self.cancel_event.wait(min(remaining, 5))
+        return True
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads running Jobs
+        jobs = get_job_queue(path)
+        job = jobs.submit("cve", self.import_cve, description="MITRE CVE import")
+        jobs.get(job["id"])
+        jobs.cancel(job["id"])
+    """
+
+    def __init__(self, path, max_workers=JOB_WORKERS):
+        self.path = path
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = {}
+        self.active = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+    def job_path(self, job_id):
+        return os.path.join(self.path, "%s.json" % job_id)
+
+    def cancel_path(self, job_id):
+        return os.path.join(self.path, "%s.cancel" % job_id)
+
+    def lock_path(self, job_type):
+        return os.path.join(self.path, "%s.lock" % job_type)
+
+    def write(self, job):
+        tmp = "%s.%d.tmp" % (self.job_path(job["id"]), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, self.job_path(job["id"]))
+
+    def save(self, job):
+        job.last_write = time.time()
+        self.write(job.to_dict())
+
+    def load(self, job_id):
+        try:
+            with open(self.job_path(job_id)) as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job["status"] in ACTIVE and not self.alive(job):
+            job["error"] = "Worker %s exited while the job was %s" % (job.get("pid"), job["status"])
+            job["status"] = "abandoned"
+            job["ended"] = get_datetime()
+            self.write(job)
+            if os.path.exists(self.cancel_path(job_id)):
+                os.remove(self.cancel_path(job_id))
+            click.echo('[%s_jobs_load] %s abandoned by worker %s' % (get_datetime(), job_id, job.get("pid")))
+        return job
+
+    def holder(self, job_type):
+        """
+        The id of the job holding the single flight lock of a type, read from the lock file
+        :param job_type:
+        :return: the job id or None if the lock is free
+        """
+        try:
+            lock_file = open(self.lock_path(job_type), 'a+')
+        except OSError:
+            return None
+        with lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.seek(0)
+                return lock_file.read().strip() or None
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            return None
+
+    def alive(self, job):
+        """
+        Whether the worker that saved an active job still runs it. A single flight job is alive while it holds the lock
+        of its type, since the lock is released when its worker exits, and any other job while its worker process is.
+        :param job: dict of the job as saved
+        :return:
+        """
+        if job["id"] in self.jobs:
+            return True
+        if job.get("pid") == os.getpid():
+            return False
+        if fcntl and job.get("single_flight"):
+            return self.holder(job["type"]) == job["id"]
+        try:
+            os.kill(job["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except (OSError, KeyError, TypeError):
+            pass
+        return True
+
+    def acquire(self, job_type):
+        """
+        Take the single flight lock for a job type, shared by every worker through a lock file
+        :param job_type:
+        :return: the open lock file or None if another job of the type holds it
+        """
+        if not fcntl:
+            return True
+        lock_file = open(self.lock_path(job_type), 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        lock_file.seek(0)
+        lock_file.truncate()
+        return lock_file
+
+    @staticmethod
+    def release(lock_file):
+        if lock_file and lock_file is not True:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def current(self, job_type):
+        """
+        Return the active job of a type, whether it runs in this worker or another
+        :param job_type:
+        :return:
+        """
+        if job_type in self.active:
+            return self.active[job_type].to_dict()
+        for j in self.list(job_type=job_type):
+            if j["status"] in ACTIVE:
+                return j
+        return None
+
+    def submit(self, job_type, target, description="", single_flight=True, **kwargs):
+        """
+        Queue target(job=Job, **kwargs) on the pool. With single_flight a job of the same type already queued or
+        running in any worker is returned instead of starting another.
+        :param job_type:
+        :param target:
+        :param description:
+        :param single_flight:
+        :param kwargs: passed to the target
+        :return: dict of the job with "existing" True if it was already running
+        """
+        with self.lock:
+            lock_file = None
+            if single_flight:
+                lock_file = self.acquire(job_type)
+                if not lock_file:
+                    existing = self.current(job_type) or {"type": job_type, "status": "running"}
+                    existing["existing"] = True
+                    return existing
+            job = Job(self, job_type, description)
+            job.single_flight = single_flight
+            job.lock_file = lock_file
+            if lock_file and lock_file is not True:
+                # The holder of the lock, so that a job left active by an exited worker can be told from this one
+                lock_file.write(job.id)
+                lock_file.flush()
+            self.jobs[job.id] = job
+            if single_flight:
+                self.active[job_type] = job
+            self.save(job)
+        click.echo('[%s_jobs_submit] Queued %s %s' % (get_datetime(), job.id, description))
+        self.executor.submit(self.run, job, target, kwargs)
+        result = job.to_dict()
+        result["existing"] = False
+        return result
+
+    def run(self, job, target, kwargs):
+        try:
+            if job.cancelled():
+                raise JobCancelled()
+            job.status = "running"
+            job.started = get_datetime()
+            self.save(job)
+            job.result = target(job=job, **kwargs)
+            job.status = "cancelled" if job.cancelled() else "completed"
+            if job.status == "completed":
+                job.progress = 1.0
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            click.echo('[%s_jobs_run] %s failed: %s' % (get_datetime(), job.id, str(e)))
+        finally:
+            job.ended = get_datetime()
+            self.save(job)
+            with self.lock:
+                if self.active.get(job.job_type) is job:
+                    self.active.pop(job.job_type)
+                self.release(job.lock_file)
+                job.lock_file = None
+            if os.path.exists(self.cancel_path(job.id)):
+                os.remove(self.cancel_path(job.id))
+            click.echo('[%s_jobs_run] %s %s' % (get_datetime(), job.id, job.status))
+
+    def get(self, job_id):
+        if job_id in self.jobs:
+            return self.jobs[job_id].to_dict()
+        return self.load(job_id)
+
+    def list(self, job_type=None, status=None):
+        """
+        All jobs known to the state directory, most recent first
+        :param job_type:
+        :param status:
+        :return:
+        """
+        jobs = []
+        for f in os.listdir(self.path):
+            if f[-5:] == ".json":
+                j = self.load(f[:-5])
+                if j and (not job_type or j["type"] == job_type) and (not status or j["status"] == status):
+                    jobs.append(j)
+        return sorted(jobs, key=lambda j: j["submitted"], reverse=True)
+
+    def cancel(self, job_id):
+        """
+        Ask a job to stop. The flag is a file so the worker running the job sees it at its next check.
+        :param job_id:
+        :return: dict of the job or None if it is not known
+        """
+        job = self.get(job_id)
+        if not job:
+            return None
+        if job["status"] in ACTIVE:
+            open(self.cancel_path(job_id), 'w').close()
+            if job_id in self.jobs:
+                self.jobs[job_id].cancel_event.set()
+            job["cancel_requested"] = True
+        return job
+
+
+# One queue per state directory and worker. The pool is recreated if a forked worker inherits the parent's queue
+job_queues = {}
+job_queues_lock = threading.Lock()
+
+
+def get_job_queue(path):
+    with job_queues_lock:
+        key = (path, os.getpid())
+        if key not in job_queues:
+            job_queues[key] = JobQueue(path)
+        return job_queues[key]
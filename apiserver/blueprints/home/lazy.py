@@ -0,0 +1,148 @@
+"""
+Lazy start up of the blueprint database clients. The views create a LazyServer in place of their client so importing a
+blueprint, and so booting a gunicorn worker, does no database work. The client is built and its database opened on the
+first use, and slower preparation such as filling indexes and warming caches then runs in a background thread while
+requests are served. The state of every LazyServer is reported by the /health route.
+"""
+import time
+import click
+import threading
+from apiserver.utils import get_datetime
+
+# Seconds before a server whose database could not be reached is tried again
+RETRY_INTERVAL = 10
+
+
+class LazyServer:
+    """
+    Stands in for a blueprint client such as ODB() and forwards attribute access to it once it is ready
+        odbserver = LazyServer("home", ODB, setup=lambda s: s.open_db(), background=lambda s: s.warm_hashkey_cache())
+        odbserver.get_db_stats()  # Builds ODB() and opens the database on the first call
+    setup returns what open_db does: False when the database is open, a message when it has to be created through
+    db_init and True when OrientDB could not be reached. Attributes are kept with an underscore so they don't hide
+    those of the client.
+    """
+
+    def __init__(self, name, factory, setup=None, background=None):
+        self._name = name
+        self._factory = factory
+        self._setup = setup
+        self._background = background
+        self._lock = threading.Lock()
+        self._server = None
+        self._state = "idle"
+        self._background_state = "idle"
+        self._init_required = None
+        self._error = None
+        self._last_attempt = 0
+        self._ready_seconds = None
+        lazy_servers.append(self)
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def _get(self):
+        if self._state not in ["ready", "setup_required"] or self._server is None:
+            with self._lock:
+                if self._state not in ["ready", "setup_required"] or self._server is None:
+                    self._initialize()
+        return self._server
+
+    def _initialize(self):
+        """
+        Build the client and open its database, starting the background preparation once the database is open. Called
+        with the lock held.
+        :return:
+        """
+        if self._state == "unavailable" and self._server and time.time() - self._last_attempt < RETRY_INTERVAL:
+            return
+        self._last_attempt = time.time()
+        self._state = "initializing"
+        try:
+            if self._server is None:
+                self._server = self._factory()
+            self._init_required = self._setup(self._server) if self._setup else False
+        except Exception as e:
+            self._state = "error"
+            self._error = str(e)
+            click.echo('[%s_%s_lazy_init] Failed: %s' % (get_datetime(), self._name, str(e)))
+            raise
+        if self._init_required is True:
+            self._state = "unavailable"
+            self._error = "Database could not be reached"
+        elif self._init_required:
+            self._state = "setup_required"
+            self._error = None
+            click.echo("[%s_%s_init] Setup required" % (get_datetime(), self._name))
+        else:
+            self._state = "ready"
+            self._error = None
+            self._ready_seconds = round(time.time() - self._last_attempt, 3)
+            click.echo('[%s_%s_lazy_init] Ready in %.3f seconds' % (get_datetime(), self._name, self._ready_seconds))
+            if self._background and self._background_state == "idle":
+                self._background_state = "running"
+                threading.Thread(target=self._run_background, daemon=True).start()
+
+    def _run_background(self):
+        try:
+            self._background(self._server)
+            self._background_state = "complete"
+        except Exception as e:
+            self._background_state = "failed: %s" % str(e)
+            click.echo('[%s_%s_lazy_background] Failed: %s' % (get_datetime(), self._name, str(e)))
+
+    def _reset(self):
+        """
+        Run the setup, and the background preparation unless it is still running, again on the next use, for example
+        after db_init created the database
+        :return:
+        """
+        with self._lock:
+            if self._state != "initializing":
+                self._state = "idle"
+            if self._background_state != "running":
+                self._background_state = "idle"
+
+    def _start(self):
+        """
+        Initialize in a thread if it has not started yet so a health check never waits on the database
+        :return:
+        """
+        if self._state in ["idle", "unavailable", "error"]:
+            threading.Thread(target=self._try_get, daemon=True).start()
+
+    def _try_get(self):
+        try:
+            self._get()
+        except Exception:
+            pass
+
+    def _health(self):
+        return {
+            "name": self._name,
+            "state": self._state,
+            "background": self._background_state,
+            "init_required": self._init_required if type(self._init_required) == str else None,
+            "error": self._error,
+            "ready_seconds": self._ready_seconds
+        }
+
+
+lazy_servers = []
+
+
+def get_health(start=True):
+    """
+    Report the state of every LazyServer. Servers are ready once their database is open, their background preparation
+    may still be running. With start, servers that have not been used yet begin initializing in the background.
+    :param start:
+    :return:
+    """
+    if start:
+        for s in lazy_servers:
+            s._start()
+    servers = [s._health() for s in lazy_servers]
+    return {
+        "ready": all([s["state"] == "ready" for s in servers]),
+        "servers": servers
+    }
@@ -13,18 +13,350 @@ import os
 import time
 import operator
 import copy
-import hashlib
+import threading
+import itertools
+import re
+import base64
+from collections import deque
+from contextlib import contextmanager
+from pyorient.exceptions import PyOrientConnectionException
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 from apiserver.models import Edges as EdgeModel, nodeKeys, POLEModel
-from apiserver.utils import get_datetime, HOST_IP, change_if_number, clean, clean_concat, date_to_standard_string, \
-    ODB_USER, ODB_PSWD
+from apiserver.blueprints.home.cache import get_hashkey_cache, get_case_cache, get_result_cache
+from apiserver.blueprints.home.graph import GraphAccumulator
+from apiserver.blueprints.home.suggest import get_suggestion_index
+from apiserver.hashing import hash_attributes, hash_frame, hash_values, normalize_key
+from apiserver.utils import get_datetime, HOST_IP, change_if_number, clean, date_to_standard_string, \
+    ODB_USER, ODB_PSWD, ODB_PORT, ODB_POOL_SIZE, ODB_POOL_TIMEOUT, ODB_POOL_IDLE, ODB_POOL_HEALTH, EDGE_BATCH_SIZE, \
+    ETL_CHUNK_SIZE, ETL_GRAPH_LIMIT, change_if_date_column, NEIGHBOR_FANOUT, NEIGHBOR_LIMIT, NEIGHBOR_MAX_DEPTH, \
+    NEIGHBOR_SAMPLE_POOL, SUGGEST_WARM_LIMIT, MERGE_GROUP_CHUNK, HASHKEY_WARM_BATCH
 
 OSINT = "OSINT"
+RID = re.compile(r"^#?-?\d+:\d+$")
+CLASS_NAME = re.compile(r"^\w+$")
+# Client operations that act on the server rather than an opened database and so use a connect() session
+SERVER_OPERATIONS = ["db_create", "db_drop", "db_exists", "db_list", "db_reload"]
+
+
+class ODBPool:
+    """
+    Thread safe pool of pyorient clients shared by every blueprint client and background thread within a worker.
+    The pyorient binary protocol allows only one request in flight per socket so each command checks out a client,
+    runs and checks it back in. Clients are kept per database so an opened session is reused rather than running
+    connect and db_open for every request. A server level client (db_name None) is used for db_exists/db_create.
+        max_size: Total clients that can be checked out at once. Further checkouts wait up to timeout seconds
+        idle_timeout: Seconds a client can sit unused in the pool before it is closed
+        health_interval: Seconds after which a client is checked with a light request before being handed out
+    """
+
+    def __init__(self, host=HOST_IP, port=ODB_PORT, user=ODB_USER, pswd=ODB_PSWD, max_size=ODB_POOL_SIZE,
+                 timeout=ODB_POOL_TIMEOUT, idle_timeout=ODB_POOL_IDLE, health_interval=ODB_POOL_HEALTH):
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.pswd = pswd
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.pid = os.getpid()
+        # {db_name: deque([(client, last_used)])} with the most recently used client on the right
+        self.idle = {}
+        self.stats = {"created": 0, "reused": 0, "evicted": 0, "discarded": 0, "waits": 0, "in_use": 0}
+
+    def _check_fork(self):
+        """
+        Sockets cannot be shared between processes. If the pool was created before gunicorn forked the worker, drop
+        the inherited clients without closing them (the parent still owns the sockets) and start again.
+        :return:
+        """
+        if os.getpid() != self.pid:
+            with self.lock:
+                if os.getpid() != self.pid:
+                    self.pid = os.getpid()
+                    self.idle = {}
+                    self.slots = threading.BoundedSemaphore(self.max_size)
+                    self.stats["in_use"] = 0
+
+    def _connect(self, db_name):
+        """
+        Create a new client. Server level clients only connect while database clients also open the database
+        :param db_name:
+        :return:
+        """
+        client = pyorient.OrientDB(self.host, self.port)
+        if db_name:
+            client.db_open(db_name, self.user, self.pswd)
+        else:
+            client.connect(self.user, self.pswd)
+        with self.lock:
+            self.stats["created"] += 1
+        return client
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def _healthy(self, client, db_name):
+        """
+        Run the lightest request available for the session type to confirm the socket is still usable
+        :param client:
+        :param db_name:
+        :return:
+        """
+        try:
+            if db_name:
+                client.db_size()
+            else:
+                client.db_list()
+            return True
+        except Exception:
+            return False
+
+    def evict_idle(self):
+        """
+        Close clients that have not been used within the idle_timeout
+        :return:
+        """
+        now = time.time()
+        stale = []
+        with self.lock:
+            for db_name in self.idle:
+                clients = self.idle[db_name]
+                # The oldest clients are on the left
+                while clients and now - clients[0][1] > self.idle_timeout:
+                    stale.append(clients.popleft()[0])
+            self.stats["evicted"] += len(stale)
+        for client in stale:
+            self._close(client)
+        return len(stale)
+
+    def checkout(self, db_name=None):
+        """
+        Get a client for the database, reusing an idle opened session when one is available
+        :param db_name: None for a server level client
+        :return: pyorient.OrientDB
+        """
+        self._check_fork()
+        self.evict_idle()
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats["waits"] += 1
+            if not self.slots.acquire(timeout=self.timeout):
+                raise PyOrientConnectionException(
+                    "No OrientDB client available for %s after %d seconds" % (db_name, self.timeout), [])
+        try:
+            while True:
+                with self.lock:
+                    clients = self.idle.get(db_name)
+                    item = clients.pop() if clients else None
+                if not item:
+                    client = self._connect(db_name)
+                    break
+                client, last_used = item
+                if time.time() - last_used < self.health_interval or self._healthy(client, db_name):
+                    with self.lock:
+                        self.stats["reused"] += 1
+                    break
+                self._close(client)
+                with self.lock:
+                    self.stats["discarded"] += 1
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.stats["in_use"] += 1
+        return client
+
+    def checkin(self, client, db_name=None, healthy=True):
+        """
+        Return a client to the pool. Clients that failed with a connection error are closed instead
+        :param client:
+        :param db_name:
+        :param healthy:
+        :return:
+        """
+        with self.lock:
+            self.stats["in_use"] -= 1
+            if healthy:
+                self.idle.setdefault(db_name, deque()).append((client, time.time()))
+            else:
+                self.stats["discarded"] += 1
+        if not healthy:
+            self._close(client)
+        self.slots.release()
+
+    @contextmanager
+    def connection(self, db_name=None):
+        client = self.checkout(db_name)
+        healthy = True
+        try:
+            yield client
+        except (PyOrientConnectionException, OSError):
+            healthy = False
+            raise
+        finally:
+            self.checkin(client, db_name, healthy)
+
+    def close(self):
+        with self.lock:
+            clients = [c for db_name in self.idle for c, last_used in self.idle[db_name]]
+            self.idle = {}
+        for client in clients:
+            self._close(client)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = sum(len(self.idle[db_name]) for db_name in self.idle)
+        stats["max_size"] = self.max_size
+        return stats
+
+
+class PooledClient:
+    """
+    Stands in for the single pyorient.OrientDB client previously held by each ODB so that existing call sites such as
+    self.client.command(sql) and self.client.batch(sql) run on a client checked out of the pool for that call only.
+    """
+
+    def __init__(self, pool, db_name):
+        self.pool = pool
+        self.db_name = db_name
+
+    def __getattr__(self, name):
+        db_name = None if name in SERVER_OPERATIONS else self.db_name
+
+        def call(*args, **kwargs):
+            with self.pool.connection(db_name) as client:
+                return getattr(client, name)(*args, **kwargs)
+
+        return call
+
+
+# One pool per server and user so that the ODB, OSINT, Shodan and userDB clients of a worker share sessions
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(host=HOST_IP, port=ODB_PORT, user=ODB_USER, pswd=ODB_PSWD):
+    with pools_lock:
+        if (host, port, user) not in pools:
+            pools[(host, port, user)] = ODBPool(host=host, port=port, user=user, pswd=pswd)
+        return pools[(host, port, user)]
+
+
+class EdgeBuffer:
+    """
+    Collects (edgeType, fromNode, toNode) triples for the imports that would otherwise call create_edge_new once per
+    relationship. Triples are deduplicated in memory and written batch_size at a time as a single transactional
+    OrientDB script. The edge classes have a UNIQUE out_in index so a batch that includes an existing edge is rejected
+    as a whole. The batch is then split in halves until the offending edges are isolated, which keeps the cost of the
+    few duplicates in an import logarithmic, and the duplicates are reported in aggregate by close() instead of one
+    message per edge.
+        with odbserver.edge_buffer() as edges:
+            edges.add(edgeType="Tweeted", fromNode=user_key, toNode=tweet_key)
+    """
+
+    def __init__(self, db, batch_size=EDGE_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.pending = []
+        self.seen = set()
+        self.stats = {"queued": 0, "deduplicated": 0, "created": 0, "duplicates": 0, "errors": 0, "batches": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, edgeType="Related", fromNode=None, toNode=None):
+        """
+        Queue an edge using the same arguments as create_edge_new
+        :param edgeType:
+        :param fromNode:
+        :param toNode:
+        :return:
+        """
+        if not fromNode or not toNode:
+            click.echo('[%s_%s_create_edge] Did not receive expected arguments' % (get_datetime(), self.db.db_name))
+            return
+        edge = (edgeType, str(fromNode), str(toNode))
+        if edge in self.seen:
+            self.stats["deduplicated"] += 1
+            return
+        self.seen.add(edge)
+        self.pending.append(edge)
+        self.stats["queued"] += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        edges = self.pending
+        self.pending = []
+        if edges:
+            self.write(edges)
+        return self.stats
+
+    def write(self, edges):
+        """
+        Send the edges as one script, splitting the batch when it is rejected
+        :param edges:
+        :return:
+        """
+        self.stats["batches"] += 1
+        script = "begin;\n"
+        for edgeType, fromNode, toNode in edges:
+            script += "create edge %s from %s to %s;\n" % (edgeType, fromNode, toNode)
+        script += "commit retry 10;"
+        try:
+            self.db.client.batch(script)
+            self.stats["created"] += len(edges)
+            self.db.result_cache.invalidate("E", *set([e[0] for e in edges]))
+        except Exception as e:
+            if len(edges) > 1:
+                self.write(edges[:len(edges) // 2])
+                self.write(edges[len(edges) // 2:])
+            elif type(e).__name__ == "PyOrientORecordDuplicatedException" or "out_in" in str(e):
+                self.stats["duplicates"] += 1
+            else:
+                self.stats["errors"] += 1
+                click.echo('[%s_%s_create_edge] Error creating edge: %s \n%s' % (
+                    get_datetime(), self.db.db_name, str(e), script))
+
+    def close(self):
+        """
+        Flush the remaining edges and report the totals for the import
+        :return:
+        """
+        self.flush()
+        if self.stats["queued"] or self.stats["deduplicated"]:
+            click.echo('[%s_%s_create_edges] Created %d edges in %d batches. %d repeated edges skipped, %d already '
+                       'existed (out_in index), %d errors' % (
+                           get_datetime(), self.db.db_name, self.stats["created"], self.stats["batches"],
+                           self.stats["deduplicated"], self.stats["duplicates"], self.stats["errors"]))
+        return self.stats
+
 
 class ODB:
 
     def __init__(self, db_name="GratefulDeadConcerts", models=POLEModel):
 
-        self.client = pyorient.OrientDB(HOST_IP, 2424)
+        self.pool = get_pool()
+        self.client = PooledClient(self.pool, db_name)
+        self.hashkey_cache = get_hashkey_cache(db_name)
+        self.case_cache = get_case_cache(db_name)
+        self.suggestions = get_suggestion_index(db_name)
+        self.result_cache = get_result_cache(db_name)
         self.user = ODB_USER
         self.pswd = ODB_PSWD
         self.db_name = db_name
@@ -87,6 +419,71 @@ class ODB:
                     "message": "No file loaded to the directory with name %s. Try uploading again." % (filename)
                 }
 
+    def file_to_chunks(self, filename, chunksize=ETL_CHUNK_SIZE):
+        """
+        Streaming version of file_to_frame. Instead of the whole file, data is an iterator of DataFrames of at most
+        chunksize rows which keep the row index of the file. CSV is read with the pandas chunked reader and XLSX is read
+        row by row from a read only workbook so only one chunk is held in memory at a time.
+        :param filename:
+        :param chunksize:
+        :return:
+        """
+        path = os.path.join(self.datapath, filename)
+        try:
+            if filename[-4:] == "xlsx":
+                return {"data": self.xlsx_chunks(path, chunksize)}
+            elif filename[-3:] == "csv":
+                return {"data": pd.read_csv(path, chunksize=chunksize)}
+            else:
+                return {
+                    "data": None,
+                    "headers": None,
+                    "ftype": "Unknown",
+                    "message": "Rejected %s." % (filename)
+                }
+        except Exception as e:
+            if "No such file or directory" in str(e):
+                return {
+                    "data": None,
+                    "headers": None,
+                    "ftype": "Unknown",
+                    "message": "No file loaded to the directory with name %s. Try uploading again." % (filename)
+                }
+            raise
+
+    @staticmethod
+    def xlsx_chunks(path, chunksize=ETL_CHUNK_SIZE):
+        """
+        Yield the first sheet of a workbook as DataFrames of chunksize rows using the first row as headers. Falls back
+        to reading the whole sheet when openpyxl is not installed.
+        :param path:
+        :param chunksize:
+        :return:
+        """
+        if not openpyxl:
+            data = pd.read_excel(path)
+            for start in range(0, len(data), chunksize):
+                yield data.iloc[start:start + chunksize]
+            return
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            headers = next(rows, None)
+            if not headers:
+                return
+            chunk = []
+            start = 0
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunksize:
+                    yield pd.DataFrame(chunk, columns=headers, index=range(start, start + len(chunk)))
+                    start += len(chunk)
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=headers, index=range(start, start + len(chunk)))
+        finally:
+            workbook.close()
+
     def file_to_graph(self, filename):
         """
         Based on acceptable file extensions but not necessarily known file types in terms of content, the function
@@ -99,11 +496,11 @@ class ODB:
         :param filename:
         :return:
         """
-        file = self.file_to_frame(filename)
-        if str(type(file["data"])) != "<class 'pandas.core.frame.DataFrame'>":
-            return file
-        else:
-            file = file["data"]
+        chunks = self.file_to_chunks(filename)
+        if chunks["data"] is None:
+            return chunks
+        # The file type is checked on the first chunk and the model is then run over the whole file as a stream
+        file = next(chunks["data"], pd.DataFrame())
         check = self.file_type_check(file.keys())
         check["size"] = str(os.stat(os.path.join(self.datapath, filename)).st_size) + " bytes"
         check["source"] = filename
@@ -114,7 +511,7 @@ class ODB:
                 "Name": check["name"],
                 "Entities": self.maps[check["name"]]["model"]["Entities"],
                 "Relations": self.maps[check["name"]]["model"]["Relations"],
-            }, file)
+            }, itertools.chain([file], chunks["data"]))
             return {
                 "data": data,
                 "ftype": check,
@@ -148,7 +545,7 @@ class ODB:
                 "message": "Could not identify the file type. Prepared %s for configuration." % (filename)
             }
 
-    def graph_etl_model(self, model, data):
+    def graph_etl_model(self, model, data, graph_limit=ETL_GRAPH_LIMIT):
         """
         The model should be a dictionary containing all the entities and their attributes. The attributes are mapped
         to headers within the data which is expected to be in a tabular format.
@@ -165,108 +562,146 @@ class ODB:
         Includes a function for etl processing of node
         Includes checking if the model is saved for file_type_check and then calling that model
 
+        The data can be a DataFrame, an iterator of DataFrames or a filename. Files are streamed in chunks through
+        file_to_chunks and each chunk is mapped and written to the database before the next is read. Only the first
+        graph_limit nodes and lines are kept for the returned graph and the totals are counted in "counts".
+
         :param model:
         :param data:
+        :param graph_limit:
         :return:
         """
         self.save_model_to_map(model)
-        etl_source = model['Name']
-        node_index = {}
-        graph = {"nodes": [], "lines": [], "n_index": []}
-        # Ensure the data received is changed into a DataFrame if it is not already
-        if str(type(data)) != "<class 'pandas.core.frame.DataFrame'>":
-            file = self.file_to_frame(data)
-            if str(type(file["data"])) != "<class 'pandas.core.frame.DataFrame'>":
+        graph = GraphAccumulator(limit=graph_limit)
+        graph["counts"] = {"rows": 0, "chunks": 0, "nodes": 0, "lines": 0, "truncated": False}
+        # Ensure the data received is changed into chunks of DataFrames if it is not already
+        if str(type(data)) == "<class 'pandas.core.frame.DataFrame'>":
+            chunks = [data]
+        elif type(data) == str:
+            file = self.file_to_chunks(data)
+            if file["data"] is None:
                 return file
-            else:
-                data = file["data"]
-
-        def get_key(**kwargs):
-            """
-            Handles node creation based on the local node_index and the local create_node function.
-            The node expects an icon and class_name (EntityType)
-            expects an Icon with a key but if there is none it will create it
-            :param kwargs:
-            :return:
-            """
-            # Check if it has been created based on attributes and return the corresponding key or create a new node
-            h_key = self.hash_node(kwargs)
-            if h_key in node_index.keys():
-                return node_index[h_key]
-            else:
+            chunks = file["data"]
+        else:
+            chunks = data
+        edges = self.edge_buffer()
+        for chunk in chunks:
+            self.graph_etl_chunk(model, chunk, graph, edges)
+            # The graph already holds the distinct lines so the buffer does not need to remember them between chunks
+            edges.flush()
+            edges.seen.clear()
+        edges.close()
+        graph["n_index"] = [n["key"] for n in graph["nodes"]]
+        graph["counts"].update({"nodes": graph.node_count(), "lines": graph.line_count(), "truncated": graph.truncated})
+        click.echo('[%s_%s_graph_etl_model] %s: %d rows in %d chunks, %d nodes and %d lines' % (
+            get_datetime(), self.db_name, model['Name'], graph["counts"]["rows"], graph["counts"]["chunks"],
+            graph["counts"]["nodes"], graph["counts"]["lines"]))
+        return graph
+
+    def graph_etl_chunk(self, model, data, graph, edges):
+        """
+        Map one DataFrame of a file through the model, creating its nodes and queuing its relations on edges
+        :param model:
+        :param data: DataFrame
+        :param graph: GraphAccumulator of graph_etl_model
+        :param edges: EdgeBuffer
+        :return:
+        """
+        etl_source = model['Name']
+        # The first data row has always been skipped by the ETL
+        data = data[data.index != 0]
+        graph["counts"]["chunks"] += 1
+        graph["counts"]["rows"] += len(data)
+        if len(data) == 0:
+            return graph
+        # Each entity resolves to a column of node keys aligned with the data rows so relations are built column wise
+        row_keys = pd.DataFrame(index=data.index)
+        for entity in model["Entities"]:
+            block = self.entity_block(entity, model["Entities"][entity], data, etl_source)
+            block["hashkey"] = self.hash_node_frame(block)
+            # Only the first row of each distinct node is sent to the database
+            unique = block.drop_duplicates(subset="hashkey")
+            hash_keys = unique.pop("hashkey").tolist()
+            # Convert date strings a column at a time rather than value by value in clean() as the nodes are inserted.
+            # Numbers are left as they are since prepare_node inserts them without cleaning.
+            for c in unique.columns:
+                if c not in ["class_name", "source", "entity", "description"] and \
+                        pd.api.types.is_string_dtype(unique[c]):
+                    converted = change_if_date_column(unique[c])
+                    convert = converted.map(bool) & ~unique[c].map(lambda v: bool(change_if_number(v)))
+                    if convert.any():
+                        unique[c] = unique[c].astype(object).where(~convert, converted)
+            nodes = unique.to_dict("records")
+            dates = [c for c in unique.columns if pd.api.types.is_datetime64_any_dtype(unique[c])]
+            for node in nodes:
+                for c in dates:
+                    node[c] = node[c].to_pydatetime()
+            results = self.create_nodes(nodes, hash_keys=hash_keys)
+            keys = {}
+            for hash_key, result in zip(hash_keys, results):
                 try:
-                    new_node = self.create_node(**kwargs)["data"]
-                    node_index[h_key] = new_node["key"]
-                    graph["nodes"].append(new_node)
-                    return new_node["key"]
+                    keys[hash_key] = result["data"]["key"]
+                    graph.add_node(result["data"])
                 except Exception as e:
                     print(str(e))
-                    return None
-
-        for index, row in data.iterrows():
-
-            if index != 0:
-                # Based on the entities in the model, get IDs that can be used to create relationships
-                rowConfig = {}
-                badRow = False
-                for entity in model["Entities"]:
-                    # The extracted entity is based on the model and mapped row value to entity attributes
-                    # If the class_name is not in the models then it should be created as a Category of an Object class
-                    if "className" in model["Entities"][entity].keys():
-                        extractedEntity = {"class_name": model["Entities"][entity]["className"], "source": etl_source}
-                    elif entity in self.models.keys():
-                        extractedEntity = {"class_name": entity, "source": etl_source}
-                    else:
-                        extractedEntity = {"class_name": "Object", "entity": entity, "source": etl_source}
-                    # Check if there is a description, otherwise set it up to auto create a description
-                    if "description" not in model["Entities"][entity]:
-                        extractedEntity['description'] = ""
-                        autoDescribe = True
-                    else:
-                        autoDescribe = False
-                    for att in model["Entities"][entity]:
-                        # If the attribute is in the row headers then it is to be mapped otherwise it is a custom value
-
-                        if model["Entities"][entity][att] in row.keys():
-                            val = row[model["Entities"][entity][att]]
-                            try:
-                                clean_val = val.to_pydatetime()
-                            except:
-                                clean_val = val
-
-                            extractedEntity[att] = clean_val
-                        else:
-                            extractedEntity[att] = model["Entities"][entity][att]
-                            clean_val = model["Entities"][entity][att]
-                        if autoDescribe:
-                            clean_val = date_to_standard_string(clean_val)
-                            extractedEntity['description'] = extractedEntity['description'] + str(clean_val) + " "
-                    # Check if this Entity has already been extracted and get the key.
-                    # The function also adds the entity to the graph which will be exported
-                    exEntityKey = get_key(**extractedEntity)
-                    if not exEntityKey:
-                        badRow = True
-                    if exEntityKey in graph["n_index"]:
-                        graph["n_index"].append(exEntityKey)
-                    # Add the entity key to its spot within the mapping configuration so the lines can be built
-                    rowConfig[entity] = exEntityKey
-                if not badRow:
-                    # Use the entity names that are saved into the relation to and from to assign the row config entity key
-                    for line in model["Relations"]:
-                        if({"to": rowConfig[model["Relations"][line]["to"]], "from": rowConfig[model["Relations"][line]["from"]], "description": line }) not in graph["lines"]:
-                            graph["lines"].append({
-                                "to": rowConfig[model["Relations"][line]["to"]],
-                                "from": rowConfig[model["Relations"][line]["from"]],
-                                "description": line,
-                            })
-                        self.create_edge_new(
-                            fromNode=rowConfig[model["Relations"][line]["from"]],
-                            toNode=rowConfig[model["Relations"][line]["to"]],
-                            edgeType=line
-                        )
+                    keys[hash_key] = None
+            row_keys[entity] = block["hashkey"].map(keys)
+        # Rows where any entity could not be created do not get relations
+        row_keys = row_keys.dropna()
+        for line in model["Relations"]:
+            pairs = pd.DataFrame({
+                "from": row_keys[model["Relations"][line]["from"]],
+                "to": row_keys[model["Relations"][line]["to"]]
+            }).drop_duplicates()
+            for fromNode, toNode in zip(pairs["from"], pairs["to"]):
+                if graph.add_line(fromNode, toNode, line):
+                    edges.add(fromNode=fromNode, toNode=toNode, edgeType=line)
 
         return graph
 
+    def entity_block(self, entity, attributes, data, etl_source):
+        """
+        Project the columns mapped to a model entity into a block with one column per extracted attribute, in the same
+        form the row by row ETL passed to create_node. Attributes whose value is a header take the column and all
+        others are constants. If the entity has no description, one is built from the attribute values.
+        :param entity:
+        :param attributes: model["Entities"][entity]
+        :param data: DataFrame
+        :param etl_source:
+        :return: DataFrame aligned with data
+        """
+        # If the class_name is not in the models then it should be created as a Category of an Object class
+        if "className" in attributes.keys():
+            block = {"class_name": attributes["className"], "source": etl_source}
+        elif entity in self.models.keys():
+            block = {"class_name": entity, "source": etl_source}
+        else:
+            block = {"class_name": "Object", "entity": entity, "source": etl_source}
+        autoDescribe = "description" not in attributes
+        if autoDescribe:
+            block["description"] = ""
+        description = pd.Series("", index=data.index)
+        for att in attributes:
+            try:
+                mapped = attributes[att] in data.columns
+            except TypeError:
+                mapped = False
+            if mapped:
+                column = data[attributes[att]]
+                if pd.api.types.is_datetime64_any_dtype(column):
+                    described = column.dt.strftime("%Y-%m-%dT%H:%M:%S").fillna("NaT")
+                else:
+                    described = column.map(date_to_standard_string).map(str)
+                block[att] = column
+            else:
+                block[att] = attributes[att]
+                described = str(date_to_standard_string(attributes[att]))
+            if autoDescribe:
+                description = description + described + " "
+        if autoDescribe:
+            block["description"] = description
+        return pd.DataFrame(block, index=data.index)
+
     def get_latlon(self):
         return np.random.normal(0, 45)
 
@@ -280,28 +715,34 @@ class ODB:
             return "Warning"
 
     def make_line(self, **kwargs):
-        if ({"to": kwargs['r_to']["key"], "from": kwargs['r_from']["key"],
-             "description": kwargs['r_type']}) not in kwargs["r"]['lines']:
-            kwargs["r"]['lines'].append({"to": kwargs['r_to']["key"], "from": kwargs['r_from']["key"], "description": kwargs['r_type']})
+        """
+        Add a line to the graph r if it is not there yet
+        :param kwargs: r (GraphAccumulator or graph dict), r_from (node), r_to (node), r_type (description)
+        :return: the GraphAccumulator
+        """
+        r = kwargs["r"]
+        if type(r) != GraphAccumulator:
+            r = GraphAccumulator(r)
+        r.add_line(kwargs['r_from']["key"], kwargs['r_to']["key"], kwargs['r_type'])
 
-        return kwargs["r"]
+        return r
 
     def check_node(self, n_dict, r):
-        newKey = self.hash_node(n_dict)
-        if newKey not in r['index']:
-            r['index'].append(n_dict['key'])
-            r['nodes'].append(n_dict)
+        """
+        Add the node to the graph r if its key is not there yet
+        :param n_dict: node
+        :param r: GraphAccumulator or graph dict
+        :return: the node and the GraphAccumulator
+        """
+        if type(r) != GraphAccumulator:
+            r = GraphAccumulator(r)
+        r.add_node(n_dict)
 
         return n_dict, r
 
     def hash_node(self, node):
 
-        node_id = ""
-        for k in node.keys():
-            node_id+=str(node[k])
-            node_id = hashlib.md5(str(node_id).encode()).hexdigest()
-
-        return node_id
+        return hash_values(node)
 
     def file_type_check(self, key_list):
         """
@@ -348,6 +789,7 @@ class ODB:
             '''.format(edgeType=edgeType, fromNode=fromNode, toNode=toNode)
             try:
                 self.client.command(sql)
+                self.result_cache.invalidate("E", edgeType)
             except Exception as e:
                 # Edges have an index to prevent the same relationship forming between the same nodes
                 if str(type(e)) != "<class 'pyorient.exceptions.PyOrientORecordDuplicatedException'>":
@@ -356,6 +798,26 @@ class ODB:
         else:
             click.echo('[%s_%s_create_edge] Did not receive expected arguments' % (get_datetime(), self.db_name))
 
+    def edge_buffer(self, batch_size=EDGE_BATCH_SIZE):
+        """
+        Get an EdgeBuffer that writes through this client. Use in place of create_edge_new within loops.
+        :param batch_size:
+        :return:
+        """
+        return EdgeBuffer(self, batch_size=batch_size)
+
+    def create_edges(self, edges, batch_size=EDGE_BATCH_SIZE):
+        """
+        Create many edges from an iterable of dicts with the create_edge_new arguments
+        :param edges:
+        :param batch_size:
+        :return: stats of the EdgeBuffer
+        """
+        with self.edge_buffer(batch_size) as buffer:
+            for e in edges:
+                buffer.add(**e)
+        return buffer.stats
+
     def create_edge(self, **kwargs):
         """
         TODO replace all uses of this method with new version
@@ -399,6 +861,7 @@ class ODB:
 
         try:
             self.client.command(sql)
+            self.result_cache.invalidate("E", kwargs['edgeType'], kwargs['fromClass'], kwargs['toClass'])
             return True
         except Exception as e:
             # Edges have an index to prevent the same relationship forming between the same nodes
@@ -424,6 +887,54 @@ class ODB:
         :param kwargs: str(db_name), str(class_name), list(properties{property: str, value: str)
         :return:
         """
+        prep = self.prepare_node(**kwargs)
+        node_prep = prep['node_prep']
+        hash_key = prep['hash_key']
+        if prep['exists']:
+            formatted_node = self.format_prepared_node(prep, hash_key)
+            message = '[%s_%s_create_node] Node exists' % (get_datetime(), self.db_name)
+            return {"message": message, "data": formatted_node}
+        sql = '''
+        {sql} return @rid
+        '''.format(sql=prep['sql'])
+        try:
+            r = self.client.command(sql)[0].get()
+            self.hashkey_cache.add(node_prep['class_name'], hash_key, r)
+            self.suggestions.add(node_prep['class_name'], r, prep['title'], node_prep.get('Ext_key'))
+            self.result_cache.invalidate(node_prep['class_name'])
+            formatted_node = self.format_prepared_node(prep, r)
+            message = '[%s_%s_create_node] Create node %s' % (get_datetime(), self.db_name, r)
+            return {"message": message, "data": formatted_node}
+
+        except Exception as e:
+            if str(type(e)) == str(type(e)) == "<class 'pyorient.exceptions.PyOrientORecordDuplicatedException'>":
+                if node_prep['class_name'] == "Case":
+                    node = self.get_node(val=node_prep['Name'], var="Name", class_name="Case")
+                    return {"data" :{"key": node['key']}}
+                elif "hashkey" in str(e):
+                    dup = "previously assigned to the record"
+                    rec = str(e)[str(e).find(dup):str(e).find(dup) + len(dup) + 15]
+                    node_hash = rec[rec.find("#"):rec.find("\r")]
+                    self.hashkey_cache.add(node_prep['class_name'], hash_key, node_hash)
+                    node = self.get_node(val=node_hash, var="record")
+                    return {"data": self.format_node(**node), "message": "duplicate blocked"}
+
+            message = '[%s_%s_create_node] ERROR %s\n%s' % (get_datetime(), self.db_name, str(e), sql)
+            '''
+            If it is a key error or duplication then need to return the formatted_node of the record that exists,
+            preventing the creation
+            '''
+            click.echo(message)
+            return message
+
+    def prepare_node(self, hash_key=None, **kwargs):
+        """
+        Shared by create_node and create_nodes to normalize the received attributes into the node_prep that will be
+        inserted, check the hashkey index and build the insert statement (without a return clause) for new nodes.
+        :param hash_key: hashkey already computed for the node, otherwise it is computed from kwargs
+        :param kwargs: as create_node
+        :return: dict(node_prep, hash_key, exists, sql, title, status, icon, attributes)
+        """
         attributes = []
         '''
         In the case attributes as an array is received instead of directly in kwargs, flatten the attributes and then 
@@ -482,18 +993,14 @@ class ODB:
             node_prep["Ext_key"] = None
 
         # Check the index based in the hashkey and class_name
-        hash_key, check = self.check_index_nodes(**kwargs)
+        if hash_key:
+            hash_key, check = self.check_index_hash(kwargs['class_name'], hash_key)
+        else:
+            hash_key, check = self.check_index_nodes(**kwargs)
+        prep = {"node_prep": node_prep, "hash_key": hash_key, "exists": check, "sql": None,
+                "title": title, "status": status, "icon": icon, "attributes": attributes}
         if check:
-            formatted_node = self.format_node(
-                key=hash_key,
-                class_name=node_prep['class_name'],
-                title=title,
-                status=status,
-                icon=icon,
-                attributes=attributes
-            )
-            message = '[%s_%s_create_node] Node exists' % (get_datetime(), self.db_name)
-            return {"message": message, "data": formatted_node}
+            return prep
         # Start the SQL based on the hashkey
         labels = "(hashkey"
         values = "('%s'" % hash_key
@@ -524,41 +1031,117 @@ class ODB:
                 status = node_prep[k]
             if k != 'passWord':
                 attributes.append({"label": k, "value": node_prep[k]})
-        sql = '''
-        insert into {class_name} {labels} values {values} return @rid
-        '''.format(class_name=node_prep['class_name'], labels=labels, values=values)
-        try:
-            r = self.client.command(sql)[0].get()
-            formatted_node = self.format_node(
-                key=r,
-                class_name=node_prep['class_name'],
-                title=title,
-                status=status,
-                icon=icon,
-                attributes=attributes
-            )
-            message = '[%s_%s_create_node] Create node %s' % (get_datetime(), self.db_name, r)
-            return {"message": message, "data": formatted_node}
+        sql = "insert into {class_name} {labels} values {values}".format(
+            class_name=node_prep['class_name'], labels=labels, values=values)
+        prep.update({"sql": sql, "title": title, "status": status, "icon": icon})
+        return prep
+
+    def format_prepared_node(self, prep, key):
+
+        return self.format_node(
+            key=key,
+            class_name=prep['node_prep']['class_name'],
+            title=prep['title'],
+            status=prep['status'],
+            icon=prep['icon'],
+            attributes=prep['attributes']
+        )
+
+    def create_nodes(self, nodes, batch_size=500, hash_keys=None):
+        """
+        Bulk version of create_node for ETL and ingestion. Nodes are prepared exactly as create_node does, including
+        the hashkey check, and the inserts for new nodes are sent batch_size at a time as a single transactional
+        OrientDB script through client.batch instead of one command per node. Nodes that share a hashkey within a batch
+        are inserted once. If a batch fails, for example because another worker inserted one of the hashkeys in the
+        meantime, its nodes are retried one at a time through create_node which resolves the duplicates.
+        :param nodes: iterable of create_node kwargs
+        :param batch_size:
+        :param hash_keys: optional list of hashkeys aligned with nodes, as computed by hash_node_frame
+        :return: list of create_node results in the same order as nodes
+        """
+        results = []
+        batch = []
+        batch_keys = []
+        for i, node in enumerate(nodes):
+            batch.append(node)
+            batch_keys.append(hash_keys[i] if hash_keys else None)
+            if len(batch) >= batch_size:
+                results.extend(self.create_node_batch(batch, batch_keys))
+                batch = []
+                batch_keys = []
+        if batch:
+            results.extend(self.create_node_batch(batch, batch_keys))
+        return results
 
+    def create_node_batch(self, nodes, hash_keys=None):
+        """
+        Create one batch of nodes for create_nodes
+        :param nodes: list of create_node kwargs
+        :param hash_keys: optional list of precomputed hashkeys aligned with nodes
+        :return:
+        """
+        results = [None] * len(nodes)
+        preps = []
+        positions = {}
+        for i, node in enumerate(nodes):
+            prep = self.prepare_node(hash_key=hash_keys[i] if hash_keys else None, **node)
+            if prep['exists']:
+                results[i] = {
+                    "message": '[%s_%s_create_node] Node exists' % (get_datetime(), self.db_name),
+                    "data": self.format_prepared_node(prep, prep['hash_key'])
+                }
+            elif prep['hash_key'] in positions:
+                positions[prep['hash_key']].append(i)
+            elif ";" in prep['sql']:
+                # The script splits statements on semicolons so values containing them are sent on their own
+                results[i] = self.create_node(**node)
+            else:
+                positions[prep['hash_key']] = [i]
+                preps.append(prep)
+        if not preps:
+            return results
+        script = "begin;\n"
+        for j, prep in enumerate(preps):
+            script += "let n%d = %s;\n" % (j, prep['sql'].replace("\r", " ").replace("\n", " "))
+        script += "commit retry 10;\nreturn [%s]" % ", ".join(["$n%d" % j for j in range(len(preps))])
+        try:
+            rids = [self.get_record_rid(r) for r in self.client.batch(script)]
+            if len(rids) != len(preps):
+                raise ValueError("Expected %d records from the batch but received %d" % (len(preps), len(rids)))
         except Exception as e:
-            if str(type(e)) == str(type(e)) == "<class 'pyorient.exceptions.PyOrientORecordDuplicatedException'>":
-                if node_prep['class_name'] == "Case":
-                    node = self.get_node(val=node_prep['Name'], var="Name", class_name="Case")
-                    return {"data" :{"key": node['key']}}
-                elif "hashkey" in str(e):
-                    dup = "previously assigned to the record"
-                    rec = str(e)[str(e).find(dup):str(e).find(dup) + len(dup) + 15]
-                    node_hash = rec[rec.find("#"):rec.find("\r")]
-                    node = self.get_node(val=node_hash, var="record")
-                    return {"data": self.format_node(**node), "message": "duplicate blocked"}
+            click.echo('[%s_%s_create_nodes] Batch of %d failed, retrying individually: %s' % (
+                get_datetime(), self.db_name, len(preps), str(e)))
+            rids = None
+        for j, prep in enumerate(preps):
+            if rids:
+                self.hashkey_cache.add(prep['node_prep']['class_name'], prep['hash_key'], rids[j])
+                self.suggestions.add(prep['node_prep']['class_name'], rids[j], prep['title'],
+                                     prep['node_prep'].get('Ext_key'))
+                self.result_cache.invalidate(prep['node_prep']['class_name'])
+                result = {
+                    "message": '[%s_%s_create_node] Create node %s' % (get_datetime(), self.db_name, rids[j]),
+                    "data": self.format_prepared_node(prep, rids[j])
+                }
+            else:
+                result = self.create_node(**nodes[positions[prep['hash_key']][0]])
+            for i in positions[prep['hash_key']]:
+                results[i] = result
+        return results
 
-            message = '[%s_%s_create_node] ERROR %s\n%s' % (get_datetime(), self.db_name, str(e), sql)
-            '''
-            If it is a key error or duplication then need to return the formatted_node of the record that exists,
-            preventing the creation
-            '''
-            click.echo(message)
-            return message
+    @staticmethod
+    def get_record_rid(record):
+        """
+        Batch scripts return records, links or a list holding either depending on the statement. Return the RID hash.
+        :param record:
+        :return:
+        """
+        if type(record) == list:
+            record = record[0]
+        if hasattr(record, "get_hash"):
+            return record.get_hash()
+        if getattr(record, "_rid", None):
+            return record._rid
+        return record.oRecordData["rid"].get_hash()
 
     def check_index_nodes(self, **kwargs):
         """
@@ -572,27 +1155,46 @@ class ODB:
                     'EndDate', 'StartDate', 'DateCreated', 'Ext_key', 'category', 'pid', 'name', 'started', 'email',
                     'searchValue', 'ipAddress', 'token', 'session', 'PhoneNumber', 'source', 'Entity']
         Return the key of the
+        Before querying the index, the in process hashkey cache is checked for the RID and, once the class has been
+        warmed, whether the hashkey is known not to exist so the round trip can be skipped.
         :param kwargs:
         :return:
         """
-        hash_str = ""
-        for k in self.nodeKeys:
-            if k in kwargs.keys():
-                if kwargs[k] != "":
-                    # Remove commas since this will be a str treated as a list
-                    hash_str = hash_str + k + str(kwargs[k])
-                    hash_str = clean_concat(hash_str).replace(",", "")
-        # Change the str to a hash string value
-        hash_str = hashlib.md5(str(hash_str).encode()).hexdigest()
+        # Change the normalized str of the nodeKeys to a hash string value
+        hash_str = hash_attributes(kwargs, self.nodeKeys)
         if "class_name" in kwargs.keys():
-            index_str = "%s_hashkey" % kwargs['class_name']
-            r = self.client.command('''
-            select from index:%s where key = '%s'
-            ''' % (index_str, hash_str))
-            if len(r) < 1:
-                return hash_str, False
-            else:
-                return r[0].oRecordData["rid"].get_hash(), True
+            return self.check_index_hash(kwargs['class_name'], hash_str)
+
+    def check_index_hash(self, class_name, hash_str):
+        """
+        Look up a hashkey in the cache and then index:<class_name>_hashkey
+        :param class_name:
+        :param hash_str:
+        :return: (rid, True) if the node exists, otherwise (hash_str, False)
+        """
+        rid = self.hashkey_cache.get(class_name, hash_str)
+        if rid:
+            return rid, True
+        if self.hashkey_cache.known_absent(class_name, hash_str):
+            return hash_str, False
+        index_str = "%s_hashkey" % class_name
+        r = self.client.command('''
+        select from index:%s where key = '%s'
+        ''' % (index_str, hash_str))
+        if len(r) < 1:
+            return hash_str, False
+        else:
+            rid = r[0].oRecordData["rid"].get_hash()
+            self.hashkey_cache.add(class_name, hash_str, rid)
+            return rid, True
+
+    def hash_node_frame(self, frame):
+        """
+        Vectorized check_index_nodes hash for a DataFrame where each row holds the attributes of one node
+        :param frame: DataFrame with a column per attribute
+        :return: Series of hashkeys aligned with frame
+        """
+        return hash_frame(frame, self.nodeKeys)
 
     def check_index_edges(self, edge):
         """
@@ -605,14 +1207,72 @@ class ODB:
         else:
             return False
 
-    def get_hash_keys(self):
+    def get_hash_keys(self, class_name, page_size=HASHKEY_WARM_BATCH):
         """
-        Get the key, hash_key pair that is used for the index
-        :return:
+        Get the hashkey, rid pairs of the nodes of a class, page_size nodes at a time in RID order so the class is
+        never held in memory at once
+        :param class_name:
+        :param page_size:
+        :return: generator of (hashkey, rid)
         """
-        r = self.client.command('''
-        select key, hash from V
-        ''')
+        last = "#-1:-1"
+        while True:
+            r = self.client.command('''
+            select @rid as rid, hashkey from %s where @rid > %s order by @rid limit %d
+            ''' % (class_name, last, page_size))
+            for i in r:
+                last = i.oRecordData["rid"].get_hash()
+                if i.oRecordData.get("hashkey"):
+                    yield i.oRecordData["hashkey"], last
+            if len(r) < page_size:
+                return
+
+    def warm_hashkey_cache(self, class_names=None):
+        """
+        Load the hashkeys of each model class, read a page at a time by get_hash_keys, into the hashkey cache so
+        create_node can resolve existing nodes, and rule out new ones, without a round trip. Classes already warmed by
+        another client of the same database are skipped.
+        :param class_names: defaults to all model classes
+        :return: number of hashkeys loaded
+        """
+        if not class_names:
+            class_names = [m for m in self.models if "hashkey" in self.models[m]]
+        total = 0
+        for class_name in class_names:
+            if class_name in self.hashkey_cache.warmed:
+                continue
+            try:
+                total += self.hashkey_cache.warm(class_name, self.get_hash_keys(class_name))
+            except Exception as e:
+                click.echo('[%s_%s_warm_hashkey_cache] Skipped %s: %s' % (
+                    get_datetime(), self.db_name, class_name, str(e)))
+        click.echo('[%s_%s_warm_hashkey_cache] Loaded %d hashkeys' % (get_datetime(), self.db_name, total))
+        return total
+
+    def warm_suggestion_index(self, class_names=None):
+        """
+        Load the titles and Ext_keys of each model class into the suggestion index, up to SUGGEST_WARM_LIMIT nodes a
+        class. A class with more nodes is marked as truncated so its searches also go to the database. Classes already
+        warmed by another client of the same database are skipped.
+        :param class_names: defaults to all model classes
+        :return: number of nodes loaded
+        """
+        total = 0
+        for class_name in class_names or self.models.keys():
+            if class_name in self.suggestions.warmed:
+                continue
+            try:
+                r = self.client.command('''
+                select @rid as rid, title, Ext_key from %s limit %d
+                ''' % (class_name, SUGGEST_WARM_LIMIT))
+                total += self.suggestions.warm(class_name, [(
+                    i.oRecordData["rid"].get_hash(), i.oRecordData.get("title"), i.oRecordData.get("Ext_key"))
+                    for i in r], complete=len(r) < SUGGEST_WARM_LIMIT)
+            except Exception as e:
+                click.echo('[%s_%s_warm_suggestion_index] Skipped %s: %s' % (
+                    get_datetime(), self.db_name, class_name, str(e)))
+        click.echo('[%s_%s_warm_suggestion_index] Loaded %d names' % (get_datetime(), self.db_name, total))
+        return total
 
     def create_index(self):
         """
@@ -637,7 +1297,7 @@ class ODB:
                 if k in rec.keys():
                     if rec[k] != "":
                         hash+=str(rec[k])
-            hash = clean_concat(hash)
+            hash = normalize_key(hash)
             if hash not in self.index.keys():
                 self.index['nodes'][hash] = rec['key']
             # Make
@@ -667,6 +1327,7 @@ class ODB:
         try:
             self.client.db_create(self.db_name, pyorient.DB_TYPE_GRAPH)
             click.echo('[%s_%s_create_db] Starting process...' % (get_datetime(), self.db_name))
+            self.forget_database()
             sql = ""
             for m in self.models:
                 sql = sql+"create class %s extends %s;\n" % (m, self.models[m]['class'])
@@ -716,16 +1377,19 @@ class ODB:
     def open_db(self):
         """
         Open the Database for use by establishing the client session based on the user and password. If it doesn't exist
-        return a message that let's the user to know
+        return a message that let's the user to know. The sessions themselves are opened by the pool on checkout so the
+        first database client is checked out here to confirm the credentials and warm the pool. The hashkey cache is
+        warmed separately by warm_hashkey_cache, which the views run in the background after start up.
         :return:
         """
         try:
-            self.client.connect(self.user, self.pswd)
+            exists = self.client.db_exists(self.db_name)
         except Exception as e:
             click.echo('[%s_get_neighbors_index] ERROR opening DB %s' % (get_datetime(), str(e)))
             return True
-        if self.client.db_exists(self.db_name):
-            self.client.db_open(self.db_name, self.user, self.pswd)
+        if exists:
+            with self.pool.connection(self.db_name):
+                pass
             return False
         else:
             return "%s doesn't exist. Please initialize through the API."
@@ -742,25 +1406,186 @@ class ODB:
         # Run the first sql to get the full entity with neighbors
         r = self.client.command(sql)
         graph = {"nodes": [], "lines": [], "index": []}
+        seen = set()
         # class_name determines if the line is a node or an edge
         for i in r:
             temp = i.oRecordData
             if "class_name" in temp.keys(): # It is a node
                 node = {"key": i._rid}
-                if node['key'] not in graph['index']:
+                if node['key'] not in seen:
                     for a in temp:
                         if a[:2] != "_in" and a[:3] != "_out" and "pyorient." not in str(type(temp[a])):
                             node[a] = temp[a]
                     graph['nodes'].append(node)
                     graph['index'].append(node['key'])
+                    seen.add(node['key'])
             else:  # It is an edge
                 line_key = "%s%s%s" %(i._class, temp['out'].get_hash(), temp['in'].get_hash())
-                if line_key not in graph['index']:
+                if line_key not in seen:
                     graph['index'].append(line_key)
+                    seen.add(line_key)
                     graph["lines"].append({"description": i._class, "from": temp['out'].get_hash(), "to": temp['in'].get_hash()})
 
         return {"message": "Retrieved %d neighbors for %s" % (len(graph['nodes'])-1, nodekey),  "data": graph}
 
+    def get_neighborhood(self, nodekey=None, depth=1, fanout=NEIGHBOR_FANOUT, limit=NEIGHBOR_LIMIT, edge_types=None,
+                         direction="both", cursor=None, sample=None, **kwargs):
+        """
+        Bounded version of get_neighbors_index for expanding nodes, including hubs, in the workbench. From the node
+        each hop follows at most fanout relations of every node reached in the previous hop, up to depth hops and limit
+        nodes. Every node carries its degree, the number of relations that could be followed, so the workbench can show
+        what was left out and expand it again. Only the relations of the starting node are paged by the cursor.
+        :param nodekey: RID of the node
+        :param depth: number of hops, at most NEIGHBOR_MAX_DEPTH
+        :param fanout: most relations followed from a node in a hop
+        :param limit: most nodes returned
+        :param edge_types: list or comma separated str of the edge classes to follow, all if empty
+        :param direction: both, out or in
+        :param cursor: the cursor returned with the previous page to get the next relations of the node
+        :param sample: "degree" to follow the best connected neighbors of a node with more than fanout relations,
+            ranked within its first NEIGHBOR_SAMPLE_POOL relations, instead of the first ones. Neighbors that have more
+            than fanout relations themselves are returned but not expanded further.
+        :return: message and data with nodes, lines, cursor for the next page (None on the last) and truncated
+        """
+        if not nodekey or not RID.match(str(nodekey)):
+            return {"message": "A RID is required as nodekey, received %s" % nodekey, "data": None}
+        nodekey = "#%s" % str(nodekey).lstrip("#")
+        try:
+            depth = max(1, min(int(depth), NEIGHBOR_MAX_DEPTH))
+            fanout = max(1, int(fanout))
+            limit = max(1, int(limit))
+        except (TypeError, ValueError):
+            return {"message": "depth, fanout and limit must be numbers", "data": None}
+        if type(edge_types) == str:
+            edge_types = [e.strip() for e in edge_types.split(",") if e.strip()]
+        edge_types = [e for e in edge_types or [] if CLASS_NAME.match(e)]
+        direction = direction if direction in ["both", "out", "in"] else "both"
+        skip = self.decode_cursor(cursor, nodekey)
+
+        graph = GraphAccumulator()
+        degrees = self.get_degrees([nodekey], edge_types, direction)
+        reached = [nodekey]
+        reached_keys = {nodekey}
+        frontier = [nodekey]
+        next_cursor = None
+        truncated = False
+        for hop in range(depth):
+            next_frontier = []
+            for node in frontier:
+                start = skip if hop == 0 else 0
+                if sample == "degree" and (degrees.get(node) or 0) > fanout and start < NEIGHBOR_SAMPLE_POOL:
+                    lines = self.get_relations(node, edge_types, direction, 0, NEIGHBOR_SAMPLE_POOL)
+                    others = [l["to"] if l["from"] == node else l["from"] for l in lines]
+                    unknown = [o for o in set(others) if o not in degrees]
+                    degrees.update(self.get_degrees(unknown, edge_types, direction))
+                    ranked = sorted(zip(lines, others), key=lambda lo: -(degrees.get(lo[1]) or 0))
+                    lines = [l for l, o in ranked[start:start + fanout]]
+                    more = start + fanout < len(ranked) or len(ranked) == NEIGHBOR_SAMPLE_POOL
+                else:
+                    lines = self.get_relations(node, edge_types, direction, start, fanout + 1)
+                    more = len(lines) > fanout
+                    lines = lines[:fanout]
+                if hop == 0 and more:
+                    next_cursor = self.encode_cursor(nodekey, start + fanout)
+                elif more:
+                    truncated = True
+                for l in lines:
+                    other = l["to"] if l["from"] == node else l["from"]
+                    if other not in reached_keys:
+                        if len(reached) >= limit:
+                            truncated = True
+                            continue
+                        reached.append(other)
+                        reached_keys.add(other)
+                        next_frontier.append(other)
+                    graph.add_line(line=l)
+            frontier = next_frontier
+            # The degrees of the new nodes decide what the next hop expands and are returned with the nodes
+            degrees.update(self.get_degrees([n for n in frontier if n not in degrees], edge_types, direction))
+            if sample == "degree":
+                frontier = [n for n in frontier if (degrees.get(n) or 0) <= fanout]
+        for node in self.get_records(reached):
+            node["degree"] = degrees.get(node["key"])
+            graph.add_node(node)
+        graph["index"] = [n["key"] for n in graph["nodes"]]
+        graph["cursor"] = next_cursor
+        graph["truncated"] = truncated
+        return {
+            "message": "Retrieved %d nodes and %d lines within %d hops of %s" % (
+                graph.node_count(), graph.line_count(), depth, nodekey),
+            "data": graph
+        }
+
+    @staticmethod
+    def encode_cursor(nodekey, skip):
+        return base64.urlsafe_b64encode(json.dumps({"node": nodekey, "skip": skip}).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor, nodekey):
+        """
+        Return the number of relations of nodekey already returned by the pages before the cursor
+        :param cursor:
+        :param nodekey:
+        :return:
+        """
+        if not cursor:
+            return 0
+        try:
+            c = json.loads(base64.urlsafe_b64decode(str(cursor).encode()).decode())
+            return int(c["skip"]) if c["node"] == nodekey else 0
+        except Exception:
+            return 0
+
+    def get_relations(self, nodekey, edge_types, direction, skip, count):
+        """
+        Relations of a node in storage order
+        :param nodekey: RID
+        :param edge_types: list of edge classes, all if empty
+        :param direction: both, out or in
+        :param skip:
+        :param count:
+        :return: list of lines
+        """
+        sql = "select expand(%sE(%s)) from %s skip %d limit %d" % (
+            direction, ", ".join(["'%s'" % e for e in edge_types]), nodekey, skip, count)
+        lines = []
+        for i in self.client.command(sql):
+            temp = i.oRecordData
+            lines.append({"description": i._class, "from": temp['out'].get_hash(), "to": temp['in'].get_hash()})
+        return lines
+
+    def get_degrees(self, nodekeys, edge_types, direction):
+        """
+        Number of relations of the given types and direction of each node in one query
+        :param nodekeys: list of RIDs
+        :param edge_types:
+        :param direction:
+        :return: dict of RID to degree
+        """
+        if not nodekeys:
+            return {}
+        sql = "select @rid as rid, %sE(%s).size() as degree from [%s]" % (
+            direction, ", ".join(["'%s'" % e for e in edge_types]), ", ".join(nodekeys))
+        return {i.oRecordData['rid'].get_hash(): i.oRecordData['degree'] for i in self.client.command(sql)}
+
+    def get_records(self, nodekeys):
+        """
+        Nodes in the form of get_neighbors_index for a list of RIDs in one query
+        :param nodekeys:
+        :return: list of nodes
+        """
+        nodes = []
+        if not nodekeys:
+            return nodes
+        for i in self.client.command("select from [%s]" % ", ".join(nodekeys)):
+            temp = i.oRecordData
+            node = {"key": i._rid}
+            for a in temp:
+                if a[:2] != "_in" and a[:3] != "_out" and "pyorient." not in str(type(temp[a])):
+                    node[a] = temp[a]
+            nodes.append(node)
+        return nodes
+
     def get_node(self, class_name="V", var=None, val=None):
         """
         Return a node based on the class_name, variable of the class and value of the variable.
@@ -799,6 +1624,11 @@ class ODB:
             "name": self.db_name,
             "size": self.client.db_size(),
             "records": self.client.db_count_records(),
+            "pool": self.pool.get_stats(),
+            "hashkey_cache": self.hashkey_cache.get_stats(),
+            "case_cache": self.case_cache.get_stats(),
+            "suggestions": self.suggestions.get_stats(),
+            "result_cache": self.result_cache.get_stats(),
             "details": self.get_db_details(self.db_name)})
 
     def get_db_details(self, db_name):
@@ -873,6 +1703,10 @@ class ODB:
           update {key} set {var}='{val}'
           ''').format(var=kwargs['var'], val=kwargs['val'], key=kwargs['key'])
         r = self.client.command(sql)
+        if kwargs.get('class_name'):
+            self.result_cache.invalidate(kwargs['class_name'])
+        else:
+            self.result_cache.clear()
 
         if len(r) > 0:
             return r
@@ -880,17 +1714,51 @@ class ODB:
             return None
 
     def delete_node(self, **kwargs):
-
-        sql = ('''
-          delete vertex {class_name} where key = {key}
-          ''').format(class_name=kwargs['class_name'], key=kwargs['key'])
-        r = self.client.command(sql)
+        """
+        Delete a node by its RID, or by its key attribute, and drop it from the in process caches
+        :param kwargs: class_name, key
+        :return:
+        """
+        if str(kwargs['key']).startswith("#"):
+            target = kwargs['key']
+        else:
+            target = "{class_name} where key = {key}".format(class_name=kwargs['class_name'], key=kwargs['key'])
+        # Read the hashkeys first so the cache stops resolving them to the deleted node
+        nodes = [{"rid": i.oRecordData["rid"].get_hash(), "class_name": kwargs['class_name'],
+                  "hashkey": i.oRecordData.get("hashkey"), "Ext_key": i.oRecordData.get("Ext_key")}
+                 for i in self.client.command("select @rid as rid, hashkey, Ext_key from %s" % target)]
+        r = self.client.command("delete vertex %s" % target)
+        self.forget_nodes(nodes)
+        self.result_cache.invalidate("E", kwargs['class_name'])
 
         if len(r) > 0:
             return r
         else:
             return None
 
+    def forget_nodes(self, nodes, replacement=None):
+        """
+        Drop deleted nodes from the in process caches. Where they were merged into a replacement their hashkeys are
+        already resolved to it and are kept.
+        :param nodes: list of dict(rid, class_name, hashkey, Ext_key)
+        :param replacement: optional RID of the node they were merged into
+        :return:
+        """
+        for n in nodes:
+            self.suggestions.discard(n["rid"])
+            if not replacement and n.get("hashkey"):
+                self.hashkey_cache.discard(n["class_name"], n["hashkey"])
+
+    def forget_database(self):
+        """
+        Drop what this worker kept about the nodes of the database when it is created again, so the RIDs of the
+        database it replaced are not reused
+        :return:
+        """
+        self.hashkey_cache.clear()
+        self.suggestions.clear()
+        self.result_cache.clear()
+
     def format_node(self, **kwargs):
         """
         Create a formatted node where title, status and icons are used
@@ -930,31 +1798,36 @@ class ODB:
         :return:
         """
 
-        node_keys = []
+        node_keys = set()
         group_keys = [{"key": "NoGroup", "title": "NoGroup" }]
+        group_index = {("NoGroup", "NoGroup")}
 
         if "groups" in graph.keys():
             for g in graph['groups']:
-                if ({"key": g['key'], "title": g['title']}) not in graph['groups']:
+                if (g['key'], g['title']) not in group_index:
+                    group_index.add((g['key'], g['title']))
                     group_keys.append({"key": g['key'], "title": g['title']})
 
         graph['groups'] = group_keys
 
         if "nodes" in graph.keys() and "lines" in graph.keys():
             for n in graph['nodes']:
-                node_keys.append(n['key'])
+                node_keys.add(n['key'])
                 if "group" in n.keys():
-                    if {"key": n['group'], "title": n['group']} not in group_keys:
+                    if (n['group'], n['group']) not in group_index:
+                        group_index.add((n['group'], n['group']))
                         graph['groups'].append({'key': n['group'], 'title': n['group']})
                 else:
                     n['group'] = "NoGroup"
             for l in graph['lines']:
                 if l['to'] not in node_keys:
-                    click.echo("Relationship TO with %s not found in nodes. Creating dummy node.")
+                    click.echo("Relationship TO with %s not found in nodes. Creating dummy node." % l['to'])
                     graph['nodes'].append(self.create_node(key=l['to'], class_name="Object"))
+                    node_keys.add(l['to'])
                 if l['from'] not in node_keys:
-                    click.echo("Relationship TO with %s not found in nodes. Creating dummy node.")
+                    click.echo("Relationship FROM with %s not found in nodes. Creating dummy node." % l['from'])
                     graph['nodes'].append(self.create_node(key=l['from'], class_name="Object"))
+                    node_keys.add(l['from'])
         else:
             click.echo("Missing nodes or lines")
             return None
@@ -971,84 +1844,129 @@ class ODB:
         hashed normalized string. This reduces entire bodies of text down to a single hash that can be compared. When
         merged, the B record is destroyed and replaced with the A key.
         Input: node_A key, node_B key
-        Get the hash of each
-        Update the node_A hash_str to be a combination of the 2 with a , sep
-        Update the index by changing the key of the node_B hash to the node_A key
+        The merge itself is done by merge_node_groups with a single group.
         :param kwargs:
         :return:
         """
         if 'node_A' in kwargs.keys() and 'node_B' in kwargs.keys():
-            results = "Merged node %d into %d resulting in " % (kwargs['node_B'], kwargs['node_A'])
-            # Get the relationships and hashkeys for both the A and B nodes
-            r = self.client.command('''
-                select hashkey, @class, key,
-                In().key as InKeys, In().class_name as n_in_class, 
-                Out().key as OutKeys, Out().class_name as n_out_class, OutE().@class, InE().@class 
-                from V where key in [%d, %d]''' % (kwargs['node_A'], kwargs['node_B']))
-            try:
-                A = r[0].oRecordData
-                if A["key"] == kwargs['node_B']:
-                    B = A
-            except:
-                return "No record for %d" % kwargs['node_A']
-            try:
-                # Normal case
-                if len(r) > 1:
-                    B = r[1].oRecordData
-                # B was created in the first
-                elif A["key"] == kwargs['node_B']:
-                    A = {"key": kwargs['node_A'], "hashkey": "", "class": B["class"],
-                         'InKeys': [], 'n_in_class': [], 'OutKeys': [],
-                         'n_out_class': [], 'OutE': [], 'InE': []}
-            except:
-                return "No record for %d" % kwargs['node_A']
-
-            A['rels'] = []
-            B['rels'] = []
-            # Format A and B so relations can easily be compared through dictionaries within lists. Use a dir for direction
-            for n in [A, B]:
-                if (len(n['OutKeys']) == len(n['OutE'])) and len(n['OutKeys']) > 0:
-                    for k, l, c in zip(n['OutKeys'], n['OutE'], n['n_out_class']):
-                        n['rels'].append({
-                            "edgeNode": k,
-                            "edgeType": l,
-                            "dir": "out",
-                            "class": c
-                        })
-                # change of the from since it's an incoming edge
-                if (len(n['InKeys']) == len(n['InE'])) and len(n['InKeys']) > 0:
-                    for k, l, c in zip(n['InKeys'], n['InE'], n['n_in_class']):
-                        n['rels'].append({
-                            "edgeNode": k,
-                            "edgeType": l,
-                            "dir": "in",
-                            "class": c
-                        })
-
-            # Check all the relationships for B and if it is not in A's relationships, create the rel using the dir
-            i = 0
-            for rel in B['rels']:
-                if rel not in A['rels']:
-                    i+=1
-                    if rel['dir'] == "out":
-                        self.create_edge(fromClass=A['class'], fromNode=A['key'], toClass=rel['class'],
-                                         toNode=rel['edgeNode'], edgeType=rel['edgeType'])
-                    else:
-                        self.create_edge(fromClass=rel['class'], fromNode=rel['edgeNode'], toClass=A['class'],
-                                         toNode=A['key'], edgeType=rel['edgeType'])
-            results+= "%d new relations." % i
-
-            # Update the hashkey of the A node for future indexing
-            newHashKey = A['hashkey'] + "," + B['hashkey']
-            self.update(key=A['key'], var="hashkey", val=newHashKey, class_name=A['class'])
-
-            # Delete the B node
-            self.delete_node(key=B['key'], class_name=B['class'])
-
+            r = self.merge_node_groups([(kwargs['node_A'], [kwargs['node_B']])])
+            if r["missing"]:
+                return "No record for %s" % r["missing"][0]
+            results = "Merged node %s into %s resulting in %d new relations." % (
+                kwargs['node_B'], kwargs['node_A'], r["edges_rewired"])
         else:
             results = "Need both an A node and B node."
         return results
 
+    def merge_node_groups(self, groups, chunk_size=MERGE_GROUP_CHUNK):
+        """
+        Merge many groups of duplicates, each given as (survivor key, [duplicate keys]) or as a dict with node_A and a
+        list of node_B keys. The nodes and edges of chunk_size groups are read with one query each. Each group is then
+        written as one transaction that creates the relations of the duplicates the survivor does not already have,
+        with one create edge per edge class and direction, sets the combined hashkey of the survivor and deletes the
+        duplicates along with their edges. Edges between members of a group are dropped rather than becoming loops.
+        :param groups: iterable of (node_A, [node_B, ...]) or {"node_A": key, "node_B": [key, ...]}
+        :param chunk_size:
+        :return: dict with counts of the groups merged and failed, nodes merged, edges rewired and edges skipped
+        """
+        stats = {"groups": 0, "failed": 0, "merged": 0, "edges_rewired": 0, "edges_skipped": 0, "missing": []}
+        groups = [(g["node_A"], g["node_B"]) if isinstance(g, dict) else g for g in groups]
+        groups = [(a, [b for b in (bs if isinstance(bs, (list, tuple, set)) else [bs]) if b != a]) for a, bs in groups]
+        for i in range(0, len(groups), chunk_size):
+            chunk = [g for g in groups[i:i + chunk_size] if g[1]]
+            if not chunk:
+                continue
+            keys = set()
+            for a, bs in chunk:
+                keys.add(a)
+                keys.update(bs)
+            nodes = {}
+            for r in self.client.command('''
+            select @rid as rid, @class as class_name, key, hashkey, Ext_key from V where key in [%s]
+            ''' % ", ".join([str(int(k)) for k in keys])):
+                r = r.oRecordData
+                nodes[r["key"]] = {"rid": r["rid"].get_hash(), "class_name": r["class_name"],
+                                   "hashkey": r.get("hashkey") or "", "Ext_key": r.get("Ext_key")}
+            edges = {}
+            if nodes:
+                for r in self.client.command('''
+                select @rid as rid, @class as class_name, out as source, in as target 
+                from (select expand(bothE()) from [%s])
+                ''' % ", ".join([n["rid"] for n in nodes.values()])):
+                    r = r.oRecordData
+                    edges[r["rid"].get_hash()] = (r["class_name"], r["source"].get_hash(), r["target"].get_hash())
+            for a, bs in chunk:
+                if a not in nodes:
+                    stats["missing"].append(a)
+                    continue
+                stats["missing"].extend([b for b in bs if b not in nodes])
+                bs = [b for b in bs if b in nodes]
+                if bs:
+                    self.merge_node_group(nodes[a], [nodes[b] for b in bs], edges.values(), stats)
+        click.echo('[%s_%s_merge_node_groups] Merged %d nodes in %d groups rewiring %d edges, %d edges already on the '
+                   'survivor, %d groups failed' % (get_datetime(), self.db_name, stats["merged"], stats["groups"],
+                                                   stats["edges_rewired"], stats["edges_skipped"], stats["failed"]))
+        return stats
+
+    def merge_node_group(self, node_A, duplicates, edges, stats):
+        """
+        Write one group of merge_node_groups as a single transaction
+        :param node_A: dict(rid, class_name, hashkey, Ext_key) of the survivor
+        :param duplicates: list of dict(rid, class_name, hashkey, Ext_key)
+        :param edges: (edge class, out rid, in rid) of every edge touching the chunk
+        :param stats:
+        :return:
+        """
+        group = set([node_A["rid"]] + [n["rid"] for n in duplicates])
+        merged = set([n["rid"] for n in duplicates])
+        existing = set()
+        new = {}
+        for edge_class, source, target in edges:
+            if source == node_A["rid"]:
+                existing.add((edge_class, "out", target))
+            if target == node_A["rid"]:
+                existing.add((edge_class, "in", source))
+        for edge_class, source, target in edges:
+            if source in merged and target not in group:
+                rel = (edge_class, "out", target)
+            elif target in merged and source not in group:
+                rel = (edge_class, "in", source)
+            else:
+                continue
+            if rel in existing or rel in new:
+                stats["edges_skipped"] += 1
+            else:
+                new[rel] = True
+        by_direction = {}
+        for edge_class, direction, other in new:
+            by_direction.setdefault((edge_class, direction), []).append(other)
+        hashkey = ",".join([h for h in [node_A["hashkey"]] + [n["hashkey"] for n in duplicates] if h])
+        script = "begin;\n"
+        for (edge_class, direction), others in by_direction.items():
+            if direction == "out":
+                script += "create edge %s from %s to [%s];\n" % (edge_class, node_A["rid"], ", ".join(others))
+            else:
+                script += "create edge %s from [%s] to %s;\n" % (edge_class, ", ".join(others), node_A["rid"])
+        script += "update %s set hashkey = '%s';\n" % (node_A["rid"], hashkey)
+        for n in duplicates:
+            script += "delete vertex %s;\n" % n["rid"]
+        script += "commit retry 10;"
+        try:
+            self.client.batch(script)
+        except Exception as e:
+            stats["failed"] += 1
+            click.echo('[%s_%s_merge_node_groups] Error merging into %s: %s\n%s' % (
+                get_datetime(), self.db_name, node_A["rid"], str(e), script))
+            return
+        stats["groups"] += 1
+        stats["merged"] += len(duplicates)
+        stats["edges_rewired"] += len(new)
+        # Resolve every hashkey of the group to the survivor from now on so a new duplicate is matched to it
+        self.hashkey_cache.add(node_A["class_name"], hashkey, node_A["rid"])
+        self.forget_nodes(duplicates, replacement=node_A["rid"])
+        self.result_cache.invalidate("E", node_A["class_name"], *(
+            [n["class_name"] for n in duplicates] + [c for c, d in by_direction]))
+
     def key_comparison(self, keys):
         """
         Using the keys from a node, check the Databases models for the one with the most similar keys to
@@ -1095,34 +2013,57 @@ class ODB:
 
         return search_items
 
+    def get_case_version(self, case_key):
+        """
+        Read what changes on a case when it is saved, the LastUpdate and the number of relations, to tell whether a
+        cached case graph is still current
+        :param case_key:
+        :return: str or None if the case was not found
+        """
+        r = self.client.command("select LastUpdate, both().size() as degree from %s" % case_key)
+        if len(r) == 0:
+            return None
+        return "%s_%s" % (r[0].oRecordData.get("LastUpdate"), r[0].oRecordData.get("degree"))
+
     def load_graph(self, graph_key):
         """
         Get a graph which is based on a saved Case and it's neighbors and those neighbors relations to each other
-        For each node in the case, get neighbors. Filter out any neighbor not in the case nodes
+        QUERY 1 Traverses the case for the case, its neighbors and the case relations
+        QUERY 2 Matches the relations between the case neighbors in one query rather than traversing each neighbor
+        Only one relation is kept per ordered pair of nodes. The graph is cached until the case is saved again.
         :param graph_key:
         :return:
         """
+        version = self.get_case_version(graph_key)
+        case_graph = self.case_cache.get(graph_key, version)
+        if case_graph:
+            return case_graph
         graph = self.get_neighbors_index(graph_key)
-        case_graph = {"nodes": [], "lines": graph["data"]["lines"], "index": []}
-        for n in graph["data"]["nodes"]:
-            case_graph["nodes"].append(n)
+        case_graph = {"nodes": graph["data"]["nodes"], "lines": graph["data"]["lines"], "index": []}
+        node_keys = set()
+        pairs = set()
+        for n in case_graph["nodes"]:
             case_graph["index"].append(n["key"])
-        for n in graph["data"]["lines"]:
-            case_graph["index"].append("%s%s" % (n["to"], n["from"]))
+            node_keys.add(n["key"])
+        for l in case_graph["lines"]:
+            case_graph["index"].append("%s%s" % (l["to"], l["from"]))
+            pairs.add("%s%s" % (l["to"], l["from"]))
         # Get the relationships of each case node that relates to another case node
-        for n in graph["data"]["nodes"]:
-            s_graph = self.get_neighbors_index(n["key"])
-            for l in s_graph["data"]["lines"]:
-                if l["to"] == n["key"]:
-                    if l["from"] in case_graph["index"]:
-                        if "%s%s" % (l["to"], l["from"]) not in case_graph["index"]:
-                            case_graph["lines"].append(l)
-                            case_graph["index"].append("%s%s" % (l["to"], l["from"]))
-                if l["from"] == n["key"]:
-                    if l["to"] in case_graph["index"]:
-                        if "%s%s" % (l["to"], l["from"]) not in case_graph["index"]:
-                            case_graph["lines"].append(l)
-                            case_graph["index"].append("%s%s" % (l["to"], l["from"]))
+        sql = ('''
+        match
+        {class:Case, as:c, where: (@rid = %s)}.both(){as:v1}.outE(){as:e}.inV(){as:v2},
+        {as:c}.both(){as:v2}
+        return v1.@rid as from_key, v2.@rid as to_key, e.@class as description
+        ''' % graph_key)
+        for rel in self.client.command(sql):
+            rel = rel.oRecordData
+            l = {"description": rel['description'], "from": rel['from_key'].get_hash(), "to": rel['to_key'].get_hash()}
+            pair = "%s%s" % (l["to"], l["from"])
+            if l["from"] in node_keys and l["to"] in node_keys and pair not in pairs:
+                case_graph["lines"].append(l)
+                case_graph["index"].append(pair)
+                pairs.add(pair)
+        self.case_cache.put(graph_key, version, case_graph)
 
         return case_graph
 
@@ -1360,6 +2301,7 @@ class ODB:
                 message = "No new data received. Case %s is up to date." % clean(kwargs["graphName"])
             else:
                 message = "%s with %d nodes and %d edges." % (message, newNodes, newLines)
+        self.case_cache.invalidate(case_key)
         click.echo('[%s_%s] %s' % (get_datetime(), "home_save", message))
         return graph, message
 
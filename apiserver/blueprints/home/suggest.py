@@ -0,0 +1,240 @@
+"""
+In process typeahead index of node names. For each class the titles and Ext_keys of the nodes are split into lower
+case words and kept, with the whole name, in a sorted array of (token, rid) so the nodes with a word starting with
+what is being typed are found by binary search. The index is filled from the database in the background and kept up
+to date by create_node within the worker. Names added since the last merge are kept in a second, short sorted run
+which is searched alongside the main one and only merged into it once it grows past the square root of its size, so
+neither inserts nor searches pay for re-sorting the whole class. Tokens of renamed or deleted nodes are skipped by
+search and only dropped when they make up a large enough share of the class.
+"""
+import re
+import heapq
+import bisect
+import threading
+from apiserver.utils import SUGGEST_LIMIT_PER_CLASS
+
+WORD = re.compile(r"\w+")
+# Smallest pending run merged into the entries and the share of stale entries at which they are dropped
+PENDING_MIN = 256
+STALE_RATIO = .25
+
+
+def name_tokens(name):
+    """
+    The normalized name followed by each of its words
+    :param name:
+    :return: list of str
+    """
+    name = " ".join(str(name).lower().split())
+    if not name:
+        return []
+    tokens = [name]
+    for w in WORD.findall(name):
+        if w != name:
+            tokens.append(w)
+    return tokens
+
+
+class PrefixIndex:
+    """
+    Sorted (token, rid) arrays of one class, the entries and the short run of pending additions, with the name and
+    tokens of every rid. An entry whose token is no longer among the tokens of its rid is stale.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.pending = []
+        self.names = {}
+        self.stale = 0
+
+    def add(self, rid, name, alias=None):
+        tokens = name_tokens(name)
+        if alias is not None and str(alias) != str(name):
+            tokens.extend([t for t in name_tokens(alias) if t not in tokens])
+        if not tokens:
+            return
+        if rid in self.names:
+            self.stale += len(self.names[rid][1])
+        self.names[rid] = (str(name), tokens)
+        for t in tokens:
+            bisect.insort(self.pending, (t, rid))
+        if len(self.pending) > max(PENDING_MIN, len(self.entries) ** .5):
+            self.merge()
+
+    def discard(self, rid):
+        # The entries of the rid are skipped by search and dropped once enough entries are stale
+        if rid not in self.names:
+            return False
+        self.stale += len(self.names.pop(rid)[1])
+        if self.stale > STALE_RATIO * (len(self.entries) + len(self.pending)):
+            self.merge()
+        return True
+
+    def current(self, entry):
+        token, rid = entry
+        return rid in self.names and token in self.names[rid][1]
+
+    def merge(self):
+        # Both runs are sorted which timsort merges in linear time
+        entries = sorted(self.entries + self.pending)
+        self.pending = []
+        if self.stale > STALE_RATIO * len(entries):
+            entries = [e for i, e in enumerate(entries) if self.current(e) and (i == 0 or e != entries[i - 1])]
+            self.stale = 0
+        self.entries = entries
+
+    def run(self, entries, lookup):
+        # The entries of a sorted run from the first token starting with lookup
+        i = bisect.bisect_left(entries, (lookup,))
+        while i < len(entries) and entries[i][0].startswith(lookup):
+            yield entries[i]
+            i += 1
+
+    def search(self, terms, limit):
+        """
+        Nodes with a token starting with each of the terms. The longest term is looked up and the others are checked
+        against the tokens of each candidate.
+        :param terms: list of lower case terms
+        :param limit:
+        :return: list of (rid, name)
+        """
+        lookup = max(terms, key=len)
+        others = [t for t in terms if t is not lookup]
+        results = []
+        found = set()
+        for token, rid in heapq.merge(self.run(self.entries, lookup), self.run(self.pending, lookup)):
+            if len(results) >= limit:
+                break
+            if rid in found or not self.current((token, rid)):
+                continue
+            name, tokens = self.names[rid]
+            if all(any(tk.startswith(t) for tk in tokens) for t in others):
+                found.add(rid)
+                results.append((rid, name))
+        return results
+
+    def __len__(self):
+        return len(self.names)
+
+
+class SuggestionIndex:
+    """
+    PrefixIndex per class of a database
+        suggestions = get_suggestion_index("OSINT")
+        suggestions.add("Vulnerability", "#25:1", "Buffer overflow in ...", "CVE-2019-0001")
+        suggestions.search("cve 2019")
+    """
+
+    def __init__(self, limit_per_class=SUGGEST_LIMIT_PER_CLASS):
+        self.limit_per_class = limit_per_class
+        self.lock = threading.Lock()
+        self.classes = {}
+        self.warmed = set()
+        self.truncated = set()
+        self.stats = {"searches": 0, "empty": 0, "inserts": 0}
+
+    def add(self, class_name, rid, title, ext_key=None):
+        """
+        Index a node under its title, or Ext_key where it has no title, and its Ext_key
+        :param class_name:
+        :param rid:
+        :param title:
+        :param ext_key:
+        :return:
+        """
+        name = title if title not in [None, ""] else ext_key
+        if not rid or name in [None, ""]:
+            return
+        with self.lock:
+            if class_name not in self.classes:
+                self.classes[class_name] = PrefixIndex()
+            self.classes[class_name].add(str(rid), name, ext_key)
+            self.stats["inserts"] += 1
+
+    def discard(self, rid):
+        with self.lock:
+            for c in self.classes:
+                self.classes[c].discard(str(rid))
+
+    def clear(self):
+        with self.lock:
+            self.classes = {}
+            self.warmed = set()
+            self.truncated = set()
+
+    def warm(self, class_name, rows, complete=True):
+        """
+        Fill a class from (rid, title, Ext_key) read from the database
+        :param class_name:
+        :param rows:
+        :param complete: False when only part of the class was read
+        :return: number of nodes loaded
+        """
+        i = 0
+        for rid, title, ext_key in rows:
+            self.add(class_name, rid, title, ext_key)
+            i += 1
+        with self.lock:
+            self.stats["inserts"] -= i
+            self.warmed.add(class_name)
+            if complete:
+                self.truncated.discard(class_name)
+            else:
+                self.truncated.add(class_name)
+        return i
+
+    def incomplete(self, items, class_names):
+        """
+        The classes whose suggestions may be missing nodes the database would match: those not warmed yet and those
+        only partly warmed with fewer than limit_per_class suggestions in items
+        :param items: list of dict as returned by search
+        :param class_names:
+        :return: list of class names
+        """
+        counts = {}
+        for item in items:
+            counts[item["NODE_TYPE"]] = counts.get(item["NODE_TYPE"], 0) + 1
+        with self.lock:
+            return [c for c in class_names if c not in self.warmed or (
+                c in self.truncated and counts.get(c, 0) < self.limit_per_class)]
+
+    def search(self, searchterms, class_names=None):
+        """
+        Suggestions in the form returned by get_suggestion_items for every class, limit_per_class each
+        :param searchterms: str as typed
+        :param class_names: optional list of classes to search
+        :return: list of dict(NODE_KEY, NODE_TYPE, NODE_NAME)
+        """
+        terms = [t.lower() for t in WORD.findall(str(searchterms))]
+        if not terms:
+            return []
+        items = []
+        with self.lock:
+            self.stats["searches"] += 1
+            for c in class_names or sorted(self.classes):
+                if c in self.classes:
+                    for rid, name in self.classes[c].search(terms, self.limit_per_class):
+                        items.append({"NODE_KEY": rid, "NODE_TYPE": c, "NODE_NAME": name})
+            if not items:
+                self.stats["empty"] += 1
+        return items
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = sum(len(self.classes[c]) for c in self.classes)
+            stats["warmed"] = sorted(self.warmed)
+            stats["truncated"] = sorted(self.truncated)
+        return stats
+
+
+# One index per database so every client of a worker adds to and searches the same names
+suggestion_indexes = {}
+suggestion_indexes_lock = threading.Lock()
+
+
+def get_suggestion_index(db_name):
+    with suggestion_indexes_lock:
+        if db_name not in suggestion_indexes:
+            suggestion_indexes[db_name] = SuggestionIndex()
+        return suggestion_indexes[db_name]
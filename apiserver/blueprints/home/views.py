@@ -5,17 +5,15 @@ Base routes used for accessing the databases
 import json
 from flask import jsonify, Blueprint, send_file, request, render_template
 from apiserver.blueprints.home.models import ODB
+from apiserver.blueprints.home.lazy import LazyServer, get_health
 from apiserver.utils import get_request_payload, check_for_file, get_datetime
 import click
 
 # Application Route specific object instantiation
 home = Blueprint('home', __name__)
-# Case where no DB has been established from which the message returned should let the user know to run the setup API
+# The client opens the DB on first use. Where no DB has been established the state is setup_required until db_init
 
-odbserver = ODB()
-init_required = odbserver.open_db()
-if init_required:
-    click.echo("[%s_Home_init] Setup required" % get_datetime())
+odbserver = LazyServer("Home", ODB, setup=lambda s: s.open_db(), background=lambda s: s.warm_hashkey_cache())
 
 
 @home.route('/home/db_init', methods=['GET'])
@@ -25,12 +23,29 @@ def db_init():
     :return:
     """
     result = odbserver.create_db()
+    odbserver._reset()
     return jsonify({
         "status": 200,
         "message": result
     })
 
 
+@home.route('/health', methods=['GET'])
+def health():
+    """
+    Readiness of the database clients of every blueprint. Checking health starts any client that has not been used
+    yet without waiting for it.
+    :return:
+    """
+    r = get_health()
+    status = 200 if r["ready"] else 503
+    return jsonify({
+        "status": status,
+        "message": "Ready" if r["ready"] else "Starting",
+        "data": r
+    }), status
+
+
 @home.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == "GET":
@@ -90,7 +105,7 @@ def graph_etl_model():
         if "file" in request.form.to_dict().keys():
             graph = odbserver.graph_etl_model(
                 json.loads(request.form.to_dict()['model']),
-                odbserver.file_to_frame(request.form.to_dict()["file"])["data"])
+                request.form.to_dict()["file"])
         elif "file" in r.keys() and "model" in r.keys():
             graph = odbserver.graph_etl_model(r["model"], r["file"])
         else:
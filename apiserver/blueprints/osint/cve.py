@@ -0,0 +1,218 @@
+"""
+Streaming pieces of the MITRE CVE import run by OSINT.graph_cve. The bulk allitems.csv is downloaded to disk in chunks
+and read back with the csv module one row at a time, so quoted commas and line breaks within descriptions are kept,
+while the bytes read give the progress and ETA of the import. References are shared by many CVEs and are only created
+the first time they are seen in the file, which is tracked with 64 bit hashes of the reference strings rather than
+the strings themselves. The index is kept by each worker across imports and is filled from the database with one scan
+of the reference Objects before the first import. Each import also keeps a fingerprint of every CVE row so the next
+import only writes the CVEs that are new or changed since.
+    <datapath>/index/<db>/cve_fingerprints.npz   sorted 64 bit hashes of the CVE names and the fingerprints of the rows
+"""
+import os
+import csv
+import time
+import click
+import requests
+import threading
+import numpy as np
+from apiserver.utils import get_datetime
+from apiserver.blueprints.osint.snapshot import key_hash, split_rid
+
+CVE_URL = "https://cve.mitre.org/data/downloads/allitems.csv"
+
+
+def download_file(url, path, chunk_size=1 << 20):
+    """
+    Stream a url to path unless it was already downloaded. The file is written under a temporary name and moved into
+    place once complete so a failed download is not mistaken for the day's file.
+    :param url:
+    :param path:
+    :param chunk_size:
+    :return: True if the file was downloaded
+    """
+    if os.path.exists(path):
+        click.echo("[%s_OSINT_download_file] Latest data exists. No need to download" % get_datetime())
+        return False
+    click.echo('[%s_OSINT_download_file] Getting %s' % (get_datetime(), url))
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(tmp, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    os.replace(tmp, path)
+    return True
+
+
+class ReadProgress:
+    """
+    Progress of a streamed import measured in bytes of a file, or rows of a DataFrame, with the row rate and ETA
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.rows = 0
+        self.started = time.time()
+
+    def lines(self, f):
+        # Count the bytes of each line as it is handed to the csv reader
+        for line in f:
+            self.done += len(line)
+            yield line.decode("utf8", errors="ignore")
+
+    def fraction(self):
+        return min(1.0, self.done / self.total) if self.total else 0.0
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.rows / elapsed if elapsed else 0.0
+
+    def eta(self):
+        fraction = self.fraction()
+        return (time.time() - self.started) * (1 - fraction) / fraction if fraction else None
+
+    def summary(self):
+        eta = self.eta()
+        return "%d rows at %.0f rows/s, %.1f percent, ETA %s" % (
+            self.rows, self.rate(), self.fraction() * 100, "%ds" % eta if eta is not None else "unknown")
+
+
+def read_cve_rows(path, progress=None):
+    """
+    Yield each CVE of the MITRE csv as a dict of its columns. The notes above the header row are skipped.
+    :param path:
+    :param progress: optional ReadProgress of the file size
+    :return: generator of dict(Name, Status, Description, References, Phase, Votes, Comments)
+    """
+    progress = progress or ReadProgress(os.path.getsize(path))
+    header = None
+    with open(path, 'rb') as f:
+        for row in csv.reader(progress.lines(f)):
+            if not row:
+                continue
+            name = row[0].strip().strip('"')
+            if header is None:
+                if name == "Name":
+                    header = [h.strip().strip('"') for h in row]
+                continue
+            if name[:4] == "CVE-":
+                progress.rows += 1
+                yield dict(zip(header, row))
+
+
+def read_frame_rows(df, progress=None):
+    """
+    Yield the rows of a DataFrame holding the csv columns as dicts, counting them on the progress
+    :param df:
+    :param progress:
+    :return:
+    """
+    progress = progress or ReadProgress(df.shape[0])
+    for row in df.to_dict("records"):
+        progress.rows += 1
+        progress.done += 1
+        yield row
+
+
+def split_references(references):
+    return [r.strip() for r in str(references or "").split("|") if r.strip()]
+
+
+def cve_fingerprint(row):
+    """
+    64 bit hash of every column of a CVE row, so a change of status, description, votes or references is noticed
+    :param row: dict of the csv columns
+    :return: int
+    """
+    return key_hash("\x1f".join(["%s=%s" % (k, row[k] if row[k] is not None else "") for k in sorted(row)]))
+
+
+class CVEFingerprints:
+    """
+    Fingerprint of each CVE row as of the last import, keyed by the hash of the CVE name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.prints = {}
+        self.loaded = 0
+
+    def load(self):
+        try:
+            with np.load(self.path) as f:
+                self.prints = dict(zip(f["names"].tolist(), f["prints"].tolist()))
+        except (OSError, ValueError, KeyError):
+            self.prints = {}
+        self.loaded = len(self.prints)
+        return self
+
+    def get(self, name):
+        return self.prints.get(key_hash(name))
+
+    def set(self, name, fingerprint):
+        self.prints[key_hash(name)] = fingerprint
+
+    def save(self):
+        names = np.fromiter(self.prints.keys(), dtype="<u8", count=len(self.prints))
+        prints = np.fromiter(self.prints.values(), dtype="<u8", count=len(self.prints))
+        order = np.argsort(names)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, names=names[order], prints=prints[order])
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.prints)
+
+
+class ReferenceIndex:
+    """
+    RIDs of the reference nodes of a database, keyed by the 64 bit hash of the reference with the RID packed into a
+    single int. Shared by the threads of an import.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rids = {}
+        self.warmed = False
+
+    def add(self, reference, rid):
+        cluster, position = split_rid(rid)
+        with self.lock:
+            self.rids[key_hash(reference)] = cluster << 40 | position
+
+    def get(self, reference):
+        packed = self.rids.get(key_hash(reference))
+        return "#%d:%d" % (packed >> 40, packed & ((1 << 40) - 1)) if packed is not None else None
+
+    def warm(self, pairs):
+        """
+        Fill from (Ext_key, rid) pairs of the reference Objects in the database
+        :param pairs:
+        :return: number of references loaded
+        """
+        i = 0
+        for reference, rid in pairs:
+            self.add(reference, rid)
+            i += 1
+        self.warmed = True
+        return i
+
+    def __contains__(self, reference):
+        return key_hash(reference) in self.rids
+
+    def __len__(self):
+        return len(self.rids)
+
+
+reference_indexes = {}
+reference_indexes_lock = threading.Lock()
+
+
+def get_reference_index(db_name):
+    with reference_indexes_lock:
+        if db_name not in reference_indexes:
+            reference_indexes[db_name] = ReferenceIndex()
+        return reference_indexes[db_name]
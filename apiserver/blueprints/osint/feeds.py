@@ -0,0 +1,176 @@
+"""
+STIX 2 bundle feeds ingested by OSINT.import_feeds. A feed is either a url, downloaded each run, or a directory of
+bundle files, so a local stand-in for a TAXII server is a directory bundles are dropped into or the same directory
+served with "python -m http.server". Each file of a feed keeps the latest modified timestamp of the objects written
+from it as its high-water mark and only objects modified after it are written when the file is read again, so a new
+file is read in full whatever the timestamps of its objects. The files of a directory feed that are unchanged since
+the last run aren't read again. A file with objects that failed to be written keeps its mark and signature so it is
+read again on the next run. The marks, file signatures and throughput of the last run and all runs of each feed are
+kept in a state file of the database, removed when the database is created again.
+    <datapath>/feeds.json               list of dict(name, url or path), the default feeds when missing
+    <datapath>/feeds/<name>.json        the last download of a url feed
+    <datapath>/feeds/local              directory of the default local feed
+    <datapath>/index/<db>/feeds.json    dict of feed name to dict(modified, marks, files, last, totals)
+"""
+import os
+import json
+import time
+import click
+import threading
+from apiserver.utils import get_datetime
+from apiserver.blueprints.osint.cve import download_file
+
+POISONIVY_URL = 'https://oasis-open.github.io/cti-documentation/examples/example_json/poisonivy.json'
+
+
+class Feed:
+    """
+    A url or directory of STIX bundles
+    """
+
+    def __init__(self, name, url=None, path=None):
+        if not url and not path:
+            raise ValueError("Feed %s needs a url or a path" % name)
+        self.name = name
+        self.url = url
+        self.path = path
+
+    def sources(self, datapath, files=None):
+        """
+        The bundle files to read this run. A url is downloaded again and a directory lists the json files not in files
+        with the same size and modification time.
+        :param datapath:
+        :param files: dict of file name to [size, mtime] as of the last run
+        :return: list of (path, [size, mtime])
+        """
+        files = files or {}
+        if self.url:
+            path = os.path.join(datapath, "feeds", "%s.json" % self.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            download_file(self.url, path)
+            return [(path, None)]
+        if os.path.isfile(self.path):
+            names = [self.path]
+        elif os.path.isdir(self.path):
+            names = [os.path.join(self.path, f) for f in sorted(os.listdir(self.path)) if f.endswith(".json")]
+        else:
+            click.echo('[%s_OSINT_feed_sources] %s is not a file or directory' % (get_datetime(), self.path))
+            return []
+        sources = []
+        for path in names:
+            st = os.stat(path)
+            signature = [st.st_size, st.st_mtime]
+            if files.get(os.path.basename(path)) != signature:
+                sources.append((path, signature))
+        return sources
+
+    def to_dict(self):
+        return {"name": self.name, "url": self.url, "path": self.path}
+
+
+def load_feeds(datapath):
+    """
+    The feeds configured in <datapath>/feeds.json, or the poisonivy example and the local directory
+    :param datapath:
+    :return: list of Feed
+    """
+    try:
+        with open(os.path.join(datapath, "feeds.json")) as f:
+            return [Feed(c["name"], url=c.get("url"), path=c.get("path")) for c in json.load(f)]
+    except (OSError, ValueError, KeyError):
+        return [Feed("poisonivy", url=POISONIVY_URL), Feed("local", path=os.path.join(datapath, "feeds", "local"))]
+
+
+class FeedMetrics:
+    """
+    Counts and throughput of one run of a feed
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counts = {"files": 0, "bytes": 0, "objects": 0, "new": 0, "old": 0, "entities": 0, "edges": 0,
+                       "missing": 0, "skipped": 0, "failed": 0, "errors": 0}
+
+    def add(self, stats):
+        for k in stats:
+            if k in self.counts:
+                self.counts[k] += stats[k]
+
+    def summary(self):
+        seconds = time.time() - self.started
+        summary = dict(self.counts)
+        summary["started"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))
+        summary["seconds"] = round(seconds, 3)
+        summary["objects_per_second"] = round(self.counts["objects"] / seconds, 1) if seconds else 0.0
+        summary["new_per_second"] = round(self.counts["new"] / seconds, 1) if seconds else 0.0
+        summary["mb_per_second"] = round(self.counts["bytes"] / seconds / (1 << 20), 3) if seconds else 0.0
+        return summary
+
+
+class FeedState:
+    """
+    High-water marks and signatures of the files of each feed and its metrics, shared by the workers through the state
+    file. The modified of a feed is the latest of its marks.
+        state = FeedState(os.path.join(datapath, "index", "OSINT", "feeds.json")).load()
+        state.mark("poisonivy", "poisonivy.json")  # "2016-05-12T08:17:27.000000Z" or None
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.feeds = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.feeds = json.load(f)
+        except (OSError, ValueError):
+            self.feeds = {}
+        return self
+
+    def get(self, name):
+        feed = self.feeds.setdefault(name, {"modified": None, "files": {}, "last": None, "totals": {"runs": 0}})
+        feed.setdefault("marks", {})
+        return feed
+
+    def mark(self, name, source):
+        """
+        The mark of a file of a feed
+        :param name:
+        :param source: base name of the file
+        :return: STIX timestamp or None if no object of the file was written yet
+        """
+        return self.get(name)["marks"].get(source)
+
+    def update(self, name, marks, files, metrics):
+        """
+        Move the marks of the files of a feed forward and record the run
+        :param name:
+        :param marks: dict of file name to the latest STIX timestamp written from the file
+        :param files: dict of file name to [size, mtime] of the files read in full
+        :param metrics: FeedMetrics
+        :return:
+        """
+        with self.lock:
+            feed = self.get(name)
+            for source, modified in marks.items():
+                if modified and (not feed["marks"].get(source) or modified > feed["marks"][source]):
+                    feed["marks"][source] = modified
+                if modified and (not feed["modified"] or modified > feed["modified"]):
+                    feed["modified"] = modified
+            feed["files"].update(files)
+            feed["last"] = metrics.summary()
+            feed["totals"]["runs"] += 1
+            for k in metrics.counts:
+                feed["totals"][k] = feed["totals"].get(k, 0) + metrics.counts[k]
+            feed["totals"]["seconds"] = round(feed["totals"].get("seconds", 0) + feed["last"]["seconds"], 3)
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self.feeds, f)
+            os.replace(tmp, self.path)
@@ -0,0 +1,211 @@
+"""
+Offline geocoder built on the cities of data/Locations.json. Names are normalized (accents, case and punctuation
+removed) and looked up in a dictionary of city and "city country" names, so the free text locations of profiles such
+as "Paris, France" or "london uk" resolve without a remote call. The cities are also kept sorted by latitude for
+nearest and reverse lookups: a search walks out from the latitude of the point and stops once the latitude difference
+alone is further than the cities already found.
+"""
+import os
+import re
+import json
+import math
+import bisect
+import threading
+import unicodedata
+import click
+from apiserver.utils import get_datetime, GAZETTEER_MAX_KM
+
+EARTH_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_KM / 180
+SEPARATORS = re.compile(r"[,/|;()]| - ")
+# Country names as they are commonly written in profiles mapped to the names used in Locations.json
+COUNTRY_ALIASES = {
+    "usa": "united states of america", "us": "united states of america", "united states": "united states of america",
+    "america": "united states of america", "uk": "united kingdom", "great britain": "united kingdom",
+    "gb": "united kingdom", "england": "united kingdom", "scotland": "united kingdom", "wales": "united kingdom",
+    "uae": "united arab emirates", "hong kong": "hong kong s a r", "macau": "macau s a r"
+}
+
+
+def normalize_place(name):
+    """
+    Lower case ascii words of a place name separated by single spaces
+    :param name:
+    :return:
+    """
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join([c for c in name if not unicodedata.combining(c)]).lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name).split())
+
+
+def repair_text(text):
+    """
+    Some names in Locations.json are utf8 that was read as latin-1, such as "ZÃ¼rich", which are decoded again
+    :param text:
+    :return:
+    """
+    try:
+        return text.encode("latin-1").decode("utf8")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return text
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Place:
+    """
+    A city of the gazetteer. Has the latitude, longitude, address and raw attributes of a geopy location so it can be
+    used wherever a Nominatim result is.
+    """
+    __slots__ = ["key", "city", "country", "latitude", "longitude", "pop", "address", "raw"]
+
+    def __init__(self, key, city, country, latitude, longitude, pop):
+        self.key = key
+        self.city = city
+        self.country = country
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.pop = int(pop or 0)
+        self.address = "%s, %s" % (city, country)
+        self.raw = {"type": "city", "pop": self.pop, "country": country}
+
+
+class Gazetteer:
+    """
+    Name and nearest lookups over the cities of Locations.json, loaded on first use
+        gazetteer = get_gazetteer(os.path.join(datapath, "Locations.json"))
+        gazetteer.lookup("Balkh, Afghanistan")  # Place
+        gazetteer.reverse(36.7, 66.9)  # Place within GAZETTEER_MAX_KM or None
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.names = {}
+        self.countries = set()
+        self.latitudes = []
+        self.places = []
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            places = []
+            try:
+                with open(self.path, encoding="utf8") as f:
+                    for loc in json.load(f):
+                        attributes = {a["label"]: a["value"] for a in loc["attributes"]}
+                        places.append(Place(loc["key"], repair_text(attributes["city"]), attributes["country"],
+                                            attributes["Latitude"], attributes["Longitude"], attributes.get("pop")))
+            except (OSError, ValueError, KeyError) as e:
+                click.echo('[%s_Gazetteer_load] Could not load %s: %s' % (get_datetime(), self.path, str(e)))
+            # Most populous first so an ambiguous name resolves to the largest city
+            places.sort(key=lambda p: -p.pop)
+            for p in places:
+                country = normalize_place(p.country)
+                self.countries.add(country)
+                for name in [normalize_place(p.city), "%s %s" % (normalize_place(p.city), country)]:
+                    self.names.setdefault(name, []).append(p)
+            places.sort(key=lambda p: p.latitude)
+            self.places = places
+            self.latitudes = [p.latitude for p in places]
+            self.loaded = True
+            click.echo('[%s_Gazetteer_load] Loaded %d places' % (get_datetime(), len(places)))
+
+    def country_of(self, part):
+        part = COUNTRY_ALIASES.get(part, part)
+        return part if part in self.countries else None
+
+    def lookup(self, loc_string):
+        """
+        Find the city named in a free text location. The whole string is tried first, then each comma separated part
+        in order, preferring a city in the country named by another part or by the last words of the part itself as in
+        "london uk".
+        :param loc_string:
+        :return: Place or None
+        """
+        self.load()
+        name = normalize_place(loc_string)
+        if not name:
+            return None
+        if name in self.names:
+            return self.names[name][0]
+        parts = [normalize_place(p) for p in SEPARATORS.split(str(loc_string))]
+        parts = [p for p in parts if p]
+        countries = [c for c in [self.country_of(p) for p in parts] if c]
+        for j, part in enumerate(parts):
+            words = part.split()
+            for i in range(1, len(words)):
+                country = self.country_of(" ".join(words[i:]))
+                if country and part not in self.names:
+                    parts[j] = " ".join(words[:i])
+                    countries.append(country)
+                    break
+        for part in parts:
+            if part in self.names:
+                for p in self.names[part]:
+                    if not countries or normalize_place(p.country) in countries:
+                        return p
+                if not countries:
+                    return self.names[part][0]
+        return None
+
+    def nearest(self, latitude, longitude, k=1, max_km=None):
+        """
+        The k closest cities to a point
+        :param latitude:
+        :param longitude:
+        :param k:
+        :param max_km: optional limit on the distance
+        :return: list of (km, Place) closest first
+        """
+        self.load()
+        found = []
+        limit = max_km if max_km is not None else float("inf")
+        lo = bisect.bisect_left(self.latitudes, latitude)
+        hi = lo
+        while lo > 0 or hi < len(self.places):
+            # Take whichever side is closer in latitude, which bounds the distance of everything beyond it
+            below = latitude - self.latitudes[lo - 1] if lo > 0 else float("inf")
+            if hi >= len(self.places) or below <= self.latitudes[hi] - latitude:
+                lo -= 1
+                i = lo
+            else:
+                i = hi
+                hi += 1
+            bound = abs(self.latitudes[i] - latitude) * KM_PER_DEGREE
+            if bound > limit or (len(found) == k and bound > found[-1][0]):
+                break
+            km = haversine(latitude, longitude, self.places[i].latitude, self.places[i].longitude)
+            if km <= limit and (len(found) < k or km < found[-1][0]):
+                bisect.insort(found, (km, i))
+                del found[k:]
+        return [(km, self.places[i]) for km, i in found]
+
+    def reverse(self, latitude, longitude, max_km=GAZETTEER_MAX_KM):
+        """
+        The closest city to a point if there is one within max_km
+        :param latitude:
+        :param longitude:
+        :param max_km:
+        :return: Place or None
+        """
+        found = self.nearest(latitude, longitude, 1, max_km)
+        return found[0][1] if found else None
+
+
+gazetteers = {}
+gazetteers_lock = threading.Lock()
+
+
+def get_gazetteer(path):
+    with gazetteers_lock:
+        path = os.path.abspath(path)
+        if path not in gazetteers:
+            gazetteers[path] = Gazetteer(path)
+        return gazetteers[path]
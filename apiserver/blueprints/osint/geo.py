@@ -1,53 +1,88 @@
 from geopy.geocoders import Nominatim
 from apiserver.utils import get_datetime
+from apiserver.blueprints.osint.gazetteer import get_gazetteer
+from apiserver.blueprints.osint.locations import get_location_cache
+import os
 import time
 
 
+def location_cache(db):
+    return get_location_cache(os.path.join(db.datapath, "index"))
+
+
 def get_location(loc_string, db):
     """
     Look up a location based on a location string.
-    Use the get_location_by_description to first check the database
+    Strings resolved before, or found not to resolve, are answered by the location cache shared by the workers.
+    Then resolve the string to a city of the local gazetteer, in which case the Location node of the city is found
+    or created once.
+    Otherwise use the get_location_by_description to check the database
     If it doesn't exist then check Nominatim for Open Streets data
-    Use the lat long to check if the location exists by using get_location_by_latlon
+    A point within GAZETTEER_MAX_KM of a gazetteer city is reverse geocoded to the Location node of the city
+    Otherwise use the lat long to check if the location exists by using get_location_by_latlon
     Pass the loc_string so that if it exists, the loc_string can be added
     searched
     :param loc_string:
     :param db:
     :return:
     """
-    loc = get_location_by_description(loc_string, db)
+    cache = location_cache(db)
+    found, loc = cache.get(db.db_name, loc_string)
+    if found:
+        return loc
+    gazetteer = get_gazetteer(os.path.join(db.datapath, "Locations.json"))
+    place = gazetteer.lookup(loc_string)
+    if place:
+        loc = get_place_node(place, loc_string, db)
+        cache.put_node(db.db_name, loc_string, loc)
+        return loc
+    loc = get_location_by_description(loc_string, db, use_cache=False)
     if loc == None:
         geolocator = Nominatim(user_agent="osint")
         try:
             time.sleep(1)
             location = geolocator.geocode(loc_string)
             if location:
-                loc = get_location_by_latlon(location, loc_string, db)
+                place = gazetteer.reverse(location.latitude, location.longitude)
+                if place:
+                    loc = get_place_node(place, loc_string, db)
+                else:
+                    loc = get_location_by_latlon(location, loc_string, db)
             else:
                 loc = None
+            # Only a definite answer is kept, a failed call is tried again next time
+            cache.put_node(db.db_name, loc_string, loc)
         except Exception as e:
             loc = None
             if(str(e) == "Service timed out"):
                 pass
             else:
                 print(str(e))
+    else:
+        cache.put_node(db.db_name, loc_string, loc)
 
     return loc
 
 
-def get_location_by_description(description, db):
+def get_location_by_description(description, db, use_cache=True):
     """
     Look up a location in the database based only on its description. I
     :param description:
     :param db:
-    :return:
+    :param use_cache: check the location cache first, get_location already has
+    :return: node with the RID of the Location as its key
     """
+    if use_cache:
+        found, node = location_cache(db).get(db.db_name, description)
+        if found and node:
+            return node
     sql = ('''
-    select * from Location where description containstext '{val}'
+    select from Location where description containstext '{val}'
     ''').format( val=description)
     r = db.client.command(sql)
     if len(r) == 1:
         node = {"attributes": []}
+        rid = r[0]._rid
         r = r[0].oRecordData
         for i in r:
             if i in ["key", "title", "group", "icon"]:
@@ -56,41 +91,78 @@ def get_location_by_description(description, db):
                 node["attributes"].append(
                     {"label": i, "value": r[i]}
                 )
+        # Edges to the Location are created from its RID
+        node["key"] = rid
+        location_cache(db).put_node(db.db_name, description, node)
         return node
     else:
         return None
 
 
-def get_location_by_latlon(location, loc_string, db):
+def get_place_node(place, loc_string, db):
+    """
+    The Location node of a gazetteer city, looked up by its coordinates or created the first time the city is seen
+    :param place: gazetteer Place
+    :param loc_string:
+    :param db:
+    :return: node with the key of the Location
     """
+    cache = location_cache(db)
+    found, node = cache.get(db.db_name, "place:%s" % place.key)
+    if not node:
+        node = get_location_by_latlon(place, loc_string, db, title=place.address)
+        if node:
+            cache.put_node(db.db_name, "place:%s" % place.key, node)
+    return node
 
-    :param location:
+
+def get_location_by_latlon(location, loc_string, db, title=None):
+    """
+    Find the Location at the coordinates of a geocoded location, adding the loc_string to its description, or create it
+    :param location: geopy location or gazetteer Place
+    :param loc_string:
     :param db:
-    :return:
+    :param title: defaults to the loc_string
+    :return: node with the RID of the Location as its key
     """
+    cache = location_cache(db)
+    point = "latlon:%f,%f" % (location.latitude, location.longitude)
+    found, node = cache.get(db.db_name, point)
+    if node:
+        return node
     r = db.client.command('''
-    select key, class_name, Category, description, Latitude, Longitude, city,
+    select @rid as rid, key, class_name, Category, description, Latitude, Longitude, city,
      icon, title from Location where Latitude = %f and Longitude = %f
     ''' % (location.latitude, location.longitude))
 
     if len(r) == 0:
+        attributes = [
+            {"label": "Created", "value": get_datetime()},
+            {"label": "Latitude", "value": location.latitude},
+            {"label": "Longitude", "value": location.longitude},
+            {"label": "Category", "value": location.raw["type"]},
+            {"label": "description", "value": "%s %s" % (loc_string, location.address)},
+        ]
+        for label in ["importance", "pop", "country"]:
+            if label in location.raw:
+                attributes.append({"label": label, "value": location.raw[label]})
         node = db.create_node(**{
             "class_name": "Location",
-            "title": loc_string,
+            "title": title or loc_string,
             "icon": db.ICON_LOCATION,
             "group": "Locations",
-            "attributes": [
-                {"label": "Created", "value": get_datetime()},
-                {"label": "Latitude", "value": location.latitude},
-                {"label": "Longitude", "value": location.longitude},
-                {"label": "importance", "value": location.raw["importance"]},
-                {"label": "Category", "value": location.raw["type"]},
-                {"label": "description", "value": "%s %s" % (loc_string, location.address)},
-            ]
+            "attributes": attributes
         })
+        if type(node) != dict:
+            return None
+        cache.put_node(db.db_name, point, node["data"])
         return node["data"]
     else:
-        new_description = "%s %s" % (r[0].oRecordData["description"], loc_string)
-        db.update(class_name="Location", var="description", val=new_description, key=r[0].oRecordData["key"])
+        r = r[0].oRecordData
+        if loc_string not in str(r.get("description")):
+            new_description = "%s %s" % (r.get("description"), loc_string)
+            db.update(class_name="Location", var="description", val=new_description, key=r["rid"].get_hash())
         # update the location
-        return r
+        node = {"key": r["rid"].get_hash(), "title": r.get("title"), "icon": r.get("icon"), "group": "Locations"}
+        cache.put_node(db.db_name, point, node)
+        return node
@@ -0,0 +1,161 @@
+"""
+Location string to Location RID cache kept in a sqlite file next to the OSINT index snapshots so every worker, and the
+next ingest, reuses what was resolved before. Strings that could not be resolved are kept as negative entries with a
+shorter expiry so they are not sent to the database and Nominatim again on every tweet but are retried later. The
+entries of a Location that is deleted or merged are dropped or moved to the surviving Location by OSINT.forget_nodes.
+    <path>/locations.sqlite   table locations(db_name, loc_key, rid, title, updated)
+"""
+import os
+import time
+import click
+import sqlite3
+import threading
+from apiserver.utils import get_datetime, LOCATION_CACHE_TTL, LOCATION_NEGATIVE_TTL
+from apiserver.blueprints.osint.gazetteer import normalize_place
+
+
+class LocationCache:
+    """
+    Persistent mapping of normalized location strings, gazetteer cities and coordinates to Location nodes of a database
+        cache = get_location_cache(os.path.join(datapath, "index"))
+        cache.put("OSINT", "London", "#30:1", "London, United Kingdom")
+        cache.get("OSINT", "london ")  # (True, {"key": "#30:1", ...})
+        cache.put("OSINT", "somewhere over the rainbow", None)
+        cache.get("OSINT", "Somewhere over the rainbow")  # (True, None)
+    """
+
+    def __init__(self, path, ttl=LOCATION_CACHE_TTL, negative_ttl=LOCATION_NEGATIVE_TTL):
+        self.path = path
+        self.db_path = os.path.join(path, "locations.sqlite")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "negatives": 0, "misses": 0, "errors": 0}
+
+    def connection(self):
+        # sqlite connections can't be shared between threads or carried over a fork
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            os.makedirs(self.path, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS locations (
+                db_name TEXT, loc_key TEXT, rid TEXT, title TEXT, updated REAL, PRIMARY KEY (db_name, loc_key))
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS locations_rid ON locations (db_name, rid)")
+            conn.commit()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def key(loc_string):
+        # Place and point keys are already exact, normalizing would drop the sign of a coordinate
+        loc_string = str(loc_string)
+        return loc_string if loc_string.startswith(("place:", "latlon:")) else normalize_place(loc_string)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, db_name, loc_string):
+        """
+        Look up a location string, a "place:<key>" gazetteer city or a "latlon:<lat>,<lon>" point
+        :param db_name:
+        :param loc_string:
+        :return: (found, node) where node is None for a negative entry
+        """
+        key = self.key(loc_string)
+        if not key:
+            return False, None
+        try:
+            row = self.connection().execute(
+                "SELECT rid, title, updated FROM locations WHERE db_name = ? AND loc_key = ?", (db_name, key)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.count("errors")
+            click.echo('[%s_LocationCache_get] %s' % (get_datetime(), str(e)))
+            return False, None
+        if row and time.time() - row[2] < (self.ttl if row[0] else self.negative_ttl):
+            if row[0]:
+                self.count("hits")
+                return True, {"key": row[0], "title": row[1], "group": "Locations"}
+            self.count("negatives")
+            return True, None
+        self.count("misses")
+        return False, None
+
+    def put(self, db_name, loc_string, rid, title=None):
+        """
+        Record the Location RID a string resolved to, or None when it could not be resolved
+        :param db_name:
+        :param loc_string:
+        :param rid:
+        :param title:
+        :return:
+        """
+        key = self.key(loc_string)
+        if not key:
+            return
+        try:
+            conn = self.connection()
+            conn.execute("INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?)",
+                         (db_name, key, str(rid) if rid else None, title, time.time()))
+            conn.commit()
+        except sqlite3.Error as e:
+            self.count("errors")
+            click.echo('[%s_LocationCache_put] %s' % (get_datetime(), str(e)))
+
+    def put_node(self, db_name, loc_string, node):
+        """
+        Record the node returned by one of the geo lookups
+        :param db_name:
+        :param loc_string:
+        :param node: dict with the RID as key, or None
+        :return:
+        """
+        if node and str(node.get("key", "")).startswith("#"):
+            self.put(db_name, loc_string, node["key"], node.get("title"))
+        elif node is None:
+            self.put(db_name, loc_string, None)
+
+    def replace_rids(self, db_name, rids, replacement=None):
+        """
+        Point the entries of deleted Locations at the Location they were merged into, or drop them
+        :param db_name:
+        :param rids: RIDs of the deleted Locations
+        :param replacement: optional RID of the surviving Location
+        :return:
+        """
+        rids = [str(r) for r in rids]
+        if not rids:
+            return
+        try:
+            conn = self.connection()
+            marks = ", ".join(["?"] * len(rids))
+            if replacement:
+                conn.execute("UPDATE locations SET rid = ? WHERE db_name = ? AND rid IN (%s)" % marks,
+                             [str(replacement), db_name] + rids)
+            else:
+                conn.execute("DELETE FROM locations WHERE db_name = ? AND rid IN (%s)" % marks, [db_name] + rids)
+            conn.commit()
+        except sqlite3.Error as e:
+            self.count("errors")
+            click.echo('[%s_LocationCache_replace_rids] %s' % (get_datetime(), str(e)))
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+location_caches = {}
+location_caches_lock = threading.Lock()
+
+
+def get_location_cache(path):
+    with location_caches_lock:
+        if path not in location_caches:
+            location_caches[path] = LocationCache(path)
+        return location_caches[path]
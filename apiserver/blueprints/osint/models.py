@@ -1,14 +1,25 @@
 import click, os
 import requests, json, random
 import pandas as pd
-import codecs
 import time
-import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from OTXv2 import OTXv2
 from apiserver.models import OSINTModel as Models
-from apiserver.utils import get_datetime, clean, change_if_date, TWITTER_AUTH, randomString
+from apiserver.utils import get_datetime, clean, clean_concat, change_if_date, TWITTER_AUTH, randomString, \
+    MERGE_MONITOR_BATCH, MERGE_MONITOR_INTERVAL, CVE_BATCH_SIZE, CVE_REFERENCE_WORKERS, STIX_BATCH_SIZE, \
+    FEED_MONITOR_INTERVAL
 from apiserver.blueprints.home.models import ODB
+from apiserver.hashing import hash_attributes
+from apiserver.blueprints.home.jobs import get_job_queue
+from apiserver.blueprints.osint.snapshot import get_shared_index
 from apiserver.blueprints.osint.geo import get_location
+from apiserver.blueprints.osint.locations import get_location_cache
+from apiserver.blueprints.osint.cve import CVE_URL, download_file, ReadProgress, read_cve_rows, read_frame_rows, \
+    split_references, get_reference_index, CVEFingerprints, cve_fingerprint
+from apiserver.blueprints.osint.stix import StixReader, SKIPPED_TYPES, select_objects, count_written, stix_node, \
+    stix_kill_chain, stix_edges, stix_sighting, stix_placeholder
+from apiserver.blueprints.osint.feeds import POISONIVY_URL, FeedMetrics, FeedState, load_feeds
 from requests_oauthlib import OAuth1
 import urllib3
 urllib3.disable_warnings()
@@ -38,12 +49,14 @@ class OSINT(ODB):
         self.UCDP_Time_URL = "%s&StartDate=" % self.UCDP_Base_URL
         self.TWITTER_AUTH = TWITTER_AUTH
         self.base_twitter_url = "https://api.twitter.com/1.1/"
-        self.monitors = {"twitter": False, "merger": False}
+        # Imports and monitors run as background jobs shared with the other workers
+        self.jobs = get_job_queue(os.path.join(self.datapath, "jobs"))
         self.default_number_of_tweets = 200
         self.cve = ["AttackPattern", "Campaign", "CourseOfAction", "Identity",
                     "Indicator", "IntrusionSet", "Malware", "ObservedData",
                     "Report", "Sighting", "ThreatActor", "Tool", "Vulnerability"]
-        self.OSINT_index = { "Profile": {}, "Post": {}, "Location": {}, "Tag": {}}
+        # Ext_key to RID indexes shared with the other workers through memory mapped snapshots
+        self.OSINT_index = {c: get_shared_index(self.index_path(), c) for c in ["Profile", "Post", "Location", "Tag"]}
         self.ICON_ORGANIZATION = "TODO"
         self.ICON_HASHTAG = "TODO"
         self.ICON_CONFLICT = "TODO"
@@ -54,6 +67,45 @@ class OSINT(ODB):
         self.ICON_TWITTER_USER = "TODO"
 
 
+    def index_path(self):
+        # Files kept about the nodes of the database, removed by forget_database when it is created again
+        return os.path.join(self.datapath, "index", self.db_name)
+
+    def forget_database(self):
+        """
+        As ODB.forget_database and also remove the files kept about the nodes of the database, which are shared by the
+        workers
+        :return:
+        """
+        ODB.forget_database(self)
+        for osi in self.OSINT_index:
+            self.OSINT_index[osi].clear()
+        for path in [os.path.join(self.index_path(), "cve_fingerprints.npz"), self.merge_marks_path(),
+                     self.feed_state_path()]:
+            if os.path.exists(path):
+                os.remove(path)
+                click.echo('[%s_OSINT_forget_database] Removed %s' % (get_datetime(), path))
+
+    def forget_nodes(self, nodes, replacement=None):
+        """
+        As ODB.forget_nodes and also repoint the Ext_key index and location cache entries of deleted nodes, which are
+        shared by the workers, to the node they were merged into or drop them
+        :param nodes: list of dict(rid, class_name, hashkey, Ext_key)
+        :param replacement: optional RID of the node they were merged into
+        :return:
+        """
+        ODB.forget_nodes(self, nodes, replacement)
+        for n in nodes:
+            index = self.OSINT_index.get(n["class_name"])
+            if index is not None and n.get("Ext_key") and index.get(n["Ext_key"]) == n["rid"]:
+                if replacement:
+                    index[n["Ext_key"]] = replacement
+                else:
+                    index.discard(n["Ext_key"])
+        locations = [n["rid"] for n in nodes if n["class_name"] == "Location"]
+        if locations:
+            get_location_cache(os.path.join(self.datapath, "index")).replace_rids(self.db_name, locations, replacement)
+
     @staticmethod
     def ucdp_conflict_type(row):
 
@@ -64,53 +116,127 @@ class OSINT(ODB):
         else:
             return "One-sided Conflict"
 
-    def monitor_merges(self):
+    def monitor_merges(self, job):
         """
-        Crawler makes queries every hour to check the database for nodes with the same Ext_ID and then perform a merge
-        on the first one found with the links of the others. TODO, include more attributes to crawl for and return
-        likely nodes based on cases where similarity but not exact matches
+        Crawler checks the database for nodes with the same Ext_key in the same class and merges them into the one with
+        the lowest key. Only vertices inserted since the last round are read, cluster by cluster from the position each
+        cluster was read up to, and are checked against the Ext_key index of their class. The positions are kept in
+        the merge_monitor.json file of the database, removed when the database is created again, so a restarted monitor
+        carries on from where it stopped. TODO, include more attributes to crawl for and return likely nodes based on
+        cases where similarity but not exact matches
+        Runs as the merge_monitor job until the job is cancelled.
+        :param job: Job
         :return:
         """
-        while self.monitors["merger"] == True:
+        while not job.cancelled():
             click.echo('[%s_OSINT_run_monitor_merges] Starting...' % (get_datetime()))
-            index = {}
-            r = self.client.command('''
-            select @class, key, Ext_key from V where Ext_key != ""
-            ''')
-            for i in r:
-                if i.oRecordData["Ext_key"] in index.keys():
-                    index[i.oRecordData["Ext_key"]].append(i.oRecordData)
-                else:
-                    index[i.oRecordData["Ext_key"]] = [i.oRecordData]
-            merges = 0
-            for i in index:
-                if len(index[i]) > 1:
-                    merges+=1
-                    # Check if each of them are in the same class by making buckets
-                    class_buckets = {}
-                    for o in index[i]:
-                        if o["class"] in class_buckets.keys():
-                            class_buckets[o["class"]].append(o["key"])
-                        else:
-                            class_buckets[o["class"]] = [o["key"]]
-                    # Run through each bucket and if there is more than 1, then we still have entities needing merging
-                    for bucket in class_buckets:
-                        if len(class_buckets[bucket]) > 1:
-                            # Run through the nodes in the bucket using an "ni" node iterator to determine if at first node
-                            ni = 0
-                            node_A = node_B = None
-                            for n in class_buckets[bucket]:
-                                if ni == 0:
-                                    node_A = n
-                                # this is skipped the first round as the source node is set
-                                else:
-                                    node_B = n
-                                # only after both nodes are set, at ni > 0, merge the nodes
-                                if ni > 0 and node_A and node_B:
-                                    self.merge_nodes(node_A=node_A, node_B=node_B)
-                                ni+=1
-            click.echo('[%s_OSINT_run_monitor_merges] Complete with %d merge operations ' % (get_datetime(), merges))
-            time.sleep(60*60*2)
+            marks = self.load_merge_marks()
+            checked = merges = 0
+            try:
+                clusters = self.get_class_clusters(self.models.keys())
+            except Exception as e:
+                click.echo('[%s_OSINT_run_monitor_merges] Could not read the schema: %s' % (get_datetime(), str(e)))
+                clusters = {}
+            for class_name in clusters:
+                for cluster in clusters[class_name]:
+                    while not job.cancelled():
+                        position = marks.get(str(cluster), -1)
+                        nodes = self.get_new_keyed_nodes(cluster, position)
+                        if not nodes:
+                            break
+                        checked += len(nodes)
+                        merges += self.merge_duplicates(class_name, set([n["Ext_key"] for n in nodes]))
+                        marks[str(cluster)] = nodes[-1]["position"]
+                        self.save_merge_marks(marks)
+                        job.update(message="Checked %d new nodes with %d merge operations" % (checked, merges))
+                        if len(nodes) < MERGE_MONITOR_BATCH:
+                            break
+            message = '[%s_OSINT_run_monitor_merges] Complete with %d new nodes checked and %d merge operations ' % (
+                get_datetime(), checked, merges)
+            click.echo(message)
+            job.update(message=message)
+            job.wait(MERGE_MONITOR_INTERVAL)
+
+    def merge_marks_path(self):
+        return os.path.join(self.index_path(), "merge_monitor.json")
+
+    def load_merge_marks(self):
+        """
+        Cluster positions the merge monitor has read up to
+        :return: dict of str(cluster id) to position
+        """
+        try:
+            with open(self.merge_marks_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_merge_marks(self, marks):
+        path = self.merge_marks_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(marks, f)
+        os.replace(path + ".tmp", path)
+
+    def get_class_clusters(self, class_names):
+        """
+        Cluster ids of each class from the schema
+        :param class_names:
+        :return: dict of class name to list of cluster ids
+        """
+        r = self.client.command('''
+        select name, clusterIds from (select expand(classes) from metadata:schema)
+        ''')
+        clusters = {}
+        for i in r:
+            if i.oRecordData["name"] in class_names:
+                clusters[i.oRecordData["name"]] = [int(c) for c in i.oRecordData["clusterIds"] if int(c) >= 0]
+        return clusters
+
+    def get_new_keyed_nodes(self, cluster, position, limit=MERGE_MONITOR_BATCH):
+        """
+        Vertices with an Ext_key stored in the cluster after the position, in the order they were stored
+        :param cluster:
+        :param position:
+        :param limit:
+        :return: list of dict(rid, position, Ext_key)
+        """
+        r = self.client.command('''
+        select @rid as rid, Ext_key from cluster:%d where @rid > #%d:%d and Ext_key is not null and Ext_key <> ""
+        order by @rid limit %d
+        ''' % (cluster, cluster, position, limit))
+        nodes = []
+        for i in r:
+            rid = i.oRecordData["rid"].get_hash()
+            nodes.append({"rid": rid, "position": int(rid.split(":")[1]), "Ext_key": i.oRecordData["Ext_key"]})
+        return nodes
+
+    def merge_duplicates(self, class_name, ext_keys):
+        """
+        Look up the Ext_keys in the class and merge the nodes sharing one into the node with the lowest key
+        :param class_name:
+        :param ext_keys: iterable of Ext_key values
+        :return: number of merge operations
+        """
+        ext_keys = [k for k in ext_keys if k not in [None, ""]]
+        if not ext_keys:
+            return 0
+        # json quoting escapes quotes and backslashes the way OrientDB string literals expect
+        r = self.client.command('''
+        select key, Ext_key from %s where Ext_key in [%s]
+        ''' % (class_name, ", ".join([json.dumps(str(k), ensure_ascii=False) for k in ext_keys])))
+        buckets = {}
+        for i in r:
+            if i.oRecordData.get("key") is not None:
+                buckets.setdefault(i.oRecordData["Ext_key"], []).append(i.oRecordData["key"])
+        groups = []
+        for ext_key in buckets:
+            if len(buckets[ext_key]) > 1:
+                keys = sorted(buckets[ext_key])
+                groups.append((keys[0], keys[1:]))
+        if groups:
+            self.merge_node_groups(groups)
+        return len(groups)
 
     def run_otx(self):
 
@@ -153,36 +279,61 @@ class OSINT(ODB):
 
         return graph
 
-    def get_suggestion_items(self, searchterms=""):
+    def get_suggestion_items(self, searchterms="", fuzzy=False, **kwargs):
+        """
+        Return a small sample of matching items that can be chosen from a search list. Nodes with a title or Ext_key
+        starting with the terms come from the in process suggestion index. The LUCENE text indexes are queried for
+        fuzzy matches when fuzzy is asked for, and for the classes the suggestion index doesn't hold in full when it
+        has fewer matches than the limit for them.
+        :param searchterms:
+        :param fuzzy:
+        :return:
+        """
+        fuzzy = str(fuzzy).lower() not in ["false", "0", ""]
+        # The terms are all required so their order and case do not change the result
+        query = (" ".join(sorted(set(str(searchterms).lower().split()))), fuzzy)
+        items = self.result_cache.get("get_suggestion_items", query)
+        if items is not None:
+            return items
+        if fuzzy:
+            items = self.get_suggestion_items_lucene(searchterms, fuzzy=True)
+        else:
+            items = self.suggestions.search(searchterms, list(self.models.keys()))
+            incomplete = self.suggestions.incomplete(items, list(self.models.keys()))
+            if incomplete:
+                keys = set([i["NODE_KEY"] for i in items])
+                items.extend([i for i in self.get_suggestion_items_lucene(searchterms, incomplete)
+                              if i["NODE_KEY"] not in keys])
+        self.result_cache.put("get_suggestion_items", query, items, self.models.keys())
+        return items
+
+    def get_suggestion_items_lucene(self, searchterms="", class_names=None, fuzzy=False):
         """
         Using the LUCENE text indexing of the different classes available,
-        return a small sample of matching items that can be chosen from a search list.
-        :param kwargs:
+        return a small sample of items with a description matching every term as a prefix, or fuzzy matching it.
+        :param searchterms:
+        :param class_names: optional list of classes to search, defaults to all model classes
+        :param fuzzy:
         :return:
         """
+        class_names = class_names or list(self.models.keys())
         # Build the SQL that will be sent to the server
         sql = '''
         SELECT EXPAND( $models )
         LET 
         '''
         union = "$models = UNIONALL("
-        i = 1
-        lucene_q = ""
-        for q in searchterms.split(" "):
-            q = q.strip().lower()
-            if len(q) > 1:
-                if i == len(searchterms.split(" ")):
-                    lucene_q = "+%s*" % q
-                else:
-                    lucene_q = "+%s* " % q
-            i+=1
+        lucene_q = " ".join(["+%s%s" % (clean_concat(q), "~" if fuzzy else "*")
+                             for q in searchterms.split(" ") if len(clean_concat(q)) > 1])
+        if not lucene_q:
+            return []
         i = 0
-        for m in self.models.keys():
+        for m in class_names:
             sql = sql + '''
             $%s = (SELECT @rid as key, title, @class, Ext_key FROM %s WHERE [description] LUCENE "(%s)" LIMIT 10),\n
             ''' % (m[0:4].lower(), m, lucene_q)
             union = union + "$%s" % m[0:4].lower()
-            if i != len(self.models.keys())-1:
+            if i != len(class_names)-1:
                 union = union + ", "
             else:
                 union = union + ")"
@@ -241,6 +392,9 @@ class OSINT(ODB):
         :param kwargs:
         :return:
         """
+        response = self.result_cache.get("get_neighbors", str(kwargs["nodekey"]))
+        if response is not None:
+            return response
         click.echo('[%s_OSINT_get_neighbors] Get neighbors via Match starting...' % (get_datetime()))
         sql = '''
         MATCH
@@ -264,6 +418,8 @@ class OSINT(ODB):
                 response["node_keys"].append(r["NODE_KEY"])
         response["message"] = "Get neighbors for %s resulted in %d nodes" % (kwargs["nodekey"], len(response["data"]))
         click.echo('[%s_OSINT_get_neighbors] Get neighbors via Match complete.' % (get_datetime()))
+        self.result_cache.put("get_neighbors", str(kwargs["nodekey"]), response,
+                              ["E"] + [r["NODE_TYPE"] for r in response["data"]])
         return response
 
     def check_base_book(self):
@@ -742,19 +898,19 @@ class OSINT(ODB):
 
     def start_merge_monitor(self):
         """
-        Start a thread to run the monitor
+        Toggle the merge monitor: submit the merge_monitor job running monitor_merges, or cancel the one already
+        running in any worker
         :return:
         """
         r = {}
-        if self.monitors["merger"] == False:
-            t = threading.Thread(target=self.monitor_merges)
-            self.monitors["merger"] = True
-            t.start()
+        running = self.jobs.current("merge_monitor")
+        if not running:
+            r["data"] = self.jobs.submit("merge_monitor", self.monitor_merges, description="Merge monitor")
             r["message"] = '[%s_OSINT_start_merge_monitor] Turned on' % (get_datetime())
             click.echo(r["message"])
         else:
+            r["data"] = self.jobs.cancel(running["id"])
             r["message"] = '[%s_OSINT_start_merge_monitor] Turned off' % (get_datetime())
-            self.monitors["merger"] = False
 
         return r
 
@@ -830,10 +986,10 @@ class OSINT(ODB):
 
     def start_twitter_monitor(self, user="SocAnalyst"):
         """
-        Start a thread to run the monitor. Using the username, get all the channels they are subscribed to on Twitter
-        and start the monitor. SocAnalyst is standard user subscribed to all channels and can therefore be used for a
-        full monitor. For all others, the channels can be made customized and only the channels they search for are
-        returned.
+        Start the twitter_monitor job, or stop it if any worker is running it. Using the username, get all the channels
+        they are subscribed to on Twitter and start the monitor. SocAnalyst is standard user subscribed to all channels
+        and can therefore be used for a full monitor. For all others, the channels can be made customized and only the
+        channels they search for are returned.
         Example monitors for twitter:
         user_monitor = [
             "realDonaldTrump", "WhatsTrending", "BernieSanders", "PeteButtigieg", "benshapiro", "jeremycorbyn",
@@ -843,6 +999,13 @@ class OSINT(ODB):
         hashtags_monitor = ["bbc", "vulnerability", "MITRE"]
         :return:
         """
+        r = {}
+        running = self.jobs.current("twitter_monitor")
+        if running:
+            click.echo('[%s_OSINT_start_twitter_monitor] Turned off' % (get_datetime()))
+            r["data"] = self.jobs.cancel(running["id"])
+            r["message"] = "Twitter monitor stopped"
+            return r
         # Get the user's monitors
         sql = '''
         match
@@ -867,39 +1030,34 @@ class OSINT(ODB):
             elif m.oRecordData["s_description"] == "user":
                 user_monitor.append(m.oRecordData["s_searchValue"])
 
-        r = {}
-        t = threading.Thread(
-            target=self.monitor_twitter,
-            kwargs={
-                "user_monitor": user_monitor,
-                "locations_monitor": locations_monitor,
-                "hashtags_monitor": hashtags_monitor
-            })
-        if self.monitors["twitter"] == False:
-            self.monitors["twitter"] = True
-            click.echo('[%s_OSINT_start_twitter_monitor] Turned on' % (get_datetime()))
-            t.start()
-            r["message"] = "Twitter monitor started"
-        else:
-            click.echo('[%s_OSINT_start_twitter_monitor] Turned off' % (get_datetime()))
-            r["message"] = "Twitter monitor stopped"
-            self.monitors["twitter"] = False
+        click.echo('[%s_OSINT_start_twitter_monitor] Turned on' % (get_datetime()))
+        r["data"] = self.jobs.submit(
+            "twitter_monitor",
+            self.monitor_twitter,
+            description="Twitter monitor for %s" % user,
+            user_monitor=user_monitor,
+            locations_monitor=locations_monitor,
+            hashtags_monitor=hashtags_monitor
+        )
+        r["message"] = "Twitter monitor started"
 
         return r
 
-    def monitor_twitter(self, **kwargs):
+    def monitor_twitter(self, job, **kwargs):
         """
-        The thread that runs until turned off. When started runs every 30 minutes.
-        The thread is stored in the self.monitors{twitter: var}. The thread can be turned off
-        by means of setting it to False. TODO create a higher level process that is monitor and relate the others to it
+        The job that runs until turned off. When started runs every 30 minutes.
+        The job is the twitter_monitor of self.jobs and is turned off by cancelling it.
+        TODO create a higher level process that is monitor and relate the others to it
+        :param job: Job
         :param kwargs:
         :return:
         """
         minutes = 30
         name = "Twitter"
-        while self.monitors["twitter"]:
+        while not job.cancelled():
             pid = self.create_report(name=name, summary="Starting")
             update_key = self.update_report(pid=pid, summary="Getting users", name=name)
+            job.update(message="Getting users")
             for u in kwargs["user_monitor"]:
                 graphs, message = self.get_twitter(number_of_tweets=100, username=u)
                 for g in graphs:
@@ -917,7 +1075,8 @@ class OSINT(ODB):
                     self.process_graph(graph=g["graph"], update_key=update_key)
             self.update_report(ended=True, pid=pid,
                                name=name, summary="Complete with requests. Sleeping for %d minutes" % minutes)
-            time.sleep(60 * minutes)
+            job.update(message="Complete with requests. Sleeping for %d minutes" % minutes)
+            job.wait(60 * minutes)
 
     def get_twitter(self, **kwargs):
         """
@@ -1098,6 +1257,7 @@ class OSINT(ODB):
         """
         new_tweets = new_users = 0
         index = []
+        edges = self.edge_buffer()
         if "tweets" in kwargs.keys():
             click.echo('[%s_OSINT_graph_twitter] Graphing %s tweets' % (get_datetime(), len(kwargs["tweets"])))
             for t in kwargs['tweets']:
@@ -1156,7 +1316,7 @@ class OSINT(ODB):
                                 ]
                             }
                             ht_node = self.create_node(**node)["data"]["key"]
-                            self.create_edge_new(edgeType="Included", toNode=ht_node, fromNode=twt_node)
+                            edges.add(edgeType="Included", toNode=ht_node, fromNode=twt_node)
                     # Process Locations
                     if "place" in t.keys():
                         if t['place']:
@@ -1187,7 +1347,7 @@ class OSINT(ODB):
                                     }
                                     loc_node = self.create_node(**loc_node)["data"]["key"]
                                     self.OSINT_index["Location"][loc_id] = loc_node
-                                    self.create_edge_new(edgeType="TweetedFrom", toNode=loc_node, fromNode=twt_node)
+                                    edges.add(edgeType="TweetedFrom", toNode=loc_node, fromNode=twt_node)
 
                                 else:
                                     print("Need to get that Ext_key and return the node formatted for graph")
@@ -1231,12 +1391,12 @@ class OSINT(ODB):
                                 if Location["key"] not in index:
                                     index.append(Location["key"])
                         if Location:
-                            self.create_edge_new(edgeType="LocatedAt", fromNode=twt_node, toNode=Location["key"]
+                            edges.add(edgeType="LocatedAt", fromNode=twt_node, toNode=Location["key"]
                             )
                     # Else get the user_node
                     else:
                         usr_node = self.OSINT_index["Profile"][user_id]
-                    self.create_edge_new(edgeType="Tweeted", toNode=twt_node, fromNode=usr_node)
+                    edges.add(edgeType="Tweeted", toNode=twt_node, fromNode=usr_node)
 
         elif "user" in kwargs.keys():
             user_id = "TWT_%s" % kwargs['user']['id']
@@ -1269,6 +1429,7 @@ class OSINT(ODB):
                 })
                 node = self.create_node(**node)["data"]["key"]
                 self.OSINT_index["Profile"][user_id] = node
+        edges.close()
         message = '[%s_OSINT_graph_twitter] Complete with %s new users and %s new tweets' % (
             get_datetime(), new_users, new_tweets)
         click.echo(message)
@@ -1276,18 +1437,22 @@ class OSINT(ODB):
 
     def refresh_indexes(self):
         """
-        Get the Ext Keys of Posts, Users, and Locations to prevent unecessary lookups
+        Get the Ext Keys of Posts, Users, and Locations to prevent unecessary lookups. The indexes are snapshots shared
+        by the workers so the class is only scanned by the first worker to find its snapshot missing or out of date.
         :return:
         """
+        def scan(osi):
+            sql = '''
+            select @rid, Ext_key from %s where Ext_key != ""
+             ''' % (osi)
+            for i in self.client.command(sql):
+                yield i.oRecordData["Ext_key"], i.oRecordData['rid'].get_hash()
+
         try:
             for osi in self.OSINT_index:
                 click.echo('[%s_OSINT_refresh_indexes] Filling %s' % (get_datetime(), osi))
-                sql = '''
-                select @rid, Ext_key from %s where Ext_key != ""
-                 ''' % (osi)
-                r = self.client.command(sql)
-                for i in r:
-                    self.OSINT_index[osi][i.oRecordData["Ext_key"]] = i.oRecordData['rid'].get_hash()
+                count = self.OSINT_index[osi].build(lambda: scan(osi))
+                click.echo('[%s_OSINT_refresh_indexes] %s has %d keys' % (get_datetime(), osi, count))
             click.echo('[%s_OSINT_refresh_indexes] Indexes complete' % (get_datetime()))
         except Exception as e:
             click.echo('[%s_OSINT_refresh_indexes] Error setting up indexes. %s' % (get_datetime(), str(e)))
@@ -1316,6 +1481,14 @@ class OSINT(ODB):
         r = self.merge_nodes(node_A=kwargs['node_A'], node_B=kwargs['node_B'])
         return r
 
+    def merge_osint_groups(self, **kwargs):
+        """
+        Merge many groups of duplicates at once
+        :param kwargs: groups, list of {"node_A": key, "node_B": [key, ...]}
+        :return:
+        """
+        return self.merge_node_groups(kwargs.get('groups', []))
+
     def process_graph(self, **kwargs):
         '''
         :param graph: 
@@ -1323,8 +1496,9 @@ class OSINT(ODB):
         '''
         entityKeyMap = {}
         odb_graph = {"nodes": [], "lines": []}
-        for n in kwargs["graph"]["nodes"]:
-            new_node = self.create_node(**n)["data"]
+        created = self.create_nodes(kwargs["graph"]["nodes"])
+        for n, new_node in zip(kwargs["graph"]["nodes"], created):
+            new_node = new_node["data"]
             # If the graph was created by an automated process, related the entities to the collection
             if "update_key" in kwargs.keys():
                 self.create_edge(edgeType="CollectedFrom", fromNode=new_node["key"],
@@ -1450,51 +1624,49 @@ class OSINT(ODB):
         click.echo(message)
         return message
 
-    def get_cve(self):
+    def get_cve(self, full=False):
+        """
+        Submit the CVE import as a background job. Only one CVE import runs at a time across the workers and a request
+        while it is running returns the running job.
+        :param full: write every CVE rather than those new or changed since the last import
+        :return: dict of the job
+        """
+        full = str(full).lower() not in ["false", "0", "", "none"]
+        return self.jobs.submit("cve", self.import_cve, description="MITRE CVE %s import" % (
+            "full" if full else "bulk"), full=full)
+
+    def import_cve(self, job=None, full=False):
         """
         Get the full bulk from MITRE for vulnerability data. Use a timestamp based on the day and save the bulk CSV to
         the server. The timestamp can be used to check if the daily bulk was already downloaded earlier.
-        Once the CSV is downloaded, change the results into a Pandas dataframe and start a thread that extracts the the
-        data into a graph. Use Vulnerability references which are separated by "|" pipes.
+        Once the CSV is downloaded it is streamed into a graph by graph_cve.
+        Use Vulnerability references which are separated by "|" pipes.
+        :param job: Job
+        :param full: write every CVE rather than those new or changed since the last import
         :return:
         """
+        if job:
+            job.update(message="Downloading")
         path = os.path.join(self.datapath, "%s_cve.csv" % get_datetime()[:10])
-        url = "https://cve.mitre.org/data/downloads/allitems.csv"
-        data = self.get_url(url, path)
-        if data:
-            open(path, 'wb').write(data.content)
-
-        with codecs.open(path, encoding="utf8", errors='ignore') as data_csv:
-            click.echo('[%s_OSINT_cve] Cleaning raw data' % (get_datetime()))
-            df = {}
-            i = 0
-            for row in data_csv:
-                # Change the string into a list
-                r = row.split(",")
-                # Check if this is the headers row. Sometimes has double quotes
-                if r[0] == 'Name' or r[0] == '"Name"':
-                    for k in r:
-                        df[k.replace('"', "")] = []
-                # Only check the first column if the entry is longer than 3
-                if len(r[0]) > 3:
-                    if r[0][:4] == 'CVE-':
-                        for k, l in zip(df.keys(), r):
-                            df[k].append(l)
-                i+=1
-        click.echo('[%s_OSINT_cve] Complete with raw data cleaning. Starting Extraction' % (get_datetime()))
-        df = pd.DataFrame.from_dict(df)
-        #self.graph_cve(df=df)
-        t = threading.Thread(
-            target=self.graph_cve,
-            kwargs={
-                "df": df,
-            })
-        t.start()
+        download_file(CVE_URL, path)
+        return self.graph_cve(path=path, job=job, delta=not full)
 
-    def graph_cve(self, df=pd.DataFrame()):
+    def graph_cve(self, df=None, job=None, path=None, batch_size=CVE_BATCH_SIZE, delta=True):
         """
-        Thread that is called to start the long extraction process
+        Long extraction process run by the cve job. The CVEs are read from the MITRE csv at path, or from a DataFrame
+        with the same columns, batch_size rows at a time. The CVEs of a batch and the references not seen earlier in
+        the import are created with create_nodes and their edges are queued on an EdgeBuffer, so memory stays flat
+        apart from the hashed index of references. The new references of a batch are created by a pool of
+        CVE_REFERENCE_WORKERS threads while the CVEs are created.
+        In delta mode rows with the same fingerprint as in the last import are skipped and the Vulnerabilities of
+        changed rows are updated. The fingerprints of the rows written are saved for the next import either way. They
+        are kept per database and are ignored when the database holds fewer Vulnerabilities than there are
+        fingerprints, as happens when Vulnerabilities were deleted.
         :param df:
+        :param job: Job to report progress to and stop on cancellation
+        :param path: csv file
+        :param batch_size:
+        :param delta:
         :return:
         """
         pid = "CVE_graph_%s" % randomString(8)
@@ -1505,77 +1677,190 @@ class OSINT(ODB):
             "started": get_datetime(),
             "pid": pid
         })
-        class_name = "Vulnerability"
-        source = "MITRE"
-        i = 0
-        c = 0
-        pct = .1
-        new_nodes = new_references = 0
-        indexes = {}
-        for index, row in df.iterrows():
-            if i > df.shape[0]*pct:
-                i = 0
-                c+=1
-                update = ('[%s_OSINT_cve] Completed %f percent. %d Vuls, %d Refs, %d Indexes' % (
-                    get_datetime(), (index/df.shape[0])*100, new_nodes, new_references, len(indexes.keys())))
-                click.echo(update)
-                self.client.command('''
-                update Process set summary = '%s' where pid = '%s'
-                ''' % (update, pid))
-            i+=1
-            if 'Comments\n' in row.keys():
-                comments = row['Comments\n']
-            elif 'Comments' in row.keys():
-                comments = row['Comments']
+        if path:
+            progress = ReadProgress(os.path.getsize(path))
+            rows = read_cve_rows(path, progress)
+        else:
+            df = df if df is not None else pd.DataFrame()
+            progress = ReadProgress(df.shape[0])
+            rows = read_frame_rows(df, progress)
+        stats = {"new_nodes": 0, "new_references": 0, "edges": 0, "changed": 0, "unchanged": 0}
+        references = self.warm_reference_index()
+        pool = ThreadPoolExecutor(max_workers=CVE_REFERENCE_WORKERS)
+        fingerprints = CVEFingerprints(os.path.join(self.index_path(), "cve_fingerprints.npz")).load()
+        if delta and len(fingerprints) and self.client.command(
+                "select count(*) as count from Vulnerability")[0].oRecordData["count"] < len(fingerprints):
+            click.echo('[%s_OSINT_cve] Fewer Vulnerabilities than the %d fingerprints, writing every CVE' % (
+                get_datetime(), len(fingerprints)))
+            fingerprints.prints = {}
+        report = .1
+        edges = self.edge_buffer()
+        while not (job and job.cancelled()):
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            prints = [cve_fingerprint(row) for row in batch]
+            changed = []
+            if delta:
+                write = []
+                for row, fingerprint in zip(batch, prints):
+                    previous = fingerprints.get(row["Name"])
+                    if previous == fingerprint:
+                        stats["unchanged"] += 1
+                    else:
+                        write.append(row)
+                        if previous is not None:
+                            changed.append(row)
             else:
-                comments = ""
+                write = batch
             try:
-                # Create the CVE node and then make relations to any entities if they don't exist
-                cve_node = self.create_node(**{
-                    "class_name": class_name,
-                    "source": source,
-                    "Ext_key": row["Name"],
-                    "description": row["Description"] + " " + comments,
-                    "labels": row["References"], # Make relations to each as a reporter
-                    "votes": row["Votes"],
-                    "status": row["Status"],
-                    "phase": row["Phase"]
-                })
-                if cve_node["message"] != "duplicate blocked":
-                    new_nodes+=1
-                cve_node = cve_node["data"]
-                references = [r.strip() for r in row["References"].split("|")]
-                for r in references:
-                # Check if in the index
-                    ref_node = self.create_node(**{
-                        "class_name": "Object",
-                        "description": "Reference from CVE %s" % r,
-                        "Category": "Vulnerability Reference",
-                        "Ext_key": r,
-                        "source": "MITRE"
-                    })
-                    if ref_node["message"] != "duplicate blocked":
-                        new_references+=1
-                    ref_node = ref_node["data"]
-                    self.create_edge_new(
-                        fromNode=ref_node["key"], edgeType="References", toNode=cve_node["key"]
-                    )
+                written = self.graph_cve_batch(write, references, edges, stats, pool) if write else set()
+                if changed:
+                    self.update_cve_rows(changed)
+                    stats["changed"] += len(changed)
+                # Rows that failed keep their old fingerprint so the next import tries them again
+                for row, fingerprint in zip(batch, prints):
+                    if row["Name"] in written:
+                        fingerprints.set(row["Name"], fingerprint)
             except Exception as e:
                 click.echo('[%s_OSINT_cve] Error %s' % (get_datetime(), str(e)))
-                pass
+            message = '%d Vuls, %d changed, %d unchanged, %d Refs, %d Edges. %s' % (
+                stats["new_nodes"], stats["changed"], stats["unchanged"], stats["new_references"], stats["edges"],
+                progress.summary())
+            if job:
+                job.update(progress=progress.fraction(), message=message)
+            if progress.fraction() >= report:
+                report += .1
+                fingerprints.save()
+                update = '[%s_OSINT_cve] Completed %s' % (get_datetime(), message)
+                click.echo(update)
+                self.client.command('''
+                update Process set summary = '%s' where pid = '%s'
+                ''' % (update, pid))
 
-        msg = '[%s_OSINT_cve] Complete with graphing CVE at index %d' % (get_datetime(), index)
+        edges.close()
+        pool.shutdown()
+        fingerprints.save()
+        msg = '[%s_OSINT_cve] Complete with graphing CVE at row %d. %d Vuls, %d changed, %d unchanged, %d Refs, ' \
+              '%d Edges in %d seconds' % (get_datetime(), progress.rows, stats["new_nodes"], stats["changed"],
+                                          stats["unchanged"], stats["new_references"], stats["edges"],
+                                          time.time() - progress.started)
         click.echo(msg)
         self.client.command('''
         update Process set ended = '%s', description = '%s' where pid = '%s'
         ''' % (get_datetime(), msg, pid))
+        return msg
+
+    def update_cve_rows(self, rows):
+        """
+        Set the attributes of the Vulnerabilities of CVE rows that changed since the last import. Their new references
+        and edges are created by graph_cve_batch.
+        :param rows: list of dicts of the csv columns
+        :return:
+        """
+        for row in rows:
+            self.client.command('''
+            update Vulnerability set description = '%s', labels = '%s', votes = '%s', status = '%s', phase = '%s' 
+            where Ext_key = '%s'
+            ''' % (clean("%s %s" % (row.get("Description", ""), row.get("Comments", "") or "")),
+                   clean(row.get("References", "")), clean(row.get("Votes", "")), clean(row.get("Status", "")),
+                   clean(row.get("Phase", "")), clean(row["Name"])))
+        self.result_cache.invalidate("Vulnerability")
+
+    def warm_reference_index(self):
+        """
+        The ReferenceIndex of the database, filled with one scan of the reference Objects the first time it is used
+        :return: ReferenceIndex
+        """
+        references = get_reference_index(self.db_name)
+        if not references.warmed:
+            try:
+                r = self.client.command('''
+                select @rid as rid, Ext_key from Object where Category = 'Vulnerability Reference'
+                ''')
+                count = references.warm([(i.oRecordData["Ext_key"], i.oRecordData["rid"].get_hash()) for i in r
+                                         if i.oRecordData.get("Ext_key")])
+                click.echo('[%s_OSINT_cve] Reference index has %d references' % (get_datetime(), count))
+            except Exception as e:
+                click.echo('[%s_OSINT_cve] Could not read the references: %s' % (get_datetime(), str(e)))
+        return references
+
+    def graph_cve_batch(self, rows, references, edges, stats, pool=None):
+        """
+        Create the Vulnerability nodes of a batch of CVE rows, the reference Objects not yet in references and queue
+        the References edges between them. With a pool the references are created in chunks on its threads while the
+        Vulnerabilities are created on this one.
+        :param rows: list of dicts of the csv columns
+        :param references: ReferenceIndex
+        :param edges: EdgeBuffer
+        :param stats:
+        :param pool: optional ThreadPoolExecutor
+        :return: set of the names of the CVEs written along with all of their references
+        """
+        new_references = []
+        batch_references = set()
+        for row in rows:
+            for r in split_references(row.get("References")):
+                if r not in references and r not in batch_references:
+                    batch_references.add(r)
+                    new_references.append(r)
+        reference_nodes = [{
+            "class_name": "Object",
+            "description": "Reference from CVE %s" % r,
+            "Category": "Vulnerability Reference",
+            "Ext_key": r,
+            "source": "MITRE"
+        } for r in new_references]
+        futures = []
+        if pool and reference_nodes:
+            chunk = max(1, -(-len(reference_nodes) // CVE_REFERENCE_WORKERS))
+            futures = [pool.submit(self.create_nodes, reference_nodes[i:i + chunk])
+                       for i in range(0, len(reference_nodes), chunk)]
+        cves = self.create_nodes([{
+            "class_name": "Vulnerability",
+            "source": "MITRE",
+            "Ext_key": row["Name"],
+            "description": "%s %s" % (row.get("Description", ""), row.get("Comments", "") or ""),
+            "labels": row.get("References", ""),  # Make relations to each as a reporter
+            "votes": row.get("Votes", ""),
+            "status": row.get("Status", ""),
+            "phase": row.get("Phase", "")
+        } for row in rows])
+        if futures:
+            results = []
+            for f in futures:
+                results.extend(f.result())
+        else:
+            results = self.create_nodes(reference_nodes)
+        for r, result in zip(new_references, results):
+            if type(result) == dict and str(result["data"]["key"]).startswith("#"):
+                references.add(r, result["data"]["key"])
+                if "Create node" in result["message"]:
+                    stats["new_references"] += 1
+        written = set()
+        for row, result in zip(rows, cves):
+            if type(result) != dict or not str(result["data"]["key"]).startswith("#"):
+                continue
+            if "Create node" in result["message"]:
+                stats["new_nodes"] += 1
+            complete = True
+            for r in split_references(row.get("References")):
+                ref_key = references.get(r)
+                if ref_key:
+                    edges.add(fromNode=ref_key, edgeType="References", toNode=result["data"]["key"])
+                    stats["edges"] += 1
+                else:
+                    complete = False
+            if complete:
+                written.add(row["Name"])
+        return written
 
     def get_poisonivy(self):
         """
         Get the latest dump from the CTI url. The current URL is set to oasis github which delivers a small sample
         using the STIX model. The expected JSON from the URL is in a format of nodes with STIX 12 entity types and
         edges including relationships and sightings. The function calls graph_poisonivy to extract the JSON into a
-        graph form and returns a message prior to starting that thread.
+        graph form and returns the poisonivy job, which runs import_poisonivy, prior to starting it.
         nodes:
             "type": "campaign",
             "id": "campaign--8e2e2d2b-17d4-4cbf-938f-98ee46b3cd3f",
@@ -1591,137 +1876,309 @@ class OSINT(ODB):
             "modified": "2016-04-06T20:08:31.000Z",
             "sighting_of_ref": "indicator--8e2e2d2b-17d4-4cbf-938f-98ee46b3cd3f"
 
-        :return:
+        :return: dict of the job
         """
-        source = "%s_poisonivy.json" % get_datetime()[:10]
-        path = os.path.join(self.datapath, source)
-        url = 'https://oasis-open.github.io/cti-documentation/examples/example_json/poisonivy.json'
-        click.echo('[%s_OSINT_get_poisonivy] Getting %s' % (get_datetime(), url))
-        data = self.get_url(url, path)
-        if data:
-            data = json.loads(data.content)
-            with open(path, 'w') as fp:
-                json.dump(data, fp)
-        else:
-            with open(path) as fp:
-                data = json.load(fp)
+        return self.jobs.submit("poisonivy", self.import_poisonivy, description="CTI poisonivy import")
 
-        message = '[%s_OSINT_get_poisonivy] Getting %s' % (get_datetime(), url)
-        click.echo(message)
-        t = threading.Thread(
-            target=self.graph_poisonivy,
-            kwargs={
-                "data": data
-            })
-        t.start()
-        return message
+    def import_poisonivy(self, job=None):
+        """
+        Download the CTI dump to disk, or use the copy saved today, and stream it into the graph with graph_poisonivy
+        :param job: Job
+        :return:
+        """
+        path = os.path.join(self.datapath, "%s_poisonivy.json" % get_datetime()[:10])
+        if job:
+            job.update(message="Downloading")
+        download_file(POISONIVY_URL, path)
+        return self.graph_poisonivy(path=path, job=job)
 
-    def graph_poisonivy(self, data):
+    def graph_poisonivy(self, path, job=None, batch_size=STIX_BATCH_SIZE):
         """
         Extract the expected format of CTI data documented at https://oasis-open.github.io/cti-documentation/stix/intro
-        :param data:
+        with graph_stix
+        :param path: STIX 2 JSON file
+        :param job: Job to report progress to and stop on cancellation
+        :param batch_size:
         :return:
         """
-        click.echo('[%s_OSINT_graph_poisonivy] Starting graph for poisonivy extract of %s' % (
-            get_datetime(), len(data["objects"])))
-        graph = {
-            "nodes": [],
-            "lines": [],
-            "index": {}
-        }
-        for i in data['objects']:
-            if i['type'] not in ["relationship", "sighting"]:
-                node_prep = {
-                    "class_name": i['type'].capitalize()
-                }
-                if node_prep["class_name"].lower() == "attack-pattern":
-                    node_prep["class_name"] = "AttackPattern"
-                elif node_prep["class_name"].lower() == "course-of-action":
-                    node_prep["class_name"] = "CourseOfAction"
-                for k in i.keys():
-                    if k not in ["type"]:
-                        if k in ["object_marking_refs", "labels", "sectors"]:
-                            val = ', '.join(i[k])
-                        elif k in ["kill_chain_phases"]:
-                            for kcp in i["kill_chain_phases"]:
-                                kcp_node = {
-                                    "name": kcp["kill_chain_name"],
-                                    "phase": kcp["phase_name"]
-                                }
-                                graph["nodes"].append(kcp_node)
-                                graph["lines"].append({
-                                    "to": node_prep, "from": kcp_node["name"]
-                                })
-
-                        elif k in ["first_seen", "modified", "created"]:
-                            val = change_if_date(i[k])
-                        else:
-                            val = i[k]
-                        node_prep[k] = val
-
-            elif i['type'] == "relationship":
-                graph["lines"].append(i)
-            if node_prep["class_name"].lower() not in ["marking-definition"]:
-                n = self.create_node(**node_prep)
-                graph["nodes"].append(n["data"])
-                graph["index"][i["id"]] = n["data"]["key"]
-            else:
-                graph["nodes"].append(node_prep)
-        click.echo('[%s_OSINT_graph_poisonivy] Complete with %s entities. Starting %s edges.' % (
-            get_datetime(), len(graph["nodes"]), len(graph["lines"])))
-        for r in graph["lines"]:
-            if "to" in r.keys():
-                if type(r["to"]) == dict:
-                    toNode = graph["index"][r["to"]["id"]]
+        click.echo('[%s_OSINT_graph_poisonivy] Starting graph for poisonivy extract of %s' % (get_datetime(), path))
+        stats = self.graph_stix(path, job=job, batch_size=batch_size)
+        msg = '%d entities and %d edges, %d referenced entities not in the bundle' % (
+            stats["entities"], stats["edges"], stats["missing"])
+        click.echo('[%s_OSINT_graph_poisonivy] Complete with extraction. %s' % (get_datetime(), msg))
+        return msg
+
+    def graph_stix(self, path, job=None, batch_size=STIX_BATCH_SIZE, since=None):
+        """
+        Stream a STIX bundle into the graph. The bundle at path is read twice by a StixReader. The first pass creates
+        the domain objects and their kill chain phases batch_size at a time with create_nodes and keeps the RID of
+        each STIX id in the hashed index of the database. The second pass creates the Sightings and a node for each id
+        referenced but not in the graph, then queues the edges of the relationships and sightings on an EdgeBuffer.
+        Objects whose node or edges could not be created are counted as failed and don't move modified on.
+        :param path: STIX 2 JSON file
+        :param job: Job to report progress to and stop on cancellation
+        :param batch_size:
+        :param since: optional STIX timestamp, only objects modified after it are written
+        :return: dict of counts with the latest timestamp written as modified
+        """
+        index = self.warm_stix_index()
+        stats = {"objects": 0, "new": 0, "old": 0, "modified": None, "entities": 0, "skipped": 0, "missing": 0,
+                 "edges": 0, "failed": 0}
+        edges = self.edge_buffer()
+        for stage, graph in enumerate([self.graph_stix_objects, self.graph_stix_relationships]):
+            progress = ReadProgress(os.path.getsize(path))
+            objects = select_objects(StixReader(path, progress), stage == 1, since, stats)
+            while not (job and job.cancelled()):
+                batch = list(itertools.islice(objects, batch_size))
+                if not batch:
+                    break
+                graph(batch, index, edges, stats)
+                if job:
+                    job.update(progress=(stage + progress.fraction()) / 2, message="%d entities, %d edges" % (
+                        stats["entities"], stats["edges"]))
+            click.echo('[%s_OSINT_graph_stix] Completed pass %d of %s with %d entities and %d edges' % (
+                get_datetime(), stage + 1, path, stats["entities"], stats["edges"]))
+        # Edges rejected by OrientDB other than duplicates aren't traced back to their objects
+        stats["failed"] += edges.close()["errors"]
+        return stats
+
+    def warm_stix_index(self):
+        """
+        The index of STIX ids to RIDs of the database, filled with one scan of the STIX classes the first time it is
+        used so relationships can reach objects ingested by earlier imports
+        :return: ReferenceIndex
+        """
+        index = get_reference_index("%s_stix" % self.db_name)
+        if not index.warmed:
+            self.migrate_stix_keys()
+            pairs = []
+            for class_name in self.cve + ["Object"]:
+                try:
+                    r = self.client.command('''
+                    select @rid as rid, Ext_key from %s where Ext_key like '%%--%%'
+                    ''' % class_name)
+                    pairs.extend([(i.oRecordData["Ext_key"], i.oRecordData["rid"].get_hash()) for i in r])
+                except Exception as e:
+                    click.echo('[%s_OSINT_graph_stix] Could not read %s: %s' % (get_datetime(), class_name, str(e)))
+            click.echo('[%s_OSINT_graph_stix] STIX index has %d ids' % (get_datetime(), index.warm(pairs)))
+        return index
+
+    def migrate_stix_keys(self):
+        """
+        Key the STIX nodes created by graph_poisonivy before it was streamed by their STIX id. Those nodes kept the id
+        in an id attribute with a sequence number as the Ext_key, so their hashkeys would not match the nodes graph_stix
+        prepares and a new import would duplicate them. Their Ext_key is set to the id and their hashkey to the one
+        graph_stix gives the same object. Nodes already migrated are not selected again.
+        :return: number of nodes migrated
+        """
+        migrated = 0
+        for class_name in self.cve:
+            try:
+                r = self.client.command('''
+                select from %s where id like '%%--%%' and (Ext_key is null or Ext_key <> id)
+                ''' % class_name)
+            except Exception as e:
+                click.echo('[%s_OSINT_migrate_stix_keys] Could not read %s: %s' % (get_datetime(), class_name, str(e)))
+                continue
+            for i in r:
+                attributes = {k: i.oRecordData[k] for k in self.nodeKeys if k in i.oRecordData}
+                attributes.update({"class_name": class_name, "Ext_key": i.oRecordData["id"]})
+                hash_key = hash_attributes(attributes, self.nodeKeys)
+                try:
+                    self.client.command("update %s set Ext_key = '%s', hashkey = '%s'" % (
+                        i._rid, clean(i.oRecordData["id"]), hash_key))
+                except Exception as e:
+                    # Most likely a node with the new key was already created for the same object
+                    click.echo('[%s_OSINT_migrate_stix_keys] Could not migrate %s: %s' % (
+                        get_datetime(), i._rid, str(e)))
+                    continue
+                self.hashkey_cache.add(class_name, hash_key, i._rid)
+                migrated += 1
+        if migrated:
+            self.result_cache.invalidate(*self.cve)
+            click.echo('[%s_OSINT_migrate_stix_keys] Keyed %d STIX nodes by their id' % (get_datetime(), migrated))
+        return migrated
+
+    def graph_stix_objects(self, objects, index, edges, stats):
+        """
+        Create the nodes of a batch of STIX domain objects and the kill chain phases linked to them
+        :param objects: list of STIX objects other than relationships and sightings
+        :param index: ReferenceIndex of the STIX ids to RIDs
+        :param edges: EdgeBuffer
+        :param stats:
+        :return:
+        """
+        nodes = []
+        phases = {}
+        selected = []
+        for obj in objects:
+            if obj.get("type") in SKIPPED_TYPES or not obj.get("id"):
+                stats["skipped"] += 1
+                continue
+            selected.append(obj)
+            nodes.append(stix_node(obj))
+            for phase in stix_kill_chain(obj):
+                if phase["Ext_key"] not in index:
+                    phases[phase["Ext_key"]] = phase
+        nodes.extend(phases.values())
+        for node, result in zip(nodes, self.create_nodes(nodes)):
+            if type(result) == dict and str(result["data"]["key"]).startswith("#"):
+                index.add(node["Ext_key"], result["data"]["key"])
+                stats["entities"] += 1
+        for obj in selected:
+            to_key = index.get(obj["id"])
+            written = bool(to_key)
+            for phase in stix_kill_chain(obj):
+                from_key = index.get(phase["Ext_key"])
+                if from_key and to_key:
+                    edges.add(fromNode=from_key, toNode=to_key)
+                    stats["edges"] += 1
                 else:
-                    if r["to"] in graph["index"].keys():
-                        toNode = graph["index"][r["to"]]
-                    else:
-                        toNode = self.create_node(
-                            class_name="Object", Ext_key=r["to"], description="CTI %s" % r["to"])["data"]["key"]
-                if type(r["from"]) == dict:
-                    fromNode = graph["index"][r["from"]["id"]]
+                    written = False
+            count_written(obj, written, stats)
+
+    def graph_stix_relationships(self, objects, index, edges, stats):
+        """
+        Create the Sighting nodes of a batch of STIX relationships and sightings, a node for each id they reference
+        that wasn't in the bundle and queue their edges
+        :param objects: list of STIX relationships and sightings
+        :param index: ReferenceIndex of the STIX ids to RIDs
+        :param edges: EdgeBuffer
+        :param stats:
+        :return:
+        """
+        nodes = {}
+        links = []
+        for obj in objects:
+            try:
+                links.append((obj, stix_edges(obj)))
+            except KeyError:
+                stats["skipped"] += 1
+                continue
+            if obj["type"] == "sighting" and obj["id"] not in index:
+                nodes[obj["id"]] = stix_sighting(obj)
+        for obj, obj_edges in links:
+            for from_id, edge_type, to_id in obj_edges:
+                for stix_id in [from_id, to_id]:
+                    if stix_id not in index and stix_id not in nodes:
+                        nodes[stix_id] = stix_placeholder(stix_id)
+                        stats["missing"] += 1
+        for stix_id, result in zip(nodes, self.create_nodes(list(nodes.values()))):
+            if type(result) == dict and str(result["data"]["key"]).startswith("#"):
+                index.add(stix_id, result["data"]["key"])
+                stats["entities"] += 1
+        for obj, obj_edges in links:
+            written = obj["type"] != "sighting" or obj["id"] in index
+            for from_id, edge_type, to_id in obj_edges:
+                from_key = index.get(from_id)
+                to_key = index.get(to_id)
+                if from_key and to_key:
+                    edges.add(fromNode=from_key, toNode=to_key, edgeType=edge_type)
+                    stats["edges"] += 1
                 else:
-                    if r["from"] in graph["index"].keys():
-                        fromNode = graph["index"][r["from"]]
-                    else:
-                        fromNode = self.create_node(
-                            class_name="Object", Ext_key=r["from"],
-                            description="CTI %s" % r["from"])["data"]["key"]
-                self.create_edge_new(fromNode=fromNode, toNode=toNode)
-            else:
-                if "source_ref" in r.keys():
-                    self.create_edge_new(
-                        fromNode=graph["index"][r["source_ref"]],
-                        toNode=graph["index"][r["target_ref"]],
-                        edgeType=r["relationship_type"]
-                    )
-                elif "sighting_of_ref" in r.keys():
-                    if r["id"] in graph["index"].keys():
-                        sNode = graph["index"][r["id"]]
-                    else:
-                        sNode = self.create_node(
-                            class_name="Sighting", Ext_key=r["id"], createDate=r["created"], updateDate=r["modified"],
-                            description="CTI Sighting of %s on %s" % (r["sighting_of_ref"], r["created"])
-                        )["data"]["key"]
-                    if r["created_by_ref"] in graph["index"].keys():
-                        cNode = graph["index"][r["created_by_ref"]]
-                    else:
-                        cNode = self.create_node(
-                            class_name="Identity", Ext_key=r["created_by_ref"],
-                            description="CTI Identity %s" % r["created_by_ref"],
-                        )["data"]["key"]
-                    self.create_edge_new(fromNode=cNode, toNode=sNode, edgeType="Created")
-                    if r["sighting_of_ref"] in graph["index"].keys():
-                        oNode = graph["index"][r["sighting_of_ref"]]
-                    else:
-                        oNode = self.create_node(
-                            class_name="Object", Ext_key=r["sighting_of_ref"],
-                            description="CTI Sighting of %s on %s" % (r["sighting_of_ref"], r["created"])
-                        )["data"]["key"]
-                    self.create_edge_new(fromNode=sNode, toNode=oNode, edgeType="SightingOf")
+                    written = False
+            count_written(obj, written, stats)
+
+    def get_feeds(self):
+        """
+        The configured STIX feeds with their high-water marks and the metrics of their last run and all runs
+        :return: list of dict
+        """
+        state = FeedState(self.feed_state_path()).load()
+        feeds = []
+        for feed in load_feeds(self.datapath):
+            f = feed.to_dict()
+            f.update({k: v for k, v in state.get(feed.name).items() if k != "files"})
+            feeds.append(f)
+        return feeds
+
+    def feed_state_path(self):
+        return os.path.join(self.index_path(), "feeds.json")
+
+    def ingest_feeds(self, name=None):
+        """
+        Start a job ingesting the objects of each feed, or the named feed, modified since its last run
+        :param name:
+        :return: dict of the job
+        """
+        return self.jobs.submit("feeds", self.import_feeds, description="STIX feed import %s" % (name or "all"),
+                                name=name)
 
-        click.echo('[%s_OSINT_graph_poisonivy] Complete with extraction.')
+    def import_feeds(self, job=None, name=None):
+        """
+        Read the new bundle files of each feed and write the objects of each file modified after the file's high-water
+        mark with graph_stix, all of them for a file not read before. The mark and signature of a file only move forward
+        once it is read to the end with every selected object written, so a file that fails or is cancelled is read
+        again from the same mark on the next run.
+        :param job: Job
+        :param name: optional feed name
+        :return: message with the counts of each feed
+        """
+        state = FeedState(self.feed_state_path()).load()
+        messages = []
+        for feed in load_feeds(self.datapath):
+            if (name and feed.name != name) or (job and job.cancelled()):
+                continue
+            metrics = FeedMetrics()
+            marks = {}
+            files = {}
+            try:
+                if job:
+                    job.update(message="Reading feed %s" % feed.name)
+                for path, signature in feed.sources(self.datapath, state.get(feed.name)["files"]):
+                    source = os.path.basename(path)
+                    stats = self.graph_stix(path, job=job, since=state.mark(feed.name, source))
+                    metrics.add(stats)
+                    metrics.counts["files"] += 1
+                    metrics.counts["bytes"] += os.path.getsize(path)
+                    if job and job.cancelled():
+                        break
+                    if stats["failed"]:
+                        click.echo('[%s_OSINT_import_feeds] %d objects of %s failed, it will be read again' % (
+                            get_datetime(), stats["failed"], path))
+                        continue
+                    marks[source] = stats["modified"]
+                    if signature:
+                        files[source] = signature
+            except Exception as e:
+                metrics.counts["errors"] += 1
+                click.echo('[%s_OSINT_import_feeds] Error in feed %s: %s' % (get_datetime(), feed.name, str(e)))
+            state.update(feed.name, marks, files, metrics)
+            state.save()
+            last = state.get(feed.name)["last"]
+            message = '%s: %d new of %d objects, %d entities, %d edges at %.1f objects/s' % (
+                feed.name, last["new"], last["objects"], last["entities"], last["edges"], last["objects_per_second"])
+            click.echo('[%s_OSINT_import_feeds] %s' % (get_datetime(), message))
+            messages.append(message)
+        return "; ".join(messages)
+
+    def monitor_feeds(self, job):
+        """
+        Run import_feeds every FEED_MONITOR_INTERVAL seconds until the job is cancelled
+        :param job: Job
+        :return:
+        """
+        while not job.cancelled():
+            job.update(message=self.import_feeds(job=job))
+            job.wait(FEED_MONITOR_INTERVAL)
+
+    def start_feed_monitor(self):
+        """
+        Turn on the feed_monitor job, which imports the feeds every FEED_MONITOR_INTERVAL seconds, or turn off the one
+        already running
+        :return:
+        """
+        r = {}
+        running = self.jobs.current("feed_monitor")
+        if not running:
+            r["data"] = self.jobs.submit("feed_monitor", self.monitor_feeds, description="Feed monitor")
+            r["message"] = '[%s_OSINT_start_feed_monitor] Turned on' % (get_datetime())
+            click.echo(r["message"])
+        else:
+            r["data"] = self.jobs.cancel(running["id"])
+            r["message"] = '[%s_OSINT_start_feed_monitor] Turned off' % (get_datetime())
+
+        return r
 
     def get_url(self, url, path):
         if not os.path.exists(path):
@@ -39,6 +39,7 @@ class Shodan(ODB):
             click.echo(message)
             return [], message
 
+        edges = self.edge_buffer()
         for r in results["matches"]:
             # Set up the Shodan Crawler node from the row
             if '_shodan' in r.keys():
@@ -70,7 +71,7 @@ class Shodan(ODB):
                         # Create the Device found by the crawler
                         d_node = self.create_node(**d_node)
                         # Create the relationship
-                        self.create_edge_new(
+                        edges.add(
                             edgeType="Discovered",
                             fromNode=s_node["data"]["key"],
                             toNode=d_node["data"]["key"])
@@ -102,7 +103,7 @@ class Shodan(ODB):
                                     get_datetime(), str(e), v))
                                     v_ok = False
                                 if v_ok:
-                                    self.create_edge_new(
+                                    edges.add(
                                         edgeType="Has",
                                         fromNode=d_node["data"]["key"],
                                         toNode=v_node
@@ -117,7 +118,7 @@ class Shodan(ODB):
                                                     Ext_key=ref,
                                                     source="Shodan",
                                                     description="Reference to %s" % v)["data"]["key"]
-                                                self.create_edge_new(
+                                                edges.add(
                                                     edgeType="References",
                                                     fromNode=ref_node,
                                                     toNode=v_node
@@ -136,11 +137,12 @@ class Shodan(ODB):
                                     create = False
                             if create:
                                 l_node = self.create_node(**l_node)["data"]["key"]
-                                self.create_edge_new(
+                                edges.add(
                                     edgeType="LocatedAt",
                                     fromNode=d_node["data"]["key"],
                                     toNode=l_node
                                 )
+        edges.close()
         return results, message
 
     def get_host(self, ip_address):
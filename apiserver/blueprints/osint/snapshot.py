@@ -0,0 +1,352 @@
+"""
+Ext_key to RID indexes shared by the gunicorn workers. Each index is a snapshot file holding a sorted array of 64 bit
+key hashes with the matching RID cluster and position arrays, which every worker memory maps read only, and a journal
+file that workers append new entries to. A lookup binary searches the snapshot and then the entries read from the
+journal, so a node inserted by one worker is seen by the others and each worker only keeps the recent entries in
+memory. A key whose node was deleted is appended with - as its RID. Once the journal is large it is merged into a new
+snapshot. The files are removed by clear when the database is created again, and a worker that finds its snapshot
+gone drops what it had read.
+    <path>/<name>.idx               header (magic, count, epoch, built) then hashes, positions, clusters
+    <path>/<name>.<epoch>.journal   lines of key<TAB>rid, or key<TAB>-, appended since the snapshot of that epoch
+    <path>/<name>.lock              shared while appending, exclusive while building or merging a snapshot
+"""
+import os
+import time
+import click
+import struct
+import hashlib
+import threading
+import numpy as np
+from apiserver.utils import get_datetime, SNAPSHOT_MAX_AGE, SNAPSHOT_COMPACT_SIZE
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b"OSINTIX1"
+# Seconds a worker answers from what it has read before checking the files for entries of other workers again, and
+# the shorter interval at which a key it doesn't know makes it check
+REFRESH_INTERVAL = 1
+MISS_REFRESH_INTERVAL = 0.1
+HEADER = struct.Struct("<8sQQQ")
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "little")
+
+
+def split_rid(rid):
+    cluster, position = str(rid).lstrip("#").split(":")
+    return int(cluster), int(position)
+
+
+class SharedIndex:
+    """
+    Dictionary like Ext_key to RID index for one class. Supports key in index, index[key], index.get(key) and
+    index[key] = rid, and keys() returns the index itself so existing "in index.keys()" checks keep working.
+    RIDs are returned in the #cluster:position form.
+    """
+
+    def __init__(self, path, name, compact_size=SNAPSHOT_COMPACT_SIZE):
+        self.path = path
+        self.name = name
+        self.compact_size = compact_size
+        self.lock = threading.RLock()
+        self.snapshot_path = os.path.join(path, "%s.idx" % name)
+        self.lock_path = os.path.join(path, "%s.lock" % name)
+        self.snapshot_id = None
+        self.epoch = 0
+        self.built = 0
+        self.hashes = self.positions = self.clusters = np.empty(0)
+        self.journal_offset = 0
+        self.journal_count = 0
+        self.recent = {}
+        self.last_refresh = 0
+
+    # Snapshot and journal files
+
+    def journal_path(self, epoch=None):
+        return os.path.join(self.path, "%s.%d.journal" % (self.name, self.epoch if epoch is None else epoch))
+
+    def file_lock(self, exclusive=False):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        f = open(self.lock_path, 'a+')
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return f
+
+    @staticmethod
+    def file_unlock(f):
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    def load(self):
+        """
+        Map the snapshot if it changed since it was last mapped, starting again on the journal of its epoch
+        :return: True if a new snapshot was mapped
+        """
+        try:
+            st = os.stat(self.snapshot_path)
+        except OSError:
+            if self.snapshot_id:
+                # Removed by clear in another worker
+                self.reset()
+            return False
+        snapshot_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if snapshot_id == self.snapshot_id:
+            return False
+        with open(self.snapshot_path, 'rb') as f:
+            magic, count, epoch, built = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            click.echo('[%s_SharedIndex_load] %s is not an index snapshot' % (get_datetime(), self.snapshot_path))
+            return False
+        if count:
+            offset = HEADER.size
+            self.hashes = np.memmap(self.snapshot_path, dtype="<u8", mode="r", offset=offset, shape=(count,))
+            offset += 8 * count
+            self.positions = np.memmap(self.snapshot_path, dtype="<i8", mode="r", offset=offset, shape=(count,))
+            offset += 8 * count
+            self.clusters = np.memmap(self.snapshot_path, dtype="<i4", mode="r", offset=offset, shape=(count,))
+        else:
+            self.hashes = np.empty(0, dtype="<u8")
+            self.positions = np.empty(0, dtype="<i8")
+            self.clusters = np.empty(0, dtype="<i4")
+        self.snapshot_id = snapshot_id
+        self.epoch = epoch
+        self.built = built
+        self.journal_offset = 0
+        self.journal_count = 0
+        self.recent = {}
+        return True
+
+    def reset(self):
+        self.snapshot_id = None
+        self.epoch = 0
+        self.built = 0
+        self.hashes = self.positions = self.clusters = np.empty(0)
+        self.journal_offset = 0
+        self.journal_count = 0
+        self.recent = {}
+
+    def read_journal(self):
+        """
+        Read the entries other workers appended to the journal since the last read
+        :return:
+        """
+        try:
+            with open(self.journal_path(), 'rb') as f:
+                f.seek(self.journal_offset)
+                data = f.read()
+        except OSError:
+            return
+        # Only whole lines are read so a concurrent append is picked up next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf8", errors="ignore").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 2:
+                self.recent[key_hash(parts[0])] = split_rid(parts[1]) if parts[1] != "-" else None
+                self.journal_count += 1
+        self.journal_offset += end
+
+    def refresh(self):
+        with self.lock:
+            self.load()
+            self.read_journal()
+            self.last_refresh = time.time()
+
+    @staticmethod
+    def sorted_unique(hashes, positions, clusters):
+        """
+        Sort the arrays by hash keeping the last entry of any repeated hash
+        :return:
+        """
+        order = np.argsort(hashes, kind="mergesort")
+        hashes, positions, clusters = hashes[order], positions[order], clusters[order]
+        if len(hashes):
+            keep = np.append(hashes[1:] != hashes[:-1], True)
+            hashes, positions, clusters = hashes[keep], positions[keep], clusters[keep]
+        return hashes, positions, clusters
+
+    def write_snapshot(self, hashes, positions, clusters, epoch, built):
+        hashes, positions, clusters = self.sorted_unique(
+            np.asarray(hashes, dtype="<u8"), np.asarray(positions, dtype="<i8"), np.asarray(clusters, dtype="<i4"))
+        tmp = "%s.%d.tmp" % (self.snapshot_path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(hashes), epoch, int(built)))
+            f.write(hashes.tobytes())
+            f.write(positions.tobytes())
+            f.write(clusters.tobytes())
+        open(self.journal_path(epoch), 'ab').close()
+        os.replace(tmp, self.snapshot_path)
+        return len(hashes)
+
+    def build(self, pairs, max_age=SNAPSHOT_MAX_AGE):
+        """
+        Write a new snapshot from (Ext_key, rid) pairs, typically a scan of the class, unless another worker built one
+        within max_age seconds. Only one worker builds at a time and the others then use its snapshot.
+        :param pairs: iterable, or a function returning one so the scan is only run when needed
+        :param max_age:
+        :return: number of entries in the snapshot
+        """
+        f = self.file_lock(exclusive=True)
+        try:
+            with self.lock:
+                self.load()
+                if self.snapshot_id and time.time() - self.built < max_age:
+                    self.read_journal()
+                    return len(self.hashes) + len(self.recent)
+                hashes, positions, clusters = [], [], []
+                for key, rid in (pairs() if callable(pairs) else pairs):
+                    cluster, position = split_rid(rid)
+                    hashes.append(key_hash(key))
+                    positions.append(position)
+                    clusters.append(cluster)
+                old_journal = self.journal_path()
+                count = self.write_snapshot(hashes, positions, clusters, self.epoch + 1, time.time())
+                if os.path.exists(old_journal):
+                    os.remove(old_journal)
+                self.load()
+                return count
+        finally:
+            self.file_unlock(f)
+
+    def compact(self):
+        """
+        Merge the journal into a new snapshot. Appends wait on the file lock while this runs.
+        :return:
+        """
+        f = self.file_lock(exclusive=True)
+        try:
+            with self.lock:
+                self.load()
+                self.read_journal()
+                if self.journal_count < self.compact_size:
+                    return
+                recent = [(h, r) for h, r in self.recent.items() if r]
+                keep = ~np.isin(self.hashes, np.array([h for h, r in self.recent.items() if not r], dtype="<u8"))
+                hashes = np.concatenate([self.hashes[keep], np.array([h for h, r in recent], dtype="<u8")])
+                positions = np.concatenate([self.positions[keep], np.array([r[1] for h, r in recent], dtype="<i8")])
+                clusters = np.concatenate([self.clusters[keep], np.array([r[0] for h, r in recent], dtype="<i4")])
+                old_journal = self.journal_path()
+                count = self.write_snapshot(hashes, positions, clusters, self.epoch + 1, self.built)
+                if os.path.exists(old_journal):
+                    os.remove(old_journal)
+                self.load()
+                click.echo('[%s_SharedIndex_compact] %s snapshot has %d entries' % (get_datetime(), self.name, count))
+        finally:
+            self.file_unlock(f)
+
+    def clear(self):
+        """
+        Remove the snapshot and journals, for a database that was created again
+        :return:
+        """
+        f = self.file_lock(exclusive=True)
+        try:
+            with self.lock:
+                for name in os.listdir(self.path):
+                    if name == "%s.idx" % self.name or (name.startswith("%s." % self.name) and
+                                                        name.endswith(".journal")):
+                        os.remove(os.path.join(self.path, name))
+                self.reset()
+        finally:
+            self.file_unlock(f)
+
+    # Dictionary interface
+
+    def lookup(self, key):
+        h = key_hash(key)
+        with self.lock:
+            if time.time() - self.last_refresh >= REFRESH_INTERVAL:
+                self.refresh()
+            if h in self.recent:
+                return self.recent[h]
+            i = int(np.searchsorted(self.hashes, np.uint64(h)))
+            if i < len(self.hashes) and int(self.hashes[i]) == h:
+                return int(self.clusters[i]), int(self.positions[i])
+            # Not known to this worker yet, check what the other workers have added unless it was checked just now
+            if time.time() - self.last_refresh < MISS_REFRESH_INTERVAL:
+                return None
+            self.refresh()
+            if h in self.recent:
+                return self.recent[h]
+            i = int(np.searchsorted(self.hashes, np.uint64(h)))
+            if i < len(self.hashes) and int(self.hashes[i]) == h:
+                return int(self.clusters[i]), int(self.positions[i])
+        return None
+
+    def get(self, key, default=None):
+        rid = self.lookup(key)
+        return "#%d:%d" % rid if rid else default
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __getitem__(self, key):
+        rid = self.get(key)
+        if rid is None:
+            raise KeyError(key)
+        return rid
+
+    def __setitem__(self, key, rid):
+        """
+        Record a new entry and append it to the journal for the other workers
+        :param key:
+        :param rid:
+        :return:
+        """
+        try:
+            rid = split_rid(rid)
+        except (ValueError, AttributeError):
+            click.echo('[%s_SharedIndex_set] %s is not a RID for %s' % (get_datetime(), rid, key))
+            return
+        self.append(key, "#%d:%d" % rid)
+
+    def discard(self, key):
+        """
+        Drop an entry, for example when its node was deleted, for every worker
+        :param key:
+        :return:
+        """
+        self.append(key, "-")
+
+    def append(self, key, value):
+        f = self.file_lock()
+        try:
+            with self.lock:
+                self.load()
+                self.read_journal()
+                with open(self.journal_path(), 'ab') as j:
+                    j.write(("%s\t%s\n" % (str(key).replace("\t", " ").replace("\n", " "), value)).encode("utf8"))
+                self.read_journal()
+                compact = self.journal_count >= self.compact_size
+        finally:
+            self.file_unlock(f)
+        if compact:
+            self.compact()
+
+    def keys(self):
+        return self
+
+    def __len__(self):
+        self.refresh()
+        return len(self.hashes) + len(self.recent)
+
+    def get_stats(self):
+        self.refresh()
+        return {"snapshot": len(self.hashes), "journal": len(self.recent), "epoch": self.epoch, "built": self.built}
+
+
+# One SharedIndex per file within a worker so every OSINT client reads the same mapping
+shared_indexes = {}
+shared_indexes_lock = threading.Lock()
+
+
+def get_shared_index(path, name):
+    with shared_indexes_lock:
+        key = (path, name, os.getpid())
+        if key not in shared_indexes:
+            shared_indexes[key] = SharedIndex(path, name)
+        return shared_indexes[key]
@@ -0,0 +1,266 @@
+"""
+Streaming reader of STIX 2 bundles run by OSINT.graph_poisonivy. The file is read in chunks and each element of the
+"objects" array of the bundle is decoded on its own with json.JSONDecoder.raw_decode, so only the object being decoded
+and the unread part of the chunk are held in memory whatever the size of the bundle. The import reads the file twice:
+the domain objects are created in the first pass, which fills a map of the STIX ids to the RIDs of their nodes, and the
+relationships and sightings are turned into edges in the second pass using that map.
+"""
+import json
+from apiserver.utils import change_if_date
+
+# STIX types that become edges rather than nodes and the types that aren't graphed at all
+RELATIONSHIP_TYPES = ["relationship", "sighting"]
+SKIPPED_TYPES = ["marking-definition"]
+# STIX types whose class name isn't their capitalized type
+CLASS_NAMES = {
+    "attack-pattern": "AttackPattern",
+    "course-of-action": "CourseOfAction"
+}
+WHITESPACE = " \t\r\n"
+
+
+class StixReader:
+    """
+    Iterate over the objects of a STIX bundle file, counting the bytes read for a ReadProgress
+        for obj in StixReader(path, progress):
+            obj["type"], obj["id"]
+    """
+
+    def __init__(self, path, progress=None, chunk_size=1 << 16):
+        self.path = path
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.f = None
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Drop what has been decoded and append the next chunk, returns False at the end of the file
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if self.progress:
+            self.progress.done += len(chunk.encode("utf8"))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # The next character that isn't whitespace, or None at the end of the file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError("Expected one of %s at %s in %s but found %s" % (
+                list(chars), self.pos, self.path, repr(c)))
+        self.pos += 1
+        return c
+
+    def value(self):
+        # Decode the next value, reading more of the file while it is incomplete
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof or self.buf[self.pos] in "{[\"tfn":
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self.fill():
+                value, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                return value
+
+    def array(self):
+        # The elements of the array whose opening bracket is next
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def __iter__(self):
+        with open(self.path, encoding="utf8") as self.f:
+            self.buf, self.pos, self.eof = "", 0, False
+            if self.peek() == "[":
+                # A bare list of objects rather than a bundle
+                for obj in self.array():
+                    yield obj
+                return
+            self.expect("{")
+            if self.peek() == "}":
+                return
+            while True:
+                key = self.value()
+                self.expect(":")
+                if key == "objects":
+                    for obj in self.array():
+                        yield obj
+                else:
+                    self.value()
+                if self.expect(",}") == "}":
+                    return
+
+
+def stix_timestamp(value):
+    """
+    A STIX timestamp with its fraction of a second padded to microseconds, so timestamps with different precisions
+    such as "2016-04-06T20:03:00Z" and "2016-04-06T20:03:00.000Z" compare in time order as strings
+    :param value:
+    :return: str or None
+    """
+    if not value or type(value) != str:
+        return None
+    if not value.endswith("Z"):
+        return value
+    base, _, fraction = value[:-1].partition(".")
+    return "%s.%sZ" % (base, (fraction + "000000")[:6])
+
+
+def stix_modified(obj):
+    return stix_timestamp(obj.get("modified") or obj.get("created"))
+
+
+def is_relationship(obj):
+    return obj.get("type") in RELATIONSHIP_TYPES
+
+
+def select_objects(objects, relationships, since, stats):
+    """
+    The domain objects, or the relationships and sightings, modified after since. Objects without a timestamp are
+    always selected. The objects read, selected and not selected are counted on stats.
+    :param objects: iterable of STIX objects
+    :param relationships: True for the relationships and sightings
+    :param since: STIX timestamp as returned by stix_timestamp or None
+    :param stats: dict with objects, new and old
+    :return: generator of STIX objects
+    """
+    for obj in objects:
+        if is_relationship(obj) != relationships:
+            continue
+        stats["objects"] += 1
+        modified = stix_modified(obj)
+        if since and modified and modified <= since:
+            stats["old"] += 1
+            continue
+        stats["new"] += 1
+        yield obj
+
+
+def count_written(obj, written, stats):
+    """
+    Count a selected object as written, moving the latest timestamp written on to its own, or as failed
+    :param obj: dict of the STIX object
+    :param written: True if its node and edges were all created
+    :param stats: dict with modified and failed
+    :return:
+    """
+    if not written:
+        stats["failed"] += 1
+        return
+    modified = stix_modified(obj)
+    if modified and (not stats["modified"] or modified > stats["modified"]):
+        stats["modified"] = modified
+
+
+def stix_class(stix_type):
+    return CLASS_NAMES.get(stix_type, stix_type.capitalize())
+
+
+def stix_date(value):
+    return (change_if_date(value) or value) if type(value) == str else value
+
+
+def stix_node(obj):
+    """
+    The create_node kwargs of a STIX domain object, with its id as the Ext_key
+    :param obj: dict of the STIX object
+    :return: dict
+    """
+    node = {"class_name": stix_class(obj["type"]), "Ext_key": obj["id"]}
+    for k in obj.keys():
+        if k in ["type", "id"]:
+            continue
+        if k in ["object_marking_refs", "labels", "sectors", "aliases"]:
+            val = ', '.join(map(str, obj[k]))
+        elif k == "kill_chain_phases":
+            val = ', '.join(["%s:%s" % (p["kill_chain_name"], p["phase_name"]) for p in obj[k]])
+        elif k in ["first_seen", "last_seen", "modified", "created"]:
+            val = stix_date(obj[k])
+        elif type(obj[k]) in [list, dict]:
+            val = json.dumps(obj[k])
+        else:
+            val = obj[k]
+        node[k] = val
+    return node
+
+
+def stix_placeholder(stix_id, description=None):
+    """
+    The create_node kwargs of a node for a STIX id that is referenced but not in the bundle
+    :param stix_id:
+    :param description:
+    :return: dict
+    """
+    stix_type = stix_id.split("--")[0]
+    class_name = "Identity" if stix_type == "identity" else "Object"
+    return {"class_name": class_name, "Ext_key": stix_id,
+            "description": description or "CTI %s %s" % (stix_type.capitalize(), stix_id)}
+
+
+def stix_kill_chain(obj):
+    """
+    The create_node kwargs of the kill chain phases of a domain object, which are linked to it
+    :param obj: dict of the STIX object
+    :return: list of dict
+    """
+    return [{"class_name": "Object", "Ext_key": "%s:%s" % (p["kill_chain_name"], p["phase_name"]),
+             "description": "CTI kill chain %s phase %s" % (p["kill_chain_name"], p["phase_name"])}
+            for p in obj.get("kill_chain_phases", [])]
+
+
+def stix_edges(obj):
+    """
+    The edges of a relationship or sighting as (from id, edge type, to id). A sighting is also a node, linked from
+    its creator and to what was sighted.
+    :param obj: dict of the STIX object
+    :return: list of tuples
+    """
+    if obj["type"] == "relationship":
+        return [(obj["source_ref"], obj["relationship_type"], obj["target_ref"])]
+    edges = []
+    if obj.get("created_by_ref"):
+        edges.append((obj["created_by_ref"], "Created", obj["id"]))
+    if obj.get("sighting_of_ref"):
+        edges.append((obj["id"], "SightingOf", obj["sighting_of_ref"]))
+    for ref in obj.get("where_sighted_refs", []):
+        edges.append((obj["id"], "SightedAt", ref))
+    return edges
+
+
+def stix_sighting(obj):
+    """
+    The create_node kwargs of the Sighting node of a sighting
+    :param obj: dict of the STIX object
+    :return: dict
+    """
+    return {"class_name": "Sighting", "Ext_key": obj["id"],
+            "createDate": stix_date(obj.get("created")), "updateDate": stix_date(obj.get("modified")),
+            "description": "CTI Sighting of %s on %s" % (obj.get("sighting_of_ref"), obj.get("created"))}
@@ -3,23 +3,18 @@ from apiserver.blueprints.osint.models import OSINT
 from apiserver.utils import get_request_payload, get_datetime, check_for_file
 from flask_cors import CORS
 from apiserver.blueprints.osint.shodan import Shodan
+from apiserver.blueprints.home.lazy import LazyServer
 import click
 import json
 
 # Create the blueprint and ensure CORS enabled for the webapp calls
 osint = Blueprint('osint', __name__)
 CORS(osint)
-shodanserver = Shodan()
-osintserver = OSINT()
-# Case where no DB has been established from which the message returned should let the user know to run the setup API
-init_required = osintserver.open_db()
-if init_required:
-    click.echo("[%s_OSINT_view_init] Setup required" % get_datetime())
-else:
-    osintserver.refresh_indexes()
-    shodanserver.open_db()
-    #osintserver.check_base_book()
-    #osintserver.fill_db()
+# The clients open the DB on first use and the OSINT indexes are filled in the background once it is open. Where no DB
+# has been established the state is setup_required, reported by /health, until db_init is run
+shodanserver = LazyServer("Shodan", Shodan, setup=lambda s: s.open_db())
+osintserver = LazyServer("OSINT", OSINT, setup=lambda s: s.open_db(), background=lambda s: (
+    s.refresh_indexes(), s.warm_hashkey_cache(), s.warm_suggestion_index()))
 
 
 @osint.route('/osint/db_init', methods=['GET'])
@@ -29,6 +24,8 @@ def db_init():
     :return:
     """
     result = osintserver.create_db()
+    osintserver._reset()
+    shodanserver._reset()
     return jsonify({
         "status": 200,
         "message": result
@@ -139,6 +136,21 @@ def merge_nodes():
     })
 
 
+@osint.route('/osint/merge_node_groups', methods=['POST'])
+def merge_node_groups():
+    '''
+    Route for merging many groups of duplicate nodes, each a node_A key and a list of node_B keys
+    :return:
+    '''
+    r = get_request_payload(request)
+    r = osintserver.merge_osint_groups(**r)
+    return jsonify({
+        "status": 200,
+        "message": "Merged %d nodes in %d groups rewiring %d edges" % (r["merged"], r["groups"], r["edges_rewired"]),
+        "data": r
+    })
+
+
 @osint.route('/osint/get_suggestion_items', methods=['POST'])
 def get_suggestion_items():
     '''
@@ -171,11 +183,12 @@ def get_neighbors():
 @osint.route('/osint/get_neighbors_index', methods=['POST'])
 def get_neighbors_index():
     '''
-    Base route for merging nodes
+    Neighbors of nodekey bounded by the optional depth, fanout, limit, edge_types, direction and sample, with the cursor
+    of the next page returned in data
     :return:
     '''
     r = get_request_payload(request)
-    r = osintserver.get_neighbors_index(**r)
+    r = osintserver.get_neighborhood(**r)
     return jsonify({
         "status": 200,
         "message": r["message"],
@@ -186,13 +199,63 @@ def get_neighbors_index():
 @osint.route('/osint/cve', methods=['GET'])
 def get_cve():
     '''
-    Base route for merging nodes
+    Start the MITRE CVE import, ?full=true writes every CVE rather than those new or changed since the last import
     :return:
     '''
+    job = osintserver.get_cve(full=request.args.get("full", False))
     return jsonify({
         "status": 200,
-        "message": "Database updated with latest CVE",
-        "data": osintserver.get_cve()
+        "message": "CVE import %s" % ("already running" if job["existing"] else "started"),
+        "data": job
+    })
+
+
+@osint.route('/osint/jobs', methods=['GET'])
+def get_jobs():
+    """
+    List the background jobs of all workers, optionally filtered by ?type= and ?status=
+    :return:
+    """
+    jobs = osintserver.jobs.list(job_type=request.args.get("type"), status=request.args.get("status"))
+    return jsonify({
+        "status": 200,
+        "message": "Retrieved %d jobs" % len(jobs),
+        "data": jobs
+    })
+
+
+@osint.route('/osint/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Status and progress of a background job
+    :param job_id:
+    :return:
+    """
+    job = osintserver.jobs.get(job_id)
+    if not job:
+        return jsonify({"status": 404, "message": "No job %s" % job_id, "data": None})
+    return jsonify({
+        "status": 200,
+        "message": "%s is %s" % (job_id, job["status"]),
+        "data": job
+    })
+
+
+@osint.route('/osint/jobs/<job_id>/cancel', methods=['GET', 'POST'])
+def cancel_job(job_id):
+    """
+    Ask a background job to stop at its next check
+    :param job_id:
+    :return:
+    """
+    job = osintserver.jobs.cancel(job_id)
+    if not job:
+        return jsonify({"status": 404, "message": "No job %s" % job_id, "data": None})
+    return jsonify({
+        "status": 200,
+        "message": "Cancel requested for %s" % job_id if job.get("cancel_requested") else "%s is %s" % (
+            job_id, job["status"]),
+        "data": job
     })
 
 
@@ -221,9 +284,54 @@ def poisonivy():
 
     :return:
     """
+    job = osintserver.get_poisonivy()
     return jsonify({
         "status": 200,
-        "message": osintserver.get_poisonivy(),
+        "message": "Poisonivy import %s" % ("already running" if job["existing"] else "started"),
+        "data": job
+    })
+
+
+@osint.route('/osint/feeds', methods=['GET'])
+def get_feeds():
+    """
+    The STIX feeds with the modified timestamp each has been ingested up to and the throughput of their runs
+    :return:
+    """
+    feeds = osintserver.get_feeds()
+    return jsonify({
+        "status": 200,
+        "message": "%d feeds" % len(feeds),
+        "data": feeds
+    })
+
+
+@osint.route('/osint/feeds/ingest', methods=['GET'])
+def ingest_feeds():
+    """
+    Start a job ingesting the objects of every feed, or the feed given by the name argument, modified since the last
+    run of the feed
+    :return:
+    """
+    job = osintserver.ingest_feeds(name=request.args.get("name"))
+    return jsonify({
+        "status": 200,
+        "message": "Feed import %s" % ("already running" if job["existing"] else "started"),
+        "data": job
+    })
+
+
+@osint.route('/osint/start_feed_monitor', methods=['GET'])
+def start_feed_monitor():
+    """
+    Turn the feed monitor, which ingests the feeds every FEED_MONITOR_INTERVAL seconds, on or off
+    :return:
+    """
+    r = osintserver.start_feed_monitor()
+    return jsonify({
+        "status": 200,
+        "message": r["message"],
+        "data": r["data"]
     })
 
 
@@ -249,7 +357,8 @@ def start_twitter_monitor():
     r = osintserver.start_twitter_monitor()
     return jsonify({
         "status": 200,
-        "message": r["message"]
+        "message": r["message"],
+        "data": r["data"]
     })
 
 
@@ -262,7 +371,8 @@ def start_merge_monitor():
     r = osintserver.start_merge_monitor()
     return jsonify({
         "status": 200,
-        "message": r["message"]
+        "message": r["message"],
+        "data": r["data"]
     })
 
 
@@ -342,7 +452,7 @@ def graph_etl_model():
         if "file" in request.form.to_dict().keys():
             graph = osintserver.graph_etl_model(
                 json.loads(request.form.to_dict()['model']),
-                osintserver.file_to_frame(request.form.to_dict()["file"])["data"])
+                request.form.to_dict()["file"])
         elif "file" in r.keys() and "model" in r.keys():
             graph = osintserver.graph_etl_model(r["model"], r["file"])
         else:
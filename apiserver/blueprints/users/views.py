@@ -1,5 +1,6 @@
 from flask import jsonify, Blueprint, request
 from apiserver.blueprints.users.models import userDB
+from apiserver.blueprints.home.lazy import LazyServer
 from apiserver.blueprints.home.models import get_datetime
 from apiserver.utils import get_request_payload
 from flask_cors import CORS
@@ -8,15 +9,9 @@ import click
 # Application Route specific object instantiation
 users = Blueprint('users', __name__)
 CORS(users)
-# Case where no DB has been established from which the message returned should let the user know to run the setup API
+# The client opens the DB on first use. Where no DB has been established the state is setup_required until db_init
 
-odbserver = userDB()
-init_required = odbserver.open_db()
-if init_required:
-    click.echo("[%s_User_init] Setup required" % get_datetime())
-else:
-    odbserver.open_db()
-    click.echo('[%s_UserServer_init] Complete' % (get_datetime()))
+odbserver = LazyServer("User", userDB, setup=lambda s: s.open_db(), background=lambda s: s.warm_hashkey_cache())
 
 
 @users.route('/users/db_init', methods=['GET'])
@@ -26,6 +21,7 @@ def db_init():
     :return:
     """
     result = odbserver.create_db()
+    odbserver._reset()
     if not result:
         return jsonify({
             "status": 200,
@@ -0,0 +1,81 @@
+"""
+Normalization and hashing of node attributes. The translation tables are built once when the module is imported and
+the hashkey string of a node is built in a single pass over the nodeKeys, with batch versions for the ETL and
+ingestion paths that hash many nodes at a time. The hashkeys are the same as those already stored in the databases:
+the md5 of the concatenated key and value of each nodeKey present and not empty, lower cased with punctuation and
+spaces removed.
+"""
+import string
+import hashlib
+import pandas as pd
+
+# clean_concat: drop punctuation (which includes the commas of values treated as lists) and spaces
+KEY_TABLE = str.maketrans('', '', string.punctuation + " ")
+# clean: drop backslashes and double quotes, escape single quotes and flatten new lines for sql
+SQL_TABLE = str.maketrans({"\\": None, '"': None, "'": "\\'", "\n": " "})
+
+
+def normalize_key(content):
+    """
+    Lower case and remove punctuation and spaces
+    :param content: str
+    :return:
+    """
+    return content.lower().translate(KEY_TABLE)
+
+
+def escape_sql(content):
+    return content.translate(SQL_TABLE)
+
+
+def hash_string(attributes, node_keys):
+    """
+    Build the normalized string the hashkey is taken from. Each key and value is normalized on its own, which is what
+    normalizing the whole string again after appending each key gave, without repeating the work on the growing string.
+    :param attributes: dict of the node attributes
+    :param node_keys: ordered list of the attributes that identify a node
+    :return:
+    """
+    return "".join([normalize_key(k + str(attributes[k]))
+                    for k in node_keys if k in attributes and attributes[k] != ""])
+
+
+def hash_attributes(attributes, node_keys):
+    """
+    Hashkey of one node
+    :param attributes:
+    :param node_keys:
+    :return: md5 hex digest
+    """
+    return hashlib.md5(hash_string(attributes, node_keys).encode()).hexdigest()
+
+
+def hash_frame(frame, node_keys):
+    """
+    Hashkeys of a DataFrame where each row holds the attributes of one node. Each nodeKeys column is normalized as a
+    whole and the columns are then concatenated, skipping empty values.
+    :param frame: DataFrame with a column per attribute
+    :param node_keys:
+    :return: Series of md5 hex digests aligned with frame
+    """
+    hash_str = pd.Series("", index=frame.index)
+    for k in node_keys:
+        if k in frame.columns:
+            column = frame[k]
+            part = (k + column.map(str)).str.lower().str.translate(KEY_TABLE)
+            hash_str = hash_str + part.where(column != "", "")
+    md5 = hashlib.md5
+    return hash_str.map(lambda h: md5(h.encode()).hexdigest())
+
+
+def hash_values(values):
+    """
+    Hash of the values of a dictionary in order, as used to identify nodes that have no nodeKeys. Each value is
+    appended to the digest of the values before it and hashed again.
+    :param values: dict
+    :return: md5 hex digest
+    """
+    node_id = ""
+    for v in values.values():
+        node_id = hashlib.md5((node_id + str(v)).encode()).hexdigest()
+    return node_id
@@ -4,13 +4,15 @@ custom files. Also manage the naming of all sensitive variables from the config
 values.
 """
 import time, string, random, socket, pyorient
-import click, smtplib, ssl, json, os
+import click, smtplib, ssl, json, os, re
 import pyorient
+import pandas as pd
 from datetime import datetime
-from dateutil.parser import parse, parser
+from dateutil.parser import parse, parser, parserinfo
 from werkzeug.utils import secure_filename
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from apiserver.hashing import normalize_key, escape_sql
 from apiserver.config import HOST_IP, SECRET_KEY, MAIL_PASSWORD,\
     MAIL_USERNAME, HTTPS, TWITTER_AUTH, SHODAN, MESSAGE_OPENING, \
     MESSAGE_CLOSING, ODB_USER, ODB_PSWD
@@ -49,8 +51,82 @@ MAIL_DEFAULT_SENDER = 'from@example.com'
 TWITTER_AUTH = TWITTER_AUTH
 SHODAN = SHODAN
 
+# OrientDB connection pool settings shared by all blueprint clients within a worker
+ODB_PORT = int(os.environ.get("ODB_PORT", 2424))
+ODB_POOL_SIZE = int(os.environ.get("ODB_POOL_SIZE", 10))
+ODB_POOL_TIMEOUT = int(os.environ.get("ODB_POOL_TIMEOUT", 30))
+ODB_POOL_IDLE = int(os.environ.get("ODB_POOL_IDLE", 300))
+ODB_POOL_HEALTH = int(os.environ.get("ODB_POOL_HEALTH", 60))
+
+# In process hashkey to RID cache used by check_index_nodes. Size is per class
+HASHKEY_CACHE_SIZE = int(os.environ.get("HASHKEY_CACHE_SIZE", 100000))
+HASHKEY_BLOOM_CAPACITY = int(os.environ.get("HASHKEY_BLOOM_CAPACITY", 1000000))
+# Seconds a cached RID is trusted before the index is checked again, since nodes deleted or merged in another worker
+# are only forgotten by the cache of the worker that removed them
+HASHKEY_CACHE_TTL = int(os.environ.get("HASHKEY_CACHE_TTL", 60))
+# Nodes read per query when a class is loaded into the hashkey cache
+HASHKEY_WARM_BATCH = int(os.environ.get("HASHKEY_WARM_BATCH", 10000))
+
+# Number of statements sent per OrientDB script by the bulk node and edge writers
+EDGE_BATCH_SIZE = int(os.environ.get("EDGE_BATCH_SIZE", 250))
+
+# Rows read per chunk when an upload is streamed through graph_etl_model and the most nodes and lines it returns
+ETL_CHUNK_SIZE = int(os.environ.get("ETL_CHUNK_SIZE", 20000))
+ETL_GRAPH_LIMIT = int(os.environ.get("ETL_GRAPH_LIMIT", 5000))
+
+# Threads per worker running background jobs such as the CVE import and the monitors
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+
+# Shared OSINT Ext_key index snapshots. Seconds before a worker rebuilds the snapshot from the database, and the number
+# of journal entries after which the journal is merged into a new snapshot
+SNAPSHOT_MAX_AGE = int(os.environ.get("SNAPSHOT_MAX_AGE", 6 * 60 * 60))
+SNAPSHOT_COMPACT_SIZE = int(os.environ.get("SNAPSHOT_COMPACT_SIZE", 50000))
+
+# Case graphs kept by load_graph per database and the seconds one is used before it is loaded again regardless
+CASE_CACHE_SIZE = int(os.environ.get("CASE_CACHE_SIZE", 100))
+CASE_CACHE_TTL = int(os.environ.get("CASE_CACHE_TTL", 300))
+
+# Bounds of get_neighborhood: relations followed per node and hop, nodes returned, hops and the relations of a hub
+# ranked when sampling by degree
+NEIGHBOR_FANOUT = int(os.environ.get("NEIGHBOR_FANOUT", 100))
+NEIGHBOR_LIMIT = int(os.environ.get("NEIGHBOR_LIMIT", 500))
+NEIGHBOR_MAX_DEPTH = int(os.environ.get("NEIGHBOR_MAX_DEPTH", 3))
+NEIGHBOR_SAMPLE_POOL = int(os.environ.get("NEIGHBOR_SAMPLE_POOL", 1000))
+
+# Typeahead suggestions returned per class and the most nodes of a class loaded into the suggestion index
+SUGGEST_LIMIT_PER_CLASS = int(os.environ.get("SUGGEST_LIMIT_PER_CLASS", 10))
+SUGGEST_WARM_LIMIT = int(os.environ.get("SUGGEST_WARM_LIMIT", 200000))
+
+# Responses kept for repeated suggestion and neighbor queries and the seconds one is used, which bounds how long a
+# write made through another worker can go unseen
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1000))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 60))
+
+# Furthest distance in km at which a point is reverse geocoded to a city of the local gazetteer
+GAZETTEER_MAX_KM = int(os.environ.get("GAZETTEER_MAX_KM", 50))
+
+# Seconds a resolved location string is kept in the location cache and a string that could not be resolved is
+# skipped before it is tried again
+LOCATION_CACHE_TTL = int(os.environ.get("LOCATION_CACHE_TTL", 30 * 24 * 60 * 60))
+LOCATION_NEGATIVE_TTL = int(os.environ.get("LOCATION_NEGATIVE_TTL", 24 * 60 * 60))
+
+# CVE rows created together by graph_cve along with the references first seen in them
+CVE_BATCH_SIZE = int(os.environ.get("CVE_BATCH_SIZE", 500))
+# Threads creating the new references of a CVE batch, each with its own pooled database connection
+CVE_REFERENCE_WORKERS = int(os.environ.get("CVE_REFERENCE_WORKERS", 4))
+# STIX objects created together by graph_poisonivy in each of its passes
+STIX_BATCH_SIZE = int(os.environ.get("STIX_BATCH_SIZE", 500))
+# Seconds the feed monitor waits between imports of the STIX feeds
+FEED_MONITOR_INTERVAL = int(os.environ.get("FEED_MONITOR_INTERVAL", 60 * 60))
+
+# Duplicate groups read together by merge_node_groups, each group is still written in its own transaction
+MERGE_GROUP_CHUNK = int(os.environ.get("MERGE_GROUP_CHUNK", 100))
+
+# Vertices the merge monitor reads from a cluster at a time and the seconds it waits between rounds
+MERGE_MONITOR_BATCH = int(os.environ.get("MERGE_MONITOR_BATCH", 1000))
+MERGE_MONITOR_INTERVAL = int(os.environ.get("MERGE_MONITOR_INTERVAL", 10 * 60))
+
 def check_HOST_IP():
-    time.sleep(10)
     user = ODB_USER
     pswd = ODB_PSWD
     for ip in IPS:
@@ -111,7 +187,7 @@ def clean_concat(content):
     :return:
     """
     try:
-        content = content.lower().translate(str.maketrans('', '', string.punctuation)).replace(" ", "")
+        content = normalize_key(content)
     except Exception as e:
         click.echo('%s %s' % (get_datetime(), str(e)))
         content = None
@@ -132,8 +208,7 @@ def clean(content):
         if clean_content:
             return clean_content
         else:
-            clean_content = str(content.replace("\\", ""))
-            clean_content = str(clean_content.replace("'", "\\'").replace('"', '').replace("\n", " "))
+            clean_content = str(escape_sql(content))
     except Exception as e:
         try:
             clean_content = change_if_number(content)
@@ -170,38 +245,167 @@ def date_to_standard_string(date):
         return date
 
 
+DATE_FORMATS = [
+    '%d.%m.%Y','%a, %d %b %Y %H:%M:%S %z', '%a, %d %b %Y %H:%M:%S %Z', '%A, %D %B %Y %H:%M:%S %z', '%A, %D %B %Y %H:%M:%S %Z',
+    '%A, %D %B %y %h:%m:%s %z', '%a, %d %b %y %h:%m:%s %z', '%a, %d %b %y %h:%m:%s %Z','%a, %D %b %Y %H:%M:%S %Z',
+    '%m/%d/%y, %I:%M %p', '%M/%d/%y, %I:%M %p', '%M/%D/%y, %I:%M %p', '%M/%D/%Y, %I:%M %p', '%m/%d/%Y/%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S','%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y', '%Y-%M-%D', '%Y/%M/%D', '%D-%M-%Y',
+    '%D/%M/%Y', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S',
+    '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M', '%d-%m-%Y %H:%M', '%d/%m/%Y %H:%M'
+]
+# What each strptime directive can match in the shape of a string, where every digit is a 9 and every letter an a
+DATE_SHAPE_DIRECTIVES = {
+    "d": " ?9{1,2}", "m": " ?9{1,2}", "H": "9{1,2}", "I": "9{1,2}", "M": "9{1,2}", "S": "9{1,2}", "y": "99",
+    "Y": "9999", "a": "a+", "A": "a+", "b": "a+", "B": "a+", "p": "a+", "Z": ".+",
+    "z": "(?:[+-]99:?99(?::?99(?:\\.9{1,6})?)?|a)"
+}
+DATE_NAME_DIRECTIVES = "aAbBpzZ"
+DATE_DIGIT = re.compile(r"\d")
+DATE_LETTER = re.compile(r"[^\W\d_]")
+DATE_WORD = re.compile(r"[^\W\d_]+")
+DATE_SHAPE_CACHE_SIZE = 10000
+
+
+def date_shape_pattern(date_format):
+    """
+    Compile the pattern of the shapes a strptime format can match
+    :param date_format:
+    :return: compiled pattern or None if strptime can never match the format, like those using %D or a directive twice
+    """
+    pattern = ""
+    directives = set()
+    i = 0
+    while i < len(date_format):
+        c = date_format[i]
+        if c == "%":
+            d = date_format[i + 1:i + 2]
+            if d not in DATE_SHAPE_DIRECTIVES or d in directives:
+                return None
+            directives.add(d)
+            pattern += DATE_SHAPE_DIRECTIVES[d]
+            i += 2
+            continue
+        if c.isspace():
+            pattern += "\\s+"
+        elif c.isdigit():
+            pattern += "9"
+        elif DATE_LETTER.match(c):
+            pattern += "a"
+        else:
+            pattern += re.escape(c)
+        i += 1
+    return re.compile(pattern)
+
+
+DATE_SHAPE_PATTERNS = [(f, date_shape_pattern(f)) for f in DATE_FORMATS if date_shape_pattern(f)]
+date_shape_cache = {}
+
+
+def date_shape(date_string):
+    return DATE_LETTER.sub("a", DATE_DIGIT.sub("9", date_string))
+
+
+def date_shape_formats(shape):
+    """
+    Return the formats, in the order of DATE_FORMATS, that could match strings of the shape. Shapes repeat heavily in
+    real data so the result is kept in date_shape_cache.
+    :param shape:
+    :return:
+    """
+    formats = date_shape_cache.get(shape)
+    if formats is None:
+        formats = [f for f, pattern in DATE_SHAPE_PATTERNS if pattern.fullmatch(shape)]
+        if len(date_shape_cache) >= DATE_SHAPE_CACHE_SIZE:
+            date_shape_cache.clear()
+        date_shape_cache[shape] = formats
+    return formats
+
+
+def get_date_words():
+    """
+    The words dateutil's parser recognizes. Any other word makes it fail unless fuzzy, apart from short upper case
+    words that may be a timezone name.
+    :return: (month and weekday names, all known words)
+    """
+    info = parserinfo()
+    names = set()
+    for w in info.WEEKDAYS + info.MONTHS:
+        names.update([n.lower() for n in w])
+    words = set(names)
+    for w in info.HMS + info.AMPM:
+        words.update([n.lower() for n in w])
+    words.update([n.lower() for n in info.JUMP + info.UTCZONE + info.PERTAIN])
+    # Words float() accepts are read as numbers
+    words.update(["nan", "inf", "infinity", "e"])
+    return names, words
+
+
+DATE_NAMES, DATE_WORDS = get_date_words()
+
+
 def change_if_date(date_string, fuzzy=False):
     """
-    Return a date if the string is possibly in a date format within the list of date_formats.
+    Return a date if the string is possibly in a date format within the list of DATE_FORMATS, otherwise the string
+    dateutil parses it to or False. Strings with words dateutil does not know are rejected without parsing, and the
+    shape of the string selects the formats worth trying with strptime so most strings are resolved by one strptime
+    call instead of parsing and trying every format.
 
     :param date_string: str, string to check for date
     :param fuzzy: bool, ignore unknown tokens in string if True
     """
-    date_formats = [
-        '%d.%m.%Y','%a, %d %b %Y %H:%M:%S %z', '%a, %d %b %Y %H:%M:%S %Z', '%A, %D %B %Y %H:%M:%S %z', '%A, %D %B %Y %H:%M:%S %Z',
-        '%A, %D %B %y %h:%m:%s %z', '%a, %d %b %y %h:%m:%s %z', '%a, %d %b %y %h:%m:%s %Z','%a, %D %b %Y %H:%M:%S %Z',
-        '%m/%d/%y, %I:%M %p', '%M/%d/%y, %I:%M %p', '%M/%D/%y, %I:%M %p', '%M/%D/%Y, %I:%M %p', '%m/%d/%Y/%H:%M:%S',
-        '%Y-%m-%dT%H:%M:%S','%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y', '%Y-%M-%D', '%Y/%M/%D', '%D-%M-%Y',
-        '%D/%M/%Y', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S',
-        '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M', '%d-%m-%Y %H:%M', '%d/%m/%Y %H:%M'
-    ]
-    try:
+    if fuzzy or type(date_string) != str:
+        # Raises TypeError for values that are not strings as parsing always has
         parse(date_string, fuzzy=fuzzy)
+        formats = DATE_FORMATS
+    else:
+        words = DATE_WORD.findall(date_string)
+        for w in words:
+            if w.lower() not in DATE_WORDS and not (len(w) <= 5 and w.isupper()):
+                return False
+        # Without digits only a month or weekday name makes a date
+        if not DATE_DIGIT.search(date_string) and not DATE_NAMES.intersection([w.lower() for w in words]):
+            return False
+        formats = date_shape_formats(date_shape(date_string))
+    for df in formats:
         try:
-            for df in date_formats:
-                try:
-                    dt = datetime.strptime(date_string, df)
-                    return dt
-                except:
-                    pass
-            lastAttempt = datetime.strftime(parse(date_string, fuzzy=fuzzy), "%Y-%m-%d %H:%M:%S")
-            return lastAttempt
-        except Exception as e:
-            click.echo('%s %s' % (get_datetime(), str(e)))
-        return False
-
+            return datetime.strptime(date_string, df)
+        except ValueError:
+            pass
+    try:
+        parsed = parse(date_string, fuzzy=fuzzy)
     except ValueError:
         return False
+    try:
+        return datetime.strftime(parsed, "%Y-%m-%d %H:%M:%S")
+    except Exception as e:
+        click.echo('%s %s' % (get_datetime(), str(e)))
+        return False
+
+
+def change_if_date_column(column):
+    """
+    Vectorized change_if_date for a pandas column. Distinct strings are grouped by shape and a group with a single
+    numeric format is converted by one pd.to_datetime call, the rest go through change_if_date once per distinct value.
+    :param column: Series
+    :return: Series aligned with column of datetime, str or False as change_if_date returns, False for non strings
+    """
+    distinct = pd.Series(column[column.map(type) == str].unique(), dtype=object)
+    converted = {}
+    if len(distinct) == 0:
+        return pd.Series(False, index=column.index, dtype=object)
+    shapes = distinct.map(date_shape)
+    for shape, group in distinct.groupby(shapes):
+        formats = date_shape_formats(shape)
+        if len(formats) == 1 and not any("%" + d in formats[0] for d in DATE_NAME_DIRECTIVES):
+            parsed = pd.to_datetime(group, format=formats[0], errors="coerce")
+            for value, date in zip(group, parsed):
+                if not pd.isnull(date):
+                    converted[value] = date.to_pydatetime()
+        for value in group:
+            if value not in converted:
+                converted[value] = change_if_date(value)
+    return column.map(lambda v: converted.get(v, False) if type(v) == str else False)
+
 
 def randomString(stringLength=15):
 
@@ -210,9 +414,6 @@ def randomString(stringLength=15):
 
 
 def get_host(user, pswd):
-    click.echo('[OrientModel_init__%s] Pausing to allow ODB setup' % (get_datetime()))
-    time.sleep(20)
-    click.echo('[OrientModel_init__%s] Complete to allow ODB setup' % (get_datetime()))
     possible_hosts = socket.gethostbyname_ex(socket.gethostname())[-1]
     if len(possible_hosts) > 0:
         hostname = possible_hosts[0][:possible_hosts[0].rfind('.')]